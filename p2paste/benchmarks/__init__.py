@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks, run them from the repository root with: python -m p2paste.benchmarks.<name>
+'''
+
+import site
+import os
+
+
+# The network package is imported the way start.py makes it importable
+site.sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
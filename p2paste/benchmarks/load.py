@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+'''
+Load generator: a ChatServer driven by many headless ChatClients
+
+    python -m p2paste.benchmarks.load --workload chat_storm --clients 100 --duration 10 --output run.json
+
+The server runs in a process of its own and the clients are spread over worker
+processes. Whatever a workload sends carries its send time, so every receiving
+client measures the end-to-end delivery latency. The report is written as JSON,
+to compare runs over time.
+
+Workloads:
+    chat_storm          every client sends --rate messages per second
+    paste_contention    every client keeps requesting the paste permission and pasting
+    paste_fanout        one client pastes --paste-size characters every --interval seconds
+    churn               every client keeps disconnecting and joining again
+'''
+
+from p2paste.chatserver import ChatServer
+from p2paste.chatclient import ChatClient, ConnectionBroken
+from p2paste.cluster import ChatCluster
+from p2paste import settings
+import multiprocessing
+import threading
+import argparse
+import resource
+import logging
+import random
+import string
+import json
+import time
+import ssl
+import sys
+
+
+WORKLOADS = ('chat_storm', 'paste_contention', 'paste_fanout', 'churn')
+BENCH_PREFIX = u'bench'
+MAX_SAMPLES = 100000
+
+
+class LatencyRecorder(object):
+    '''Reservoir of samples, so long runs with many clients keep a bounded memory'''
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.samples = []
+        self.seen = 0
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            self.seen += 1
+            if len(self.samples) < self.max_samples:
+                self.samples.append(value)
+                return
+            index = random.randrange(self.seen)
+            if index < self.max_samples:
+                self.samples[index] = value
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+
+    def percentile(percent):
+        return ordered[min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))]
+
+    return dict(count=len(ordered), mean=sum(ordered) / len(ordered), p50=percentile(50),
+                p90=percentile(90), p99=percentile(99), max=ordered[-1])
+
+
+def stamp(text=u''):
+    return u'{0} {1!r}\n{2}'.format(BENCH_PREFIX, time.time(), text)
+
+
+def stamped_time(text):
+    '''Send time carried by a benchmark message or paste, None for anything else'''
+    if not text.startswith(BENCH_PREFIX):
+        return None
+    try:
+        return float(text[len(BENCH_PREFIX):text.index(u'\n')])
+    except ValueError:
+        return None
+
+
+def random_text(size):
+    # Nothing in common with the previous paste, so it's never sent as a delta
+    line = ''.join(random.choice(string.ascii_letters) for _index in xrange(79)) + '\n'
+    return unicode(line * (size // len(line) + 1))[:size]
+
+
+class BenchClient(object):
+    '''Headless ChatClient recording the latency of everything stamped it receives'''
+
+    def __init__(self, nickname, options, address, report):
+        self.nickname = nickname
+        self.address = address
+        self.report = report
+        self.welcomed = threading.Event()
+        self.granted = threading.Event()
+        self.chat_client = ChatClient(
+            logging.getLogger('p2paste.benchmarks.load'),
+            settings.PASTE_CHUNK_SIZE,
+            settings.CLIENT_TIMEOUT,
+            options.ssl_version,
+            options.certificate,
+            settings.COMPRESSION_THRESHOLD
+        )
+        self.chat_client.message_handler.bind(self._message_received)
+        self.chat_client.paste_handler.bind(self._paste_received)
+        self.chat_client.paste_delta_handler.bind(lambda sender, changes, _text: self._paste_received(sender, changes))
+        self.chat_client.paste_granted_handler.bind(lambda *args: self.granted.set())
+
+    def _received(self, text):
+        sent_at = stamped_time(text)
+        if sent_at is not None:
+            self.report.delivered(time.time() - sent_at)
+
+    def _message_received(self, sender, message):
+        if sender == settings.SERVER_IDENTIFIER:
+            self.welcomed.set()
+            return
+        self._received(message)
+
+    def _paste_received(self, sender, _paste_data):
+        # Deltas only carry the changes, the stamp is read from the updated blackboard
+        self._received(self.chat_client.blackboard.text)
+
+    def connect(self):
+        self.welcomed.clear()
+        self.chat_client.connect(self.address, self.nickname)
+
+    def disconnect(self):
+        if self.chat_client.connected:
+            self.chat_client.disconnect()
+
+    def paste(self, text, deadline):
+        '''Waits for the paste permission and pastes, returns the seconds waited or None'''
+        requested_at = time.time()
+        self.granted.clear()
+        self.chat_client.send_paste_request()
+        if not self.granted.wait(max(0.0, deadline - requested_at)):
+            return None
+        waited = time.time() - requested_at
+        self.chat_client.send_paste(stamp(text))
+        return waited
+
+
+class WorkerReport(object):
+
+    def __init__(self):
+        self.sent = 0
+        self.errors = 0
+        self.latencies = LatencyRecorder()
+        self.waits = LatencyRecorder()
+        self.lock = threading.Lock()
+
+    def delivered(self, latency):
+        self.latencies.add(latency)
+
+    def count_sent(self, count=1):
+        with self.lock:
+            self.sent += count
+
+    def count_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def as_dict(self):
+        return dict(sent=self.sent, errors=self.errors, delivered=self.latencies.seen,
+                    latencies=self.latencies.samples, waits=self.waits.samples)
+
+
+def chat_storm(client, options, deadline, report, leader):
+    interval = 1.0 / options.rate
+    # Clients start spread over one interval, instead of all sending at once
+    time.sleep(random.random() * interval)
+    while time.time() < deadline:
+        client.chat_client.send_message(stamp())
+        report.count_sent()
+        time.sleep(interval)
+
+
+def paste_contention(client, options, deadline, report, leader):
+    while time.time() < deadline:
+        waited = client.paste(random_text(options.paste_size), deadline)
+        if waited is None:
+            return
+        report.waits.add(waited)
+        report.count_sent()
+        time.sleep(random.random() * options.interval)
+
+
+def paste_fanout(client, options, deadline, report, leader):
+    if not leader:
+        return
+    while time.time() < deadline:
+        started = time.time()
+        waited = client.paste(random_text(options.paste_size), deadline)
+        if waited is None:
+            return
+        report.waits.add(waited)
+        report.count_sent()
+        time.sleep(max(0.0, options.interval - (time.time() - started)))
+
+
+def churn(client, options, deadline, report, leader):
+    while time.time() < deadline:
+        client.disconnect()
+        started = time.time()
+        client.connect()
+        if client.welcomed.wait(settings.CLIENT_TIMEOUT):
+            report.waits.add(time.time() - started)
+        report.count_sent()
+        time.sleep(random.random() * options.interval)
+
+
+def _run_worker(worker_id, client_count, options, address, conn):
+    random.seed(worker_id)
+    report = WorkerReport()
+    clients = []
+    for index in xrange(client_count):
+        client = BenchClient('bench{0}_{1}'.format(worker_id, index), options, address, report)
+        try:
+            client.connect()
+            clients.append(client)
+        except ConnectionBroken:
+            report.count_error()
+    conn.send(len(clients))
+
+    deadline = conn.recv()
+    workload = globals()[options.workload]
+
+    def drive(client, leader):
+        try:
+            workload(client, options, deadline, report, leader)
+        except ConnectionBroken:
+            report.count_error()
+
+    threads = [threading.Thread(target=drive, args=(client, worker_id == 0 and index == 0))
+               for index, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Whatever is still on its way gets a moment to arrive
+    time.sleep(options.drain)
+    conn.send(report.as_dict())
+    for client in clients:
+        client.disconnect()
+    conn.close()
+
+
+def _raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _run_server(options, conn):
+    _raise_file_limit()
+    if options.server_workers > 1:
+        make_chat_server = lambda *args: ChatCluster(options.server_workers, *args)
+    else:
+        make_chat_server = ChatServer
+    chat_server = make_chat_server(
+        logging.getLogger('p2paste.benchmarks.load.server'),
+        settings.SERVER_IDENTIFIER,
+        settings.SERVER_WELCOME_MESSAGE,
+        options.paste_time,
+        settings.SERVER_TIMEOUT,
+        options.ssl_version,
+        options.certificate,
+        options.key,
+        settings.OUTBOUND_BUFFER_SIZE,
+        settings.COMPRESSION_THRESHOLD
+    )
+    conn.send(chat_server.host(options.port))
+
+    started = resource.getrusage(resource.RUSAGE_SELF)
+    conn.recv()
+    metrics = chat_server.server.metrics.snapshot() if options.server_workers == 1 else None
+    # Server worker processes are only accounted for once they have exited
+    chat_server.close_server()
+    finished = resource.getrusage(resource.RUSAGE_SELF)
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN)
+    conn.send(dict(
+        cpu_user=finished.ru_utime - started.ru_utime + workers.ru_utime,
+        cpu_system=finished.ru_stime - started.ru_stime + workers.ru_stime,
+        max_rss_kb=max(finished.ru_maxrss, workers.ru_maxrss),
+        metrics=metrics
+    ))
+    conn.close()
+
+
+def run(options):
+    server_conn, server_side = multiprocessing.Pipe()
+    server_process = multiprocessing.Process(target=_run_server, args=(options, server_side))
+    server_process.start()
+    address = server_conn.recv()
+
+    workers = []
+    for worker_id, first in enumerate(xrange(0, options.clients, options.clients_per_worker)):
+        conn, worker_side = multiprocessing.Pipe()
+        client_count = min(options.clients_per_worker, options.clients - first)
+        process = multiprocessing.Process(
+            target=_run_worker, args=(worker_id, client_count, options, address, worker_side))
+        process.start()
+        workers.append((process, conn))
+
+    connected = sum(conn.recv() for _process, conn in workers)
+    started = time.time()
+    deadline = started + options.duration
+    for _process, conn in workers:
+        conn.send(deadline)
+    reports = [conn.recv() for _process, conn in workers]
+    for process, _conn in workers:
+        process.join()
+
+    server_conn.send('stop')
+    server = server_conn.recv()
+    server_process.join()
+
+    elapsed = options.duration + options.drain
+    server['cpu_percent'] = 100.0 * (server['cpu_user'] + server['cpu_system']) / elapsed
+    sent = sum(report['sent'] for report in reports)
+    delivered = sum(report['delivered'] for report in reports)
+    return dict(
+        workload=options.workload,
+        started=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+        options=dict(clients=options.clients, server_workers=options.server_workers, clients_per_worker=options.clients_per_worker,
+                     duration=options.duration, rate=options.rate, paste_size=options.paste_size,
+                     interval=options.interval),
+        connected=connected,
+        errors=sum(report['errors'] for report in reports),
+        sent=sent,
+        delivered=delivered,
+        sent_per_second=sent / float(options.duration),
+        delivered_per_second=delivered / float(options.duration),
+        latency=summarize(sum((report['latencies'] for report in reports), [])),
+        # Paste permission waits, or the connect-to-welcome time of the churn workload
+        wait=summarize(sum((report['waits'] for report in reports), [])),
+        server=server
+    )
+
+
+def parse_options(argv):
+    parser = argparse.ArgumentParser(description='Drives a ChatServer with many headless ChatClients.')
+    parser.add_argument('--workload', choices=WORKLOADS, default='chat_storm')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--clients-per-worker', type=int, default=50,
+                        help='clients sharing a worker process')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds the workload runs')
+    parser.add_argument('--drain', type=float, default=2.0, help='seconds allowed for deliveries in flight')
+    parser.add_argument('--rate', type=float, default=1.0, help='chat messages per second and client')
+    parser.add_argument('--paste-size', type=int, default=256 * 1024, help='characters per paste')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between pastes or reconnects')
+    parser.add_argument('--paste-time', type=float, default=settings.ALLOWED_PASTE_TIME)
+    parser.add_argument('--port', type=int, default=0, help='server port, a free one by default')
+    parser.add_argument('--server-workers', type=int, default=1,
+                        help='server processes sharing the port, see p2paste.cluster')
+    parser.add_argument('--certificate', default=settings.CERTIFICATE_PATH)
+    parser.add_argument('--key', default=settings.KEY_PATH)
+    parser.add_argument('--ssl-version', default=None,
+                        help='ssl module protocol name, e.g. PROTOCOL_SSLv23, the settings one by default')
+    parser.add_argument('--output', default='-', help='JSON report path, - for stdout')
+    options = parser.parse_args(argv)
+    options.ssl_version = getattr(ssl, options.ssl_version) if options.ssl_version else settings.SSL_VERSION
+    return options
+
+
+def main(argv=None):
+    options = parse_options(argv)
+    logging.getLogger('p2paste.benchmarks.load').addHandler(logging.NullHandler())
+    result = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output == '-':
+        print(result)
+    else:
+        with open(options.output, 'w') as output:
+            output.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
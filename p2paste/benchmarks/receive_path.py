@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+'''
+Receive throughput of the former string concatenating reader against FrameReader
+
+    python -m p2paste.benchmarks.receive_path
+'''
+
+from network.base import FrameReader, HEADER_SIZE, pack_header, unpack_header
+import threading
+import socket
+import time
+
+
+TLS_RECORD_SIZE = 16 * 1024
+SEND_BATCH_SIZE = 1024 * 1024
+
+WORKLOADS = (
+    ('1 KB', 1024, 20000),
+    ('1 MB', 1024 * 1024, 100),
+    ('50 MB', 50 * 1024 * 1024, 3),
+)
+
+
+class RecordSocket(object):
+    '''Hands out at most one TLS record per read, like the SSL socket the readers normally get'''
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def read(self, size):
+        return self.sock.recv(min(size, TLS_RECORD_SIZE))
+
+    def recv_into(self, buffer, size):
+        return self.sock.recv_into(buffer, min(size, TLS_RECORD_SIZE))
+
+    def pending(self):
+        return 0
+
+
+def concatenating_reader(sock, count):
+    '''The loop nb_receive used to run for every frame'''
+    for _index in xrange(count):
+        size = unpack_header(sock.read(HEADER_SIZE))
+        in_data = ''
+        while len(in_data) < size:
+            in_data += sock.read(size - len(in_data))
+
+
+def buffered_reader(sock, count):
+    reader = FrameReader()
+    received = 0
+    while received < count:
+        reader.receive_into(sock)
+        received += len(reader.frames())
+
+
+def _write_frames(sock, payload_size, count):
+    frame = pack_header(payload_size) + 'x' * payload_size
+    batch = max(1, SEND_BATCH_SIZE // len(frame))
+    sent = 0
+    while sent < count:
+        frames = min(batch, count - sent)
+        sock.sendall(frame * frames)
+        sent += frames
+
+
+def measure(reader, payload_size, count, repeat=3):
+    best = None
+    for _run in xrange(repeat):
+        receiving, sending = socket.socketpair()
+        writer = threading.Thread(target=_write_frames, args=(sending, payload_size, count))
+        writer.start()
+        started = time.time()
+        reader(RecordSocket(receiving), count)
+        elapsed = time.time() - started
+        writer.join()
+        receiving.close()
+        sending.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return payload_size * count / best / 1e6
+
+
+def main():
+    row = '{0:<8} {1:>8} {2:>16} {3:>16}'
+    print(row.format('frame', 'frames', 'before MB/s', 'after MB/s'))
+    for name, payload_size, count in WORKLOADS:
+        before = measure(concatenating_reader, payload_size, count)
+        after = measure(buffered_reader, payload_size, count)
+        print(row.format(name, count, '{0:.1f}'.format(before), '{0:.1f}'.format(after)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+'''
+Compares the wire codecs: encode/decode throughput and bytes on the wire
+
+    python -m p2paste.benchmarks.wire_codec
+'''
+
+from network.codec import JSON_CODEC, BINARY_CODEC
+from p2paste.packager import (PKG_MESSAGE, PKG_PASTE, PKG_CLIENT_LIST,
+                              PKG_PASTE_REQUEST, PKG_PASTE_GRANTED)
+import timeit
+
+
+SAMPLE_SOURCE = u'''def handler(self, event):
+    """Docstring with "quotes", tabs\tand a backslash \\\\ in it"""
+    return {'value': event.value * 2, 'name': u'p\\u00e9r'}
+'''
+
+WORKLOADS = (
+    ('paste request', dict(type=PKG_PASTE_REQUEST, data=None)),
+    ('paste granted', dict(type=PKG_PASTE_GRANTED, sender=u'Server', data=None)),
+    ('client list', dict(type=PKG_CLIENT_LIST, sender=u'Server', data=[u'user{0}'.format(i) for i in range(50)])),
+    ('chat message', dict(type=PKG_MESSAGE, sender=u'alice', data=u'did you see the new build?')),
+    ('paste 100 KB', dict(type=PKG_PASTE, sender=u'alice', data=SAMPLE_SOURCE * (100 * 1024 // len(SAMPLE_SOURCE)))),
+    ('paste 1 MB', dict(type=PKG_PASTE, sender=u'alice', data=SAMPLE_SOURCE * (1024 * 1024 // len(SAMPLE_SOURCE)))),
+)
+
+
+def measure(codec, package, repeat=5):
+    payload = codec.encode(package)
+    assert codec.decode(payload) == package
+    number = max(1, 200000 // max(1, len(payload) // 64))
+    encode = min(timeit.repeat(lambda: codec.encode(package), number=number, repeat=repeat)) / number
+    decode = min(timeit.repeat(lambda: codec.decode(payload), number=number, repeat=repeat)) / number
+    return len(payload), encode, decode
+
+
+def main():
+    row = '{0:<14} {1:<7} {2:>10} {3:>12} {4:>12} {5:>12}'
+    print(row.format('package', 'codec', 'bytes', 'encode us', 'decode us', 'decode MB/s'))
+    for name, package in WORKLOADS:
+        for codec in (JSON_CODEC, BINARY_CODEC):
+            size, encode, decode = measure(codec, package)
+            print(row.format(name, codec.name, size, '{0:.2f}'.format(encode * 1e6),
+                             '{0:.2f}'.format(decode * 1e6), '{0:.1f}'.format(size / decode / 1e6)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+'''
+Versioned blackboard, and the deltas sent between two of its versions
+
+A delta is a list of [start, end, text] changes, each replacing the characters
+between start and end of the base version with text. Changes are sorted and
+don't overlap.
+
+Pastes of at least MIN_DEDUP_SIZE characters are also known by a hash of their
+content, and kept in a PasteCache by both ends, so a paste one end already has
+is sent as its hash only.
+'''
+
+from collections import OrderedDict
+from difflib import SequenceMatcher
+import threading
+import hashlib
+
+
+# Smaller pastes are always sent whole, a hash and a possible fetch aren't worth it
+MIN_DEDUP_SIZE = 4 * 1024
+# Characters of paste bodies cached by the server, and by every client
+SERVER_PASTE_CACHE_SIZE = 64 * 1024 * 1024
+CLIENT_PASTE_CACHE_SIZE = 16 * 1024 * 1024
+# Most pairs of changed lines diffed, the matcher is quadratic in the worst case and runs
+# on the GUI thread. Edits spread over more lines are sent whole.
+MAX_DIFF_PAIRS = 500 * 500
+
+
+class StaleVersion(Exception):
+    pass
+
+
+def _common_affix(old, new):
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and old[-suffix - 1] == new[-suffix - 1]:
+        suffix += 1
+    return prefix, suffix
+
+
+def make_changes(old_text, new_text):
+    '''
+    Line based diff of the two texts, narrowed down to characters inside the changed lines.
+    None when the changed lines are too many to diff.
+    '''
+    old_lines = old_text.splitlines(True)
+    new_lines = new_text.splitlines(True)
+    # Unchanged lines around the edit are cut off first, so repeated lines elsewhere
+    # in a large document can't throw the matcher off
+    head, tail = _common_affix(old_lines, new_lines)
+    old_middle = old_lines[head:len(old_lines) - tail]
+    new_middle = new_lines[head:len(new_lines) - tail]
+    if len(old_middle) * len(new_middle) > MAX_DIFF_PAIRS:
+        return None
+
+    old_offsets = [sum(len(line) for line in old_lines[:head])]
+    for line in old_middle:
+        old_offsets.append(old_offsets[-1] + len(line))
+
+    changes = []
+    matcher = SequenceMatcher(None, old_middle, new_middle, autojunk=False)
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        old_chunk = old_text[old_offsets[old_start]:old_offsets[old_end]]
+        new_chunk = u''.join(new_middle[new_start:new_end])
+        prefix, suffix = _common_affix(old_chunk, new_chunk)
+        start = old_offsets[old_start] + prefix
+        end = old_offsets[old_end] - suffix
+        changes.append([start, end, new_chunk[prefix:len(new_chunk) - suffix]])
+    return changes
+
+
+def apply_changes(text, changes):
+    parts = []
+    position = 0
+    for start, end, replacement in changes:
+        if not position <= start <= end <= len(text):
+            raise ValueError('Change {0}:{1} is out of order or out of range.'.format(start, end))
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return u''.join(parts)
+
+
+def changes_size(changes):
+    return sum(len(replacement) for _start, _end, replacement in changes) + 16 * len(changes)
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class PasteCache(object):
+    '''Least recently used paste bodies by content hash, bounded by their total length'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, paste_hash):
+        with self.lock:
+            text = self.bodies.pop(paste_hash, None)
+            if text is not None:
+                self.bodies[paste_hash] = text
+            return text
+
+    def put(self, paste_hash, text):
+        if len(text) > self.capacity:
+            return
+        with self.lock:
+            replaced = self.bodies.pop(paste_hash, None)
+            if replaced is not None:
+                self.size -= len(replaced)
+            self.bodies[paste_hash] = text
+            self.size += len(text)
+            while self.size > self.capacity:
+                _paste_hash, evicted = self.bodies.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class Blackboard(object):
+
+    def __init__(self):
+        self.text = u''
+        self.version = 0
+        self._hashed_text = None
+        self._content_hash = None
+
+    @property
+    def content_hash(self):
+        '''Hash of the text, computed once per text'''
+        if self._hashed_text is not self.text:
+            self._content_hash = content_hash(self.text)
+            self._hashed_text = self.text
+        return self._content_hash
+
+    def load(self, text, version):
+        self.text = text
+        self.version = version
+
+    def replace(self, text):
+        self.text = text
+        self.version += 1
+        return self.version
+
+    def apply(self, base_version, changes):
+        if base_version != self.version:
+            raise StaleVersion
+        self.text = apply_changes(self.text, changes)
+        self.version += 1
+        return self.version
+
+    def delta_to(self, new_text):
+        '''Changes turning the current text into new_text, None when sending it whole is cheaper'''
+        if not self.version:
+            return None
+        changes = make_changes(self.text, new_text)
+        if changes is None or changes_size(changes) * 2 > len(new_text):
+            return None
+        return changes
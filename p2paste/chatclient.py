@@ -4,76 +4,527 @@ p2paste chat client
 '''
 
 from p2paste.network.client import Client, EventHandler, ConnectionBroken
+from p2paste.network.traffic import PackageSummary
 from p2paste.packager import (DataPackager, PackageVerificationFailed, PKG_MESSAGE, 
-                              PKG_PASTE, PKG_CLIENT_LIST, PKG_PASTE_GRANTED, PKG_PASTE_NOTIFICATION)
+                              PKG_PASTE, PKG_CLIENT_LIST, PKG_PASTE_GRANTED, PKG_PASTE_NOTIFICATION,
+                              PKG_PASTE_DELTA, PKG_PASTE_ACCEPTED, PKG_PASTE_REJECTED, PKG_PASTE_CHUNK,
+                              PKG_PASTE_ABORT, PKG_ADMIN_METRICS, SUPPORTED_FEATURES, FEATURE_PASTE_CHUNKS,
+                              PKG_HISTORY, PKG_HISTORY_PASTE, PKG_PASTE_REF, PKG_PASTE_FETCH, FEATURE_ROOMS,
+                              FEATURE_PASTE_HASH, FEATURE_PASTE_LEASES, PKG_PASTE_RENEW, FEATURE_RESUME,
+                              PKG_CLIENT_LIST_DELTA, DEFAULT_ROOM)
+from p2paste.blackboard import (Blackboard, StaleVersion, PasteCache, content_hash, MIN_DEDUP_SIZE,
+                                CLIENT_PASTE_CACHE_SIZE)
+from collections import OrderedDict
+import threading
+import random
+import uuid
+
+
+# Seconds before the first reconnect attempt, doubled after every failed one up to the maximum
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
 
 
 class ChatClient(object):
 
-    message_handler = EventHandler()
-    paste_handler = EventHandler()
-    client_list_handler = EventHandler()
-    paste_granted_handler = EventHandler()
-    paste_notification_handler = EventHandler()
-    
-    def __init__(self, logger, *args):
+    def __init__(self, logger, paste_chunk_size, *args):
         self.logger = logger
+        # Handlers belong to the instance, so several clients can live in one process
+        self.message_handler = EventHandler()
+        self.paste_handler = EventHandler()
+        # Gets the changes, and the whole text they make, for a pastebox that no longer shows their base
+        self.paste_delta_handler = EventHandler()
+        self.paste_progress_handler = EventHandler()
+        self.paste_abort_handler = EventHandler()
+        # Gets the whole client list as (member id, nickname) pairs, the delta handler who joined and left since
+        self.client_list_handler = EventHandler()
+        self.client_list_delta_handler = EventHandler()
+        self.paste_granted_handler = EventHandler()
+        self.paste_renewed_handler = EventHandler()
+        self.paste_notification_handler = EventHandler()
+        self.metrics_handler = EventHandler()
+        self.room_handler = EventHandler()
+        self.history_handler = EventHandler()
+        self.history_paste_handler = EventHandler()
+        # Called with False when the connection is lost, and True once it's back
+        self.connection_handler = EventHandler()
+        self.paste_chunk_size = paste_chunk_size
         self.client = Client(logger, *args)
         self.client.data_handler.bind(self.identify_package)
+        self.client.connection_lost_handler.bind(self._connection_lost)
         self.packager = DataPackager(logger)
+        self.nickname = None
+        self.address = None
+        self.server_features = []
+        # Epoch of the server's sequence numbers, to resume with after a reconnect
+        self.server_epoch = None
+        self.reconnect_stopped = threading.Event()
+        self.reconnect_stopped.set()
+        self.reconnect_thread = None
+        # Outlives the connection, a reconnecting client gets most pastes back from it
+        self.paste_cache = PasteCache(CLIENT_PASTE_CACHE_SIZE)
+        self._reset_rooms()
+        self.outgoing_paste_id = None
+        self.outgoing_paste_cancelled = threading.Event()
     
     @property
     def connected(self):
         return self.client.connected.is_set()
+
+    @property
+    def blackboard(self):
+        '''Blackboard of the room shown to the user'''
+        return self.blackboards[self.room]
+
+    def _reset_rooms(self):
+        # Every joined room has a blackboard, the handlers only hear about the active room
+        self.room = DEFAULT_ROOM
+        self.blackboards = {DEFAULT_ROOM: Blackboard()}
+        # Room -> OrderedDict of member id -> nickname, in the order the members were listed
+        self.client_lists = dict()
+        # Room -> sequence number of the last room-wide broadcast received
+        self.sequences = dict()
+        self.incoming_pastes = dict()
+        # Room -> (hash, sender, version) of the paste being fetched, after a cache miss
+        self.fetching_pastes = dict()
+        # The room the paste permission was granted in, pastes go there whichever room is shown
+        self.paste_room = DEFAULT_ROOM
+        # Granted and not pasted yet
+        self.paste_permitted = False
+        self.pending_paste = None
     
     def connect(self, address, nickname):
+        self._stop_reconnecting()
+        if self.connected:
+            self.client.disconnect()
         self.client.connect(address)
-            
+        self.address = address
+        self.nickname = nickname
+        self.server_features = []
+        self.server_epoch = None
+        self._reset_rooms()
+        self._identify()
+
+    def _identify(self, resume=None):
         try:
-            id_package = self.packager.make_id_package(nickname)
+            id_package = self.packager.make_id_package(
+                self.nickname, self.client.supported_codecs, self.client.supported_compressions, SUPPORTED_FEATURES,
+                resume)
             self.client.send(id_package)
-            self.logger.debug('Sent identification: {0}'.format(str(id_package)))
+            self.logger.debug('Sent identification as {0}.'.format(self.nickname))
         except ConnectionBroken:
             self.client.disconnect()
             self.logger.info('Server rejected client identification.')
             raise
-    
+
+    def _resume_state(self):
+        '''What the server needs to replay the broadcasts of the joined rooms missed while away'''
+        if FEATURE_RESUME not in self.server_features or self.server_epoch is None:
+            return None
+        return self.server_epoch, dict((room, (self.sequences.get(room, 0), blackboard.version))
+                                       for room, blackboard in self.blackboards.items())
+
+    def _connection_lost(self):
+        # Whatever was on its way is gone, the server aborted it for the others
+        self.outgoing_paste_cancelled.set()
+        self.incoming_pastes = dict()
+        self.fetching_pastes = dict()
+        self.paste_permitted = False
+        self.pending_paste = None
+        self.connection_handler(False)
+
+        self.reconnect_stopped.clear()
+        self.reconnect_thread = threading.Thread(target=self._reconnect)
+        self.reconnect_thread.daemon = True
+        self.reconnect_thread.start()
+
+    def _reconnect(self):
+        '''Reconnects with a growing, jittered delay until it succeeds or disconnect is called'''
+        delay = RECONNECT_MIN_DELAY
+        while not self.reconnect_stopped.wait(delay * random.uniform(0.5, 1.0)):
+            resume = self._resume_state()
+            try:
+                self.client.connect(self.address)
+                if resume is None:
+                    # Without resume the server starts over, and so do the rooms here
+                    self.server_features = []
+                    self._reset_rooms()
+                self._identify(resume)
+            except ConnectionBroken:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                self.logger.info('Reconnecting failed, next attempt in {0:.1f}s.'.format(delay))
+                continue
+            if self.reconnect_stopped.is_set():
+                # Disconnected by the user while connecting
+                self.client.disconnect()
+                return
+
+            self.logger.info('Reconnected to {0}:{1}.'.format(self.address[0], self.address[1]))
+            self.connection_handler(True)
+            if resume is None:
+                self.switch_room(DEFAULT_ROOM)
+            return
+
+    def _stop_reconnecting(self):
+        self.reconnect_stopped.set()
+        reconnect_thread = self.reconnect_thread
+        if reconnect_thread is not None and reconnect_thread is not threading.current_thread():
+            reconnect_thread.join()
+        self.reconnect_thread = None
+
     def disconnect(self):
+        # A reconnect attempt in progress is given up on, not waited for
+        self.reconnect_stopped.set()
+        self.outgoing_paste_cancelled.set()
         self.client.disconnect()
 
+    def _remember(self, blackboard):
+        if len(blackboard.text) >= MIN_DEDUP_SIZE:
+            self.paste_cache.put(blackboard.content_hash, blackboard.text)
+
+    def _paste_received(self, room, package_sender, package_data, version):
+        self.blackboards[room].load(package_data, version)
+        self.fetching_pastes.pop(room, None)
+        self._remember(self.blackboards[room])
+        if room == self.room:
+            self.paste_handler(package_sender, package_data)
+
+    def _paste_delta_received(self, room, package_sender, package_data, version):
+        blackboard = self.blackboards[room]
+        try:
+            base_version, changes = self.packager.unpack_paste_delta(package_data)
+            blackboard.apply(base_version, changes)
+        except (PackageVerificationFailed, StaleVersion, ValueError):
+            self.logger.info('Paste delta does not apply to blackboard version {0} of {1}, requesting a snapshot.'.format(
+                blackboard.version, room))
+            self.send_package(self.packager.make_paste_snapshot_request_package(), room)
+            return
+
+        blackboard.version = version
+        self._remember(blackboard)
+        if room == self.room:
+            self.paste_delta_handler(package_sender, changes, blackboard.text)
+
+    def _paste_ref_received(self, room, package_sender, package_data, version):
+        paste_hash, _size = self.packager.unpack_paste_ref(package_data)
+        paste_data = self.paste_cache.get(paste_hash)
+        if paste_data is not None:
+            self._paste_received(room, package_sender, paste_data, version)
+            return
+        self.fetching_pastes[room] = (paste_hash, package_sender, version)
+        self.send_package(self.packager.make_paste_fetch_request_package(paste_hash), room)
+
+    def _paste_fetched(self, room, package_data):
+        paste_hash, paste_data = self.packager.unpack_paste_fetch(package_data)
+        fetching = self.fetching_pastes.get(room)
+        if fetching is None or fetching[0] != paste_hash:
+            return
+        if paste_data is None:
+            # Already replaced on the server, the newer version is on its way
+            self.logger.info('Paste {0} is no longer on the server.'.format(paste_hash))
+            del self.fetching_pastes[room]
+            return
+        _paste_hash, package_sender, version = fetching
+        self._paste_received(room, package_sender, paste_data, version)
+
+    def _paste_chunk_received(self, room, package_sender, package_data, version):
+        paste_id, index, total_size, chunk, final = self.packager.unpack_paste_chunk(package_data)
+        if index == 0:
+            self.incoming_pastes[room] = dict(paste_id=paste_id, parts=[], received=0)
+        stream = self.incoming_pastes.get(room)
+        if stream is None or stream['paste_id'] != paste_id or len(stream['parts']) != index:
+            # Joined in the middle of a stream, the whole paste is fetched once it's complete
+            self.incoming_pastes.pop(room, None)
+            if final:
+                self.send_package(self.packager.make_paste_snapshot_request_package(), room)
+            return
+
+        stream['parts'].append(chunk)
+        stream['received'] += len(chunk)
+        if room == self.room:
+            self.paste_progress_handler(package_sender, stream['received'], total_size)
+        if final:
+            del self.incoming_pastes[room]
+            self._paste_received(room, package_sender, u''.join(stream['parts']), version)
+
+    def _paste_aborted(self, room, package_sender, paste_id):
+        if paste_id == self.outgoing_paste_id:
+            # The server gave up on our stream as the permission ran out, the stream thread reports it
+            self.outgoing_paste_cancelled.set()
+            self.pending_paste = None
+            return
+        stream = self.incoming_pastes.get(room)
+        if stream is None or stream['paste_id'] != paste_id:
+            return
+        del self.incoming_pastes[room]
+        if room == self.room:
+            self.paste_abort_handler(package_sender, paste_id)
+
+    def _paste_accepted(self, room, version):
+        if self.pending_paste is not None:
+            self.blackboards[room].load(self.pending_paste, version)
+            self._remember(self.blackboards[room])
+            self.pending_paste = None
+
+    def _paste_rejected(self, room):
+        if self.pending_paste is not None:
+            self.logger.info('Paste delta rejected, sending the whole paste.')
+            self.send_package(self.packager.make_paste_package(self.pending_paste), room)
+
+    def _message_received(self, room, package_sender, message):
+        # Chat of the other joined rooms still shows up, marked with its room
+        if room != self.room:
+            package_sender = '{0}@{1}'.format(package_sender, room)
+        self.message_handler(package_sender, message)
+
+    def _client_list_received(self, room, package_sender, client_list):
+        # Servers without deltas only send nicknames, their place in the list stands in for an id
+        self._client_list_replaced(room, package_sender, [(str(index), nickname)
+                                                          for index, nickname in enumerate(client_list)])
+
+    def _client_list_replaced(self, room, package_sender, members):
+        self.client_lists[room] = OrderedDict(members)
+        if room == self.room:
+            self.client_list_handler(package_sender, members)
+
+    def _client_list_delta_received(self, room, package_sender, package_data):
+        joined, left, full = self.packager.unpack_client_list_delta(package_data)
+        if full:
+            self._client_list_replaced(room, package_sender, joined)
+            return
+        # Deltas may repeat what a full list already showed, they only apply what's new
+        client_list = self.client_lists.setdefault(room, OrderedDict())
+        left = [member_id for member_id in left if client_list.pop(member_id, None) is not None]
+        joined = [(member_id, nickname) for member_id, nickname in joined if member_id not in client_list]
+        client_list.update(joined)
+        if room == self.room and (joined or left):
+            self.client_list_delta_handler(package_sender, joined, left)
+
+    def _paste_granted(self, room, package_sender, package_data):
+        # The permission is for the room it was requested in, which is shown again if the user moved on
+        self.paste_room = room
+        self.paste_permitted = True
+        if room != self.room:
+            self.switch_room(room)
+        self.paste_granted_handler(package_sender, package_data)
+
+    def _paste_renewed(self, room, package_sender, renewed):
+        if not renewed:
+            self.logger.info('Paste permission renewal in {0} refused.'.format(room))
+        self.paste_renewed_handler(package_sender, renewed)
+
+    def _paste_notification_received(self, room, package_sender, nickname):
+        if room == self.room:
+            self.paste_notification_handler(package_sender, nickname)
+
     def identify_package(self, package):
         package_handlers = {
-            PKG_MESSAGE: self.message_handler,
-            PKG_PASTE: self.paste_handler,
-            PKG_CLIENT_LIST: self.client_list_handler,
-            PKG_PASTE_GRANTED: self.paste_granted_handler,
-            PKG_PASTE_NOTIFICATION: self.paste_notification_handler
+            PKG_MESSAGE: self._message_received,
+            PKG_CLIENT_LIST: self._client_list_received,
+            PKG_CLIENT_LIST_DELTA: self._client_list_delta_received,
+            PKG_PASTE_GRANTED: self._paste_granted,
+            PKG_PASTE_RENEW: self._paste_renewed,
+            PKG_PASTE_NOTIFICATION: self._paste_notification_received,
+            PKG_HISTORY: self.history_handler,
+            PKG_HISTORY_PASTE: self.history_paste_handler
         }
+        codec_name = self.packager.get_negotiated_codec(package)
+        if codec_name:
+            self.client.set_codec(codec_name)
+        compression_name = self.packager.get_negotiated_compression(package)
+        if compression_name:
+            self.client.set_compression(compression_name)
+        features = self.packager.get_negotiated_features(package)
+        if features is not None:
+            self.server_features = features
+        epoch = self.packager.get_package_epoch(package)
+        if epoch is not None:
+            self.server_epoch = epoch
+
         try:
             package_type, package_sender, package_data = self.packager.process_package(package)
-            self.logger.debug('Package processed as: {0} from {1} - {2}'.format(package_type, package_sender, str(package_data)))
-            handler = package_handlers[package_type]
-            handler(package_sender, package_data)
-            self.logger.info('Package handled successfully.')
-        except PackageVerificationFailed:
-            self.logger.error('Package verification failed: {0}'.format(str(package)))
+            version = self.packager.get_package_version(package)
+            room = self.packager.get_package_room(package)
+            sequence = self.packager.get_package_sequence(package)
+            if sequence is not None and room in self.blackboards:
+                self.sequences[room] = max(sequence, self.sequences.get(room, 0))
+            if package_type == PKG_ADMIN_METRICS:
+                self.metrics_handler(package_sender, package_data)
+            elif room not in self.blackboards:
+                # Sent before the server got our leave package
+                self.logger.debug('Package of the left room {0} ignored.'.format(room))
+            elif package_type == PKG_PASTE:
+                self._paste_received(room, package_sender, package_data, version)
+            elif package_type == PKG_PASTE_DELTA:
+                self._paste_delta_received(room, package_sender, package_data, version)
+            elif package_type == PKG_PASTE_CHUNK:
+                self._paste_chunk_received(room, package_sender, package_data, version)
+            elif package_type == PKG_PASTE_REF:
+                self._paste_ref_received(room, package_sender, package_data, version)
+            elif package_type == PKG_PASTE_FETCH:
+                self._paste_fetched(room, package_data)
+            elif package_type == PKG_PASTE_ABORT:
+                self._paste_aborted(room, package_sender, package_data)
+            elif package_type == PKG_PASTE_ACCEPTED:
+                self._paste_accepted(room, package_data)
+            elif package_type == PKG_PASTE_REJECTED:
+                self._paste_rejected(room)
+            elif package_type in (PKG_HISTORY, PKG_HISTORY_PASTE):
+                # Answers belong to the room they were asked in, whichever room is shown by now
+                package_handlers[package_type](room, package_data)
+            else:
+                handler = package_handlers[package_type]
+                handler(room, package_sender, package_data)
+        except (PackageVerificationFailed, KeyError):
+            self.logger.error('Package verification failed: %s', PackageSummary(package))
+        except ConnectionBroken:
+            self.logger.error('Answering package failed, connection broken.')
                 
-    def send_package(self, package):
+    def send_package(self, package, room=None):
         if not self.connected:
             raise ConnectionBroken
-            
+
+        # Servers without rooms put everyone in the default room
+        if room is not None and room != DEFAULT_ROOM:
+            package = self.packager.add_room_to_package(package, room)
         self.client.send(package)
-        self.logger.debug('Package sent to {0} with: {1}'.format(self.client().getpeername(), str(package)))
         
     def send_message(self, message):    
         package = self.packager.make_message_package(message)
-        self.send_package(package)
+        self.send_package(package, self.room)
+
+    def join_room(self, room_name):
+        '''Joins the room and shows it, False if the server has no rooms or the name is invalid'''
+        if FEATURE_ROOMS not in self.server_features:
+            return False
+        try:
+            room_name = self.packager.verify_room_name(room_name)
+        except PackageVerificationFailed:
+            return False
+
+        if room_name not in self.blackboards:
+            self.send_package(self.packager.make_room_join_package(room_name))
+            self.blackboards[room_name] = Blackboard()
+        self.switch_room(room_name)
+        return True
+
+    def leave_room(self, room_name):
+        '''Leaves a joined room, the default room is never left. False if not in the room.'''
+        if room_name == DEFAULT_ROOM or room_name not in self.blackboards:
+            return False
+
+        self.send_package(self.packager.make_room_leave_package(room_name))
+        del self.blackboards[room_name]
+        self.client_lists.pop(room_name, None)
+        self.sequences.pop(room_name, None)
+        self.incoming_pastes.pop(room_name, None)
+        if room_name == self.room:
+            self.switch_room(DEFAULT_ROOM)
+        return True
+
+    def switch_room(self, room_name):
+        '''Shows a joined room, the handlers get its blackboard and client list right away'''
+        self.room = room_name
+        self.room_handler(room_name, sorted(self.blackboards))
+        self.paste_handler(room_name, self.blackboard.text)
+        if room_name in self.client_lists:
+            self.client_list_handler(room_name, self.client_lists[room_name].items())
     
+    def _stream_paste(self, paste_id, paste_data):
+        total_size = len(paste_data)
+        try:
+            for index, offset in enumerate(xrange(0, total_size, self.paste_chunk_size)):
+                if self.outgoing_paste_cancelled.is_set():
+                    self.logger.info('Paste stream {0} cancelled after {1} of {2} characters.'.format(
+                        paste_id, offset, total_size))
+                    self.pending_paste = None
+                    if self.connected:
+                        self.send_package(self.packager.make_paste_abort_package(paste_id), self.paste_room)
+                    self.paste_abort_handler(self.nickname, paste_id)
+                    return
+
+                end = min(offset + self.paste_chunk_size, total_size)
+                package = self.packager.make_paste_chunk_package(
+                    paste_id, index, total_size, paste_data[offset:end], end == total_size)
+                self.send_package(package, self.paste_room)
+                if self.paste_room == self.room:
+                    self.paste_progress_handler(self.nickname, end, total_size)
+        except ConnectionBroken:
+            self.logger.error('Paste stream {0} interrupted, connection broken.'.format(paste_id))
+        finally:
+            self.outgoing_paste_id = None
+
     def send_paste(self, paste_data):
-        package = self.packager.make_paste_package(paste_data)
-        self.send_package(package)
+        if not self.connected:
+            raise ConnectionBroken
+
+        room = self.paste_room
+        if room not in self.blackboards:
+            self.logger.info('Paste permission of the left room {0} dropped.'.format(room))
+            return
+
+        self.pending_paste = paste_data
+        self.paste_permitted = False
+        # Small edits of a large blackboard only carry the changes, when the server keeps versions
+        blackboard = self.blackboards[room]
+        changes = blackboard.delta_to(paste_data)
+        paste_hash = None
+        if FEATURE_PASTE_HASH in self.server_features and len(paste_data) >= MIN_DEDUP_SIZE:
+            paste_hash = content_hash(paste_data)
+        if changes is not None:
+            self.send_package(self.packager.make_paste_delta_package(blackboard.version, changes), room)
+        elif paste_hash is not None and self.paste_cache.get(paste_hash) is not None:
+            # A paste seen before is most likely still cached by the server, which rejects it otherwise
+            self.send_package(self.packager.make_paste_ref_package(paste_hash, len(paste_data)), room)
+        elif len(paste_data) > self.paste_chunk_size and FEATURE_PASTE_CHUNKS in self.server_features:
+            # Large pastes go out chunk by chunk from their own thread, so chat keeps flowing
+            # and the sender can still cancel halfway
+            self.outgoing_paste_id = uuid.uuid4().hex
+            self.outgoing_paste_cancelled.clear()
+            stream_thread = threading.Thread(target=self._stream_paste, args=(self.outgoing_paste_id, paste_data))
+            stream_thread.daemon = True
+            stream_thread.start()
+        else:
+            self.send_package(self.packager.make_paste_package(paste_data), room)
+
+    def cancel_paste(self):
+        '''Stops the paste being streamed, returns False when there is nothing to cancel'''
+        if self.outgoing_paste_id is None:
+            return False
+        self.outgoing_paste_cancelled.set()
+        return True
+
+    def release_paste(self):
+        '''Gives an unused paste permission back, so the next one waiting gets it. False if none is held.'''
+        if not self.paste_permitted or FEATURE_PASTE_LEASES not in self.server_features:
+            return False
+        self.paste_permitted = False
+        self.send_package(self.packager.make_paste_release_package(), self.paste_room)
+        return True
+
+    def renew_paste(self):
+        '''Asks for more time to paste, answered through paste_renewed_handler. False if no permission is held.'''
+        if not self.paste_permitted or FEATURE_PASTE_LEASES not in self.server_features:
+            return False
+        self.send_package(self.packager.make_paste_renew_package(), self.paste_room)
+        return True
+
+    def request_metrics(self):
+        '''Asks the server for its metrics, answered through metrics_handler when connected locally'''
+        self.send_package(self.packager.make_admin_metrics_package())
+
+    def request_history(self, before=None, before_time=None, limit=None):
+        '''
+        Asks for a page of the shown room's history, older than the paste id before or the timestamp
+        before_time, newest first. Answered through history_handler with (room, entries).
+        '''
+        self.send_package(self.packager.make_history_request_package(before, before_time, limit), self.room)
+
+    def request_history_paste(self, paste_id=None):
+        '''Asks for a paste of the shown room's history, the latest by default, through history_paste_handler'''
+        self.send_package(self.packager.make_history_paste_request_package(paste_id), self.room)
 
     def send_paste_request(self):
         package = self.packager.make_paste_request_package()
-        self.send_package(package)
-        
\ No newline at end of file
+        self.send_package(package, self.room)
+        
@@ -4,167 +4,873 @@ p2paste chat server
 '''
 
 from p2paste.network.server import Server, ConnectionBroken
+from p2paste.network.traffic import PackageSummary
+from p2paste.network.metrics import MetricsEndpoint, WAIT_BUCKETS
 from p2paste.packager import (ClientIdentificationFailed, PackageVerificationFailed,
-                              DataPackager, PKG_PASTE_REQUEST, PKG_PASTE)
-from Queue import Queue, Empty as QueueEmpty
+                              DataPackager, PKG_PASTE_REQUEST, PKG_PASTE, PKG_PASTE_DELTA,
+                              PKG_PASTE_SNAPSHOT_REQUEST, PKG_PASTE_ACCEPTED, PKG_PASTE_REJECTED,
+                              PKG_PASTE_CHUNK, PKG_PASTE_ABORT, PKG_ADMIN_METRICS, PKG_ROOM_JOIN,
+                              PKG_ROOM_LEAVE, PKG_HISTORY, PKG_HISTORY_PASTE, PKG_PASTE_REF, PKG_PASTE_FETCH,
+                              PKG_PASTE_RELEASE, PKG_PASTE_RENEW, PKG_MESSAGE,
+                              FEATURE_PASTE_DELTA, FEATURE_PASTE_CHUNKS, FEATURE_HISTORY, FEATURE_PASTE_HASH,
+                              FEATURE_RESUME, FEATURE_CLIENT_LIST_DELTA,
+                              SUPPORTED_FEATURES, DEFAULT_ROOM)
+from p2paste.blackboard import StaleVersion, PasteCache, MIN_DEDUP_SIZE, SERVER_PASTE_CACHE_SIZE
+from p2paste.rooms import Room
+from p2paste.history import MAX_PAGE_SIZE
+from p2paste.leases import TimerWheel, PasteLeases, POLICY_FIFO
+import itertools
 import threading
+import socket
+import time
+import uuid
+
+
+# Seconds the joins and leaves of a room are gathered for, before its members hear of them
+CLIENT_LIST_WINDOW = 0.05
 
 
 class ChatServer(object):
-    
+
     def __init__(self, logger, identifier, welcome_message, max_paste_time, *args):
         self.logger = logger
         self.identifier = identifier
         self.welcome_message = welcome_message
         self.max_paste_time = max_paste_time
-        
+
         self.server = Server(logger, *args)
         self.server.connect_handler.bind(self.client_connected)
         self.server.disconnect_handler.bind(self.client_disconnected)
         self.server.data_handler.bind(self.identify_package)
-        
+
         self.packager = DataPackager(logger)
-        self.paste_requests = Queue()
-        self.paste_request_processor_running = threading.Event()
-        self.paste_request_received = threading.Event()
-        self.paste_received = threading.Event()
-        self.paste_permission_holder = None
+        # Room name -> Room, a room lives as long as it has members
+        self.rooms = dict()
+        self.rooms_lock = threading.Lock()
 
         self.client_list = dict()
-    
+        self.client_rooms = dict()
+        self.delta_clients = set()
+        self.chunk_clients = set()
+        self.hash_clients = set()
+        self.list_delta_clients = set()
+        # Client -> member id, the key of the client in the client lists. Ids are made of the
+        # epoch and a number, so they differ between the workers of a cluster.
+        self.member_ids = dict()
+        self.member_numbers = itertools.count(1)
+        # Clients being disconnected. A client may be found gone again while it leaves its
+        # rooms, the first one to claim it here takes it out of them.
+        self.leaving_clients = set()
+        self.leaving_lock = threading.Lock()
+        # Recent paste bodies, for the pastes and fetches that only name a content hash
+        self.paste_cache = PasteCache(SERVER_PASTE_CACHE_SIZE)
+        # Opened by host, when the server keeps a paste history
+        self.history = None
+        # Numbers the room-wide broadcasts. A reconnecting client names the epoch it saw them
+        # in, numbers from another server or an earlier run can't be replayed.
+        self.sequences = itertools.count(1)
+        self.epoch = uuid.uuid4().hex
+        # Runs the paste lease timers and the client list updates of every room. They change the
+        # rooms and may disconnect clients, so they fire on the listener thread like the packages.
+        self.timers = TimerWheel(logger, dispatch=self.server.call_on_listener)
+        self.paste_policy = POLICY_FIFO
+
+        metrics = self.server.metrics
+        metrics.callback('p2paste_paste_queue_depth', 'Clients waiting for the paste permission, by room', 'gauge',
+                         lambda: dict(((room.name,), len(room.leases) if room.leases is not None else 0)
+                                      for room in self.rooms.values()),
+                         ('room',))
+        self.paste_wait_seconds = metrics.histogram(
+            'p2paste_paste_permission_wait_seconds', 'Time from a paste request until it is granted', WAIT_BUCKETS)
+        self.pastes_published = metrics.counter(
+            'p2paste_pastes_published_total', 'Blackboard versions published, by how the paste was sent', ('kind',))
+        self.resumes = metrics.counter(
+            'p2paste_room_resumes_total', 'Rooms rejoined after a reconnect, by whether the missed broadcasts were '
+            'replayed or a snapshot was sent instead', ('result',))
+        self.paste_refs = metrics.counter(
+            'p2paste_paste_refs_total', 'Pastes sent or received as their content hash, and bodies fetched after a miss',
+            ('result',))
+        self.metrics_endpoint = MetricsEndpoint(logger, metrics.render)
+
     @property
     def running(self):
         return self.server.server_running.is_set()
-    
+
     def _get_client_address(self, client):
         return self.server.all_clients[client]
 
     def _get_client_nickname(self, client):
         return self.client_list[client]
 
-    def _get_client_list(self):
-        return filter(lambda x: x != self.identifier, self.client_list.values())
-    
-    def _broadcast_package(self, package, sender):
+    def _get_members(self, room):
+        '''Member id -> nickname of everyone in the room, on this server or another worker'''
+        members = dict(room.remote_members)
+        for client in list(room.members):
+            member_id, nickname = self.member_ids.get(client), self.client_list.get(client)
+            if member_id is not None and nickname is not None:
+                members[member_id] = nickname
+        return members
+
+    def _get_recipients(self, room, sender):
+        # A copy, sending to the recipients may disconnect some of them
+        return [client for client in list(room.members) if client is not sender]
+
+    def _open_room(self, room_name):
+        with self.rooms_lock:
+            room = self.rooms.get(room_name)
+            if room is None:
+                room = self.rooms[room_name] = Room(room_name, next(self.sequences))
+                self._restore_blackboard(room)
+                self._open_paste_leases(room)
+                self.logger.debug('Room {0} opened.'.format(room_name))
+            return room
+
+    def _close_room(self, room):
+        with self.rooms_lock:
+            if self.rooms.get(room.name) is room:
+                del self.rooms[room.name]
+        room.close()
+        # Closed, it records no more broadcasts
+        with room.broadcast_lock:
+            self.server.memory.held_resized(-room.forget_replay())
+        self.logger.debug('Room {0} closed.'.format(room.name))
+
+    def _restore_blackboard(self, room):
+        '''Loads the last paste of the room from the history, so a reopened room isn't blank'''
+        if self.history is None:
+            return
+        self.history.refresh()
+        entry = self.history.latest(room.name)
+        text = None if entry is None else self.history.read(entry)
+        if text is not None:
+            room.blackboard.load(text, entry.version)
+
+    def _room_emptied(self, room):
+        '''Called once the last member left, True if the room is closed'''
+        self._close_room(room)
+        return True
+
+    def _broadcast_package(self, room, package, sender, recipients=None, replayable=False):
+        '''
+        Sends the package to the recipients, or to every member of the room but the sender.
+        Room-wide broadcasts, and replayable ones, are numbered and kept for the members that reconnect.
+        '''
+        failed_clients = self._broadcast(room, package, sender, recipients, replayable)
+        # Out of the lock, the failed clients leave their rooms with broadcasts of their own
+        self._disconnect_failed(failed_clients)
+
+    def _broadcast(self, room, package, sender, recipients=None, replayable=False):
+        '''Same as _broadcast_package, but returns the clients it failed to reach instead of dropping them'''
         nickname = self._get_client_nickname(sender)
         outgoing_package = self.packager.add_sender_to_package(package, nickname)
-        for client in self.server.all_clients:
-            if client not in [self.server(), sender]:
-                try:
-                    self.server.send_to(client, outgoing_package)
-                except ConnectionBroken:
-                    self.client_disconnected(client)
-                    self.logger.error('Broadcasting to {0} failed.'.format(nickname))
+        outgoing_package = self.packager.add_room_to_package(outgoing_package, room.name)
+        if recipients is not None and not replayable:
+            return self._send_broadcast(outgoing_package, recipients)
+        with room.broadcast_lock:
+            sequence = next(self.sequences)
+            outgoing_package = self.packager.add_sequence_to_package(outgoing_package, sequence)
+            self.server.memory.held_resized(room.record(sequence, outgoing_package))
+            if recipients is None:
+                recipients = self._get_recipients(room, sender)
+            return self._send_broadcast(outgoing_package, recipients)
 
-    def _broadcast_client_list(self):
-        client_list_package = self.packager.make_client_list_package(self._get_client_list())
-        self._broadcast_package(client_list_package, self.server())
-        self.logger.debug('Client list broadcasted: {0}'.format(str(client_list_package)))
+    def _disconnect_failed(self, failed_clients):
+        for client in failed_clients:
+            self.logger.error('Broadcasting to {0} failed.'.format(self.client_list.get(client)))
+            self.client_disconnected(client)
 
-    def _receive_identification(self, new_client):
+    def _send_broadcast(self, outgoing_package, recipients):
+        '''Returns the clients it failed to reach'''
+        if not recipients:
+            return []
         try:
-            self.logger.info('Identification started.')
-            id_package = self.server.receive_from(new_client)
-            self.logger.debug('Identification package received: {0}'.format(str(id_package)))
-            return self.packager.identify_client(id_package)
+            return self.server.broadcast(recipients, outgoing_package)
         except ConnectionBroken:
-            raise ClientIdentificationFailed
+            self.logger.error('Package encoding failed: %s', PackageSummary(outgoing_package))
+            return []
 
-    def client_connected(self, new_client):
+    def _send_package(self, client, package, room=None):
+        outgoing_package = self.packager.add_sender_to_package(package, self.identifier)
+        if room is not None:
+            outgoing_package = self.packager.add_room_to_package(outgoing_package, room.name)
         try:
-            nickname = self._receive_identification(new_client)
+            self.server.send_to(client, outgoing_package)
+        except ConnectionBroken:
+            self.logger.error('Sending to {0} failed.'.format(self.client_list.get(client)))
+            self.client_disconnected(client)
+
+    def _make_client_list_package(self, members, client):
+        '''The whole client list, keyed by member id for the clients that take deltas'''
+        if client in self.list_delta_clients:
+            return self.packager.make_client_list_delta_package(
+                sorted(members.items(), key=lambda member: member[1]), full=True)
+        return self.packager.make_client_list_package(sorted(members.values()))
+
+    def _send_client_list(self, room, client):
+        '''Sends the whole client list to a member that just joined'''
+        with room.roster_lock:
+            members = self._get_members(room)
+            # Whoever the last delta didn't announce is shown now, if they leave before the next one it says so
+            room.shown.update(member_id for member_id in members if member_id not in room.roster)
+            package = self._make_client_list_package(members, client)
+            package = self.packager.add_sender_to_package(package, self.identifier)
+            package = self.packager.add_room_to_package(package, room.name)
+            try:
+                self.server.send_to(client, package)
+                failed_clients = []
+            except ConnectionBroken:
+                failed_clients = [client]
+        self._disconnect_failed(failed_clients)
+
+    def _client_list_changed(self, room):
+        '''A member joined or left, the room hears of every change within the window at once'''
+        with room.roster_lock:
+            if room.roster_timer is None:
+                room.roster_timer = self.timers.schedule(CLIENT_LIST_WINDOW, self._flush_client_list, room)
+
+    def _flush_client_list(self, room):
+        '''
+        Sends who joined and left since the last flush, the clients without deltas get the whole
+        list. Runs on the listener thread.
+        '''
+        failed_clients = []
+        with room.roster_lock:
+            room.roster_timer = None
+            if not room.open:
+                return
+            members = self._get_members(room)
+            joined = sorted(((member_id, nickname) for member_id, nickname in members.items()
+                             if member_id not in room.roster), key=lambda member: member[1])
+            left = [member_id for member_id in set(room.roster) | room.shown if member_id not in members]
+            room.roster, room.shown = members, set()
+            if not joined and not left:
+                return
+
+            recipients = self._get_recipients(room, None)
+            delta_recipients = [client for client in recipients if client in self.list_delta_clients]
+            list_recipients = [client for client in recipients if client not in self.list_delta_clients]
+            # Replayed along with the room-wide broadcasts, to the members that reconnect
+            failed_clients += self._broadcast(room, self.packager.make_client_list_delta_package(joined, left),
+                                              self.server(), delta_recipients, replayable=True)
+            if list_recipients:
+                failed_clients += self._broadcast(room, self._make_client_list_package(members, None),
+                                                  self.server(), list_recipients)
+        self.logger.debug('Client list of %s updated, %d joined and %d left.', room.name, len(joined), len(left))
+        self._disconnect_failed(failed_clients)
+
+    def _member_joined(self, room, client):
+        self._client_list_changed(room)
+
+    def _member_left(self, room, client):
+        self._client_list_changed(room)
+
+    def _server_features(self):
+        # The history is only offered when the server keeps one
+        return [feature for feature in SUPPORTED_FEATURES if feature != FEATURE_HISTORY or self.history is not None]
+
+    def _identify_client(self, new_client, id_package):
+        resume = None
+        try:
+            self.logger.debug('Identification package received: %s', PackageSummary(id_package))
+            nickname = self.packager.identify_client(id_package)
+            codec_name = self.server.negotiate_codec(new_client, self.packager.get_offered_codecs(id_package))
+            compression_name = self.server.negotiate_compression(
+                new_client, self.packager.get_offered_compressions(id_package))
+            features = [feature for feature in self.packager.get_offered_features(id_package)
+                        if feature in self._server_features()]
+            if FEATURE_PASTE_DELTA in features:
+                self.delta_clients.add(new_client)
+            if FEATURE_PASTE_CHUNKS in features:
+                self.chunk_clients.add(new_client)
+            if FEATURE_PASTE_HASH in features:
+                self.hash_clients.add(new_client)
+            if FEATURE_CLIENT_LIST_DELTA in features:
+                self.list_delta_clients.add(new_client)
+            if FEATURE_RESUME in features:
+                resume = self.packager.get_resume(id_package)
+            self.member_ids[new_client] = '{0}.{1}'.format(self.epoch[:8], next(self.member_numbers))
             self.client_list[new_client] = nickname
-        except ClientIdentificationFailed:
+            self.client_rooms[new_client] = set()
+        except (ClientIdentificationFailed, PackageVerificationFailed, ConnectionBroken):
             self.logger.info('Client identification failed.')
             self.server.disconnect_client(new_client)
             return
 
         welcome_package = self.packager.make_message_package(self.welcome_message)
         welcome_package = self.packager.add_sender_to_package(welcome_package, self.identifier)
+        welcome_package = self.packager.add_codec_to_package(welcome_package, codec_name)
+        if compression_name:
+            welcome_package = self.packager.add_compression_to_package(welcome_package, compression_name)
+        if features:
+            welcome_package = self.packager.add_features_to_package(welcome_package, features)
+        if FEATURE_RESUME in features:
+            welcome_package = self.packager.add_epoch_to_package(welcome_package, self.epoch)
         try:
             self.server.send_to(new_client, welcome_package)
-            self.logger.debug('Welcome message sent: {0}'.format(str(welcome_package)))
+            self.logger.debug('Welcome message sent to {0}.'.format(nickname))
         except ConnectionBroken:
             self.logger.info('Welcome message sending failed, connection broken.')
             self.server.disconnect_client(new_client)
             self.client_list.pop(new_client, None)
+            self.client_rooms.pop(new_client, None)
+            self.delta_clients.discard(new_client)
+            self.chunk_clients.discard(new_client)
+            self.hash_clients.discard(new_client)
+            self.list_delta_clients.discard(new_client)
+            self.member_ids.pop(new_client, None)
+            return
+
+        if resume is None:
+            self._join_room(new_client, DEFAULT_ROOM)
+            return
+        epoch, rooms = resume
+        self.logger.info('{0} resumes {1} rooms.'.format(nickname, len(rooms)))
+        for room_name in [DEFAULT_ROOM] + sorted(set(rooms) - set([DEFAULT_ROOM])):
+            if new_client not in self.client_list:
+                return
+            sequence, version = rooms.get(room_name, (None, None))
+            # Sequence numbers of another epoch mean nothing here, the room only gets a snapshot
+            self._join_room(new_client, room_name, sequence if epoch == self.epoch else None, version)
+
+    def _replay(self, room, client, last_sequence):
+        '''Sends the room's broadcasts numbered after last_sequence, False if some of them are gone'''
+        packages = room.replay_since(last_sequence)
+        if packages is None:
+            return False
+        for package in packages:
+            self.server.send_to(client, package)
+        self.logger.debug('%d broadcasts of %s replayed to %s.', len(packages), room.name,
+                          self._get_client_nickname(client))
+        return True
+
+    def _join_room(self, client, room_name, last_sequence=None, known_version=None):
+        '''
+        A client resuming after a reconnect names the last broadcast of the room it got, and the
+        blackboard version it has. It gets the broadcasts it missed, and a snapshot only if the
+        blackboard changed. If the broadcasts are no longer kept, it gets a snapshot instead.
+        '''
+        if room_name in self.client_rooms[client]:
+            return
+        room = self._open_room(room_name)
+        replayed = False
+        with room.broadcast_lock:
+            room.members.add(client)
+            self.client_rooms[client].add(room_name)
+            if last_sequence is not None:
+                try:
+                    replayed = self._replay(room, client, last_sequence)
+                except ConnectionBroken:
+                    replayed = None
+        if replayed is None:
+            self.logger.error('Replaying to {0} failed.'.format(self._get_client_nickname(client)))
+            self.client_disconnected(client)
             return
 
-        self._broadcast_client_list()
-        address = self._get_client_address(new_client)
+        if known_version is not None:
+            self.resumes.inc(1, ('replayed' if replayed else 'snapshot',))
+            if not replayed:
+                self._send_package(client, self.packager.make_message_package(
+                    'Messages sent while you were away could not be replayed.'), room)
+        if replayed and known_version == room.blackboard.version:
+            room.client_versions[client] = known_version
+        elif room.blackboard.version or known_version:
+            # A resuming client's blackboard may be ahead of a room that started over
+            self._send_snapshot(room, client)
+        self._send_client_list(room, client)
+        # Sending to the client may have failed, and it left again
+        if client not in room.members:
+            return
+        self._member_joined(room, client)
+        nickname = self._get_client_nickname(client)
+        address = self._get_client_address(client)
         message = '{0} joined from {1}:{2}'.format(nickname, address[0], address[1])
         inform_package = self.packager.make_message_package(message)
-        self._broadcast_package(inform_package, self.server())
-        self.logger.debug(message)
-        
+        self._broadcast_package(room, inform_package, self.server())
+        self.logger.debug('{0} in {1}'.format(message, room_name))
+
+    def _leave_room(self, client, room):
+        if room.paste_stream is not None and room.paste_stream['sender'] == client:
+            self._abort_paste_stream(room, notify_sender=False)
+        room.members.discard(client)
+        room.client_versions.pop(client, None)
+        # Once out of the members, so the next holder's notification doesn't go to the leaver
+        self._withdraw_paste_request(room, client)
+        self.client_rooms.get(client, set()).discard(room.name)
+        self._member_left(room, client)
+        if not room.members and self._room_emptied(room):
+            return
+
+        message = '{0} left.'.format(self._get_client_nickname(client))
+        inform_package = self.packager.make_message_package(message)
+        self._broadcast_package(room, inform_package, self.server())
+        self.logger.debug('{0} from {1}'.format(message, room.name))
+
+    def _room_requested(self, client, package_type, room_name):
+        try:
+            room_name = self.packager.verify_room_name(room_name)
+        except PackageVerificationFailed:
+            self.logger.info('Invalid room name from {0}.'.format(self._get_client_nickname(client)))
+            return
+
+        if package_type == PKG_ROOM_JOIN:
+            self._join_room(client, room_name)
+            return
+        room = self.rooms.get(room_name)
+        if room is not None and client in room.members:
+            self._leave_room(client, room)
+
+    def client_connected(self, new_client):
+        # The identification package is handled by identify_package once it arrives,
+        # so a silent client never holds up the listener
+        self.logger.info('Identification started.')
+
     def client_disconnected(self, disconnected_client):
-        nickname = self._get_client_nickname(disconnected_client)
         self.server.disconnect_client(disconnected_client)
-        self.client_list.pop(disconnected_client, None)
-        self._broadcast_client_list()
+        with self.leaving_lock:
+            if disconnected_client not in self.client_list or disconnected_client in self.leaving_clients:
+                return
+            self.leaving_clients.add(disconnected_client)
 
-        message = '{0} left.'.format(nickname)
-        inform_package = self.packager.make_message_package(message)
-        self._broadcast_package(inform_package, self.server())
-        self.logger.debug(message)
+        for room_name in list(self.client_rooms.get(disconnected_client, ())):
+            room = self.rooms.get(room_name)
+            if room is not None:
+                self._leave_room(disconnected_client, room)
+        self.client_list.pop(disconnected_client)
+        self.client_rooms.pop(disconnected_client, None)
+        self.delta_clients.discard(disconnected_client)
+        self.chunk_clients.discard(disconnected_client)
+        self.hash_clients.discard(disconnected_client)
+        self.list_delta_clients.discard(disconnected_client)
+        self.member_ids.pop(disconnected_client, None)
+        self.leaving_clients.discard(disconnected_client)
 
-    def _broadcast_paste_permission(self, nickname):
+    def _broadcast_paste_permission(self, room, nickname):
         paste_permission_package = self.packager.make_paste_notification_package(nickname)
-        self._broadcast_package(paste_permission_package, self.server())
-        self.logger.debug('Paste permission broadcasted: {0}'.format(str(paste_permission_package)))
+        self._broadcast_package(room, paste_permission_package, self.server())
+        self.logger.debug('Paste permission of {0} in {1} broadcasted.'.format(nickname, room.name))
 
-    def _paste_request_processor(self):
-        self.logger.info('Paste request processor started.')
-        while self.running:
-            try:
-                requester_client = self.paste_requests.get(False)
-                package = self.packager.make_paste_granted_package()
-                package = self.packager.add_sender_to_package(package, self.identifier)
-                nickname = self._get_client_nickname(requester_client)
-                try:
-                    self.paste_received.clear()
-                    self.paste_permission_holder = requester_client
-                    self.server.send_to(requester_client, package)
-                    self.logger.debug('Paste request granted to: {0} for {1}s'.format(nickname, self.max_paste_time))
-                    self._broadcast_paste_permission(nickname)
-                    self.paste_received.wait(self.max_paste_time)
-                except ConnectionBroken:
-                    self.logger.debug('Paste request permission sending failed to: {0}'.format(nickname))
-            except QueueEmpty:
-                self.paste_permission_holder = None
-                self.paste_request_received.clear()
-                self.paste_request_received.wait()
+    def _make_snapshot_package(self, room, by_hash=False):
+        if by_hash:
+            package = self.packager.make_paste_ref_package(room.blackboard.content_hash, len(room.blackboard.text))
+        else:
+            package = self.packager.make_paste_package(room.blackboard.text)
+        return self.packager.add_version_to_package(package, room.blackboard.version)
+
+    def _send_snapshot(self, room, client):
+        room.client_versions[client] = room.blackboard.version
+        by_hash = client in self.hash_clients and len(room.blackboard.text) >= MIN_DEDUP_SIZE
+        if by_hash:
+            self.paste_refs.inc(1, ('sent',))
+        self._send_package(client, self._make_snapshot_package(room, by_hash), room)
+
+    def _end_paste_turn(self, room):
+        holder, room.paste_permission_holder = room.paste_permission_holder, None
+        room.leases.release(holder)
+
+    def _extend_paste_turn(self, room):
+        room.leases.extend(room.paste_permission_holder)
+
+    def _distribute_blackboard(self, room, sender, recipients, incremental_package=None, incremental_recipients=()):
+        '''
+        Sends the current blackboard version to the recipients: the incremental package (a delta,
+        or the last chunk of a streamed paste) to the incremental recipients, a full snapshot to the rest
+        '''
+        version = room.blackboard.version
+        incremental_recipients = [client for client in incremental_recipients if client in recipients]
+        snapshot_recipients = [client for client in recipients if client not in incremental_recipients]
+        for client in recipients:
+            room.client_versions[client] = version
+
+        # Large pastes only go out as their hash to the clients caching them, they fetch the body on a miss
+        hash_recipients = []
+        if len(room.blackboard.text) >= MIN_DEDUP_SIZE:
+            self.paste_cache.put(room.blackboard.content_hash, room.blackboard.text)
+            hash_recipients = [client for client in snapshot_recipients if client in self.hash_clients]
+            snapshot_recipients = [client for client in snapshot_recipients if client not in self.hash_clients]
+
+        if incremental_recipients:
+            incremental_package = self.packager.add_version_to_package(incremental_package, version)
+            self._broadcast_package(room, incremental_package, sender, incremental_recipients)
+        if hash_recipients:
+            self.paste_refs.inc(len(hash_recipients), ('sent',))
+            self._broadcast_package(room, self._make_snapshot_package(room, True), sender, hash_recipients)
+        self._broadcast_package(room, self._make_snapshot_package(room), sender, snapshot_recipients)
+        self.logger.debug('Blackboard version %d of %s published, %d incremental, %d by hash and %d snapshots.',
+                          version, room.name, len(incremental_recipients), len(hash_recipients),
+                          len(snapshot_recipients))
+
+    def _record_paste(self, room, sender_client, incremental_package=None):
+        if self.history is None:
+            return
+        base_version = changes = None
+        if incremental_package is not None and incremental_package['type'] == PKG_PASTE_DELTA:
+            # Small edits are logged as the changes, not the whole text again
+            base_version, changes = self.packager.unpack_paste_delta(incremental_package['data'])
+        try:
+            self.history.append(room.name, self._get_client_nickname(sender_client), room.blackboard.text,
+                                room.blackboard.version, base_version=base_version, changes=changes)
+        except (IOError, OSError) as exc:
+            self.logger.error('Writing the paste history failed: {0}'.format(str(exc)))
+
+    def _publish_paste(self, room, sender_client, incremental_package=None, incremental_recipients=()):
+        self._record_paste(room, sender_client, incremental_package)
+        self._end_paste_turn(room)
+        version = room.blackboard.version
+        self._distribute_blackboard(
+            room, sender_client, self._get_recipients(room, sender_client), incremental_package, incremental_recipients)
+        room.client_versions[sender_client] = version
+        self._send_package(sender_client, self.packager.make_paste_accepted_package(version), room)
+
+    def _accept_paste(self, room, sender_client, paste_data):
+        if not isinstance(paste_data, basestring):
+            self.logger.error('Invalid paste data received from: {0}'.format(self._get_client_nickname(sender_client)))
+            return
+        room.blackboard.replace(paste_data)
+        self.pastes_published.inc(1, ('full',))
+        self._publish_paste(room, sender_client)
+
+    def _find_paste_body(self, room, paste_hash):
+        if paste_hash == room.blackboard.content_hash:
+            return room.blackboard.text
+        return self.paste_cache.get(paste_hash)
 
-        self.paste_request_processor_running.set()
+    def _accept_paste_ref(self, room, sender_client, ref_data):
+        try:
+            paste_hash, _size = self.packager.unpack_paste_ref(ref_data)
+        except PackageVerificationFailed:
+            self.logger.error('Invalid paste reference received from: {0}'.format(
+                self._get_client_nickname(sender_client)))
+            return
+
+        paste_data = self._find_paste_body(room, paste_hash)
+        if paste_data is None:
+            # Same as a delta that doesn't apply, the sender answers with the whole paste
+            self.logger.info('Paste of {0} is not cached, rejected.'.format(self._get_client_nickname(sender_client)))
+            self._send_package(sender_client, self.packager.make_paste_rejected_package(), room)
+            return
+
+        room.blackboard.replace(paste_data)
+        self.paste_refs.inc(1, ('received',))
+        self.pastes_published.inc(1, ('hash',))
+        self._publish_paste(room, sender_client)
+
+    def _send_paste_body(self, room, client, paste_hash):
+        if not isinstance(paste_hash, basestring):
+            self.logger.error('Invalid paste fetch from: {0}'.format(self._get_client_nickname(client)))
+            return
+        paste_data = self._find_paste_body(room, paste_hash)
+        if paste_data is not None:
+            self.paste_refs.inc(1, ('fetched',))
+        self._send_package(client, self.packager.make_paste_fetch_package(paste_hash, paste_data), room)
+
+    def _accept_paste_delta(self, room, sender_client, delta_data):
+        try:
+            base_version, changes = self.packager.unpack_paste_delta(delta_data)
+            room.blackboard.apply(base_version, changes)
+        except (PackageVerificationFailed, StaleVersion, ValueError):
+            # The sender still holds the permission, and answers with the whole paste
+            self.logger.info('Paste delta of {0} rejected.'.format(self._get_client_nickname(sender_client)))
+            self._send_package(sender_client, self.packager.make_paste_rejected_package(), room)
+            return
+
+        delta_package = self.packager.make_paste_delta_package(base_version, changes)
+        self.pastes_published.inc(1, ('delta',))
+        self._publish_paste(room, sender_client, delta_package, self._delta_recipients(room, sender_client, base_version))
+
+    def _delta_recipients(self, room, sender_client, base_version):
+        return [client for client in self._get_recipients(room, sender_client)
+                if client in self.delta_clients and room.client_versions.get(client) == base_version]
+
+    def _abort_paste_stream(self, room, notify_sender=True):
+        '''Drops the paste being streamed, and tells the clients that got its first chunks'''
+        stream, room.paste_stream = room.paste_stream, None
+        if stream is None:
+            return
+
+        self.logger.info('Paste stream {0} aborted after {1} chunks.'.format(stream['paste_id'], len(stream['parts'])))
+        self.server.memory.held_resized(-stream['size'])
+        abort_package = self.packager.make_paste_abort_package(stream['paste_id'])
+        sender = stream['sender'] if stream['sender'] in self.client_list else self.server()
+        recipients = [client for client in stream['recipients'] if client in room.members]
+        self._broadcast_package(room, abort_package, sender, recipients)
+        if notify_sender and sender != self.server():
+            # Stops the sender from streaming the rest of a paste that will be ignored
+            self._send_package(sender, abort_package, room)
+
+    def _accept_paste_chunk(self, room, sender_client, chunk_data):
+        '''
+        Relays every chunk as soon as it arrives, to the members that were in the room when
+        the stream started. The blackboard only changes once the final chunk is in. A stream
+        longer than it said it would be, or than a whole paste may be, is aborted.
+        '''
+        try:
+            paste_id, index, total_size, chunk, final = self.packager.unpack_paste_chunk(chunk_data)
+        except PackageVerificationFailed:
+            self.logger.error('Invalid paste chunk received from: {0}'.format(self._get_client_nickname(sender_client)))
+            self._abort_paste_stream(room)
+            return
+
+        stream = room.paste_stream
+        if index == 0:
+            self._abort_paste_stream(room)
+            stream = room.paste_stream = dict(
+                paste_id=paste_id,
+                sender=sender_client,
+                parts=[],
+                # Characters of the parts, counted against the server's memory ceiling
+                size=0,
+                total=total_size,
+                recipients=[client for client in self._get_recipients(room, sender_client)
+                            if client in self.chunk_clients]
+            )
+        elif stream is None or stream['paste_id'] != paste_id or len(stream['parts']) != index:
+            self.logger.info('Paste chunk {0} of {1} is out of sequence.'.format(index, paste_id))
+            self._abort_paste_stream(room)
+            return
+
+        size = stream['size'] + len(chunk)
+        if size > min(stream['total'], self.server.limits.inbound_buffer_size) or \
+                self.server.memory.exceeded(len(chunk)):
+            self.logger.error('Paste stream {0} of {1} is too large.'.format(
+                paste_id, self._get_client_nickname(sender_client)))
+            self._abort_paste_stream(room)
+            self._end_paste_turn(room)
+            return
+        stream['parts'].append(chunk)
+        stream['size'] = size
+        self.server.memory.held_resized(len(chunk))
+        self._extend_paste_turn(room)
+        chunk_package = self.packager.make_paste_chunk_package(paste_id, index, total_size, chunk, final)
+        if not final:
+            self._relay_paste_chunk(room, sender_client, chunk_package, stream['recipients'])
+            return
+
+        room.paste_stream = None
+        self.server.memory.held_resized(-stream['size'])
+        room.blackboard.replace(u''.join(stream['parts']))
+        self.pastes_published.inc(1, ('stream',))
+        self._publish_paste(room, sender_client, chunk_package, stream['recipients'])
+
+    def _relay_paste_chunk(self, room, sender_client, chunk_package, recipients):
+        self._broadcast_package(room, chunk_package, sender_client, recipients)
+
+    def _cancel_paste_stream(self, room, sender_client, paste_id):
+        if room.paste_stream is None or room.paste_stream['paste_id'] != paste_id:
+            return
+        self._abort_paste_stream(room, notify_sender=False)
+        # A cancelled paste gives the permission back right away
+        self._end_paste_turn(room)
+
+    def _release_paste_permission(self, room, client):
+        '''The holder gives the permission back unused, or drops the paste it is streaming'''
+        if room.paste_stream is not None and room.paste_stream['sender'] == client:
+            self._abort_paste_stream(room, notify_sender=False)
+        self._end_paste_turn(room)
+
+    def _renew_paste_permission(self, room, client):
+        renewed = room.leases.renew(client)
+        self._send_package(client, self.packager.make_paste_renew_package(renewed), room)
+
+    def _paste_lease_expired(self, room, client):
+        if room.paste_permission_holder == client:
+            room.paste_permission_holder = None
+        self.logger.info('Paste permission of {0} in {1} expired.'.format(self.client_list.get(client), room.name))
+        self._abort_paste_stream(room)
+
+    def _open_paste_leases(self, room):
+        room.leases = PasteLeases(
+            self.timers, self.max_paste_time,
+            lambda client, requested_at: self._grant_paste_permission(room, client, requested_at),
+            lambda client: self._paste_lease_expired(room, client),
+            self.paste_policy)
+
+    def _queue_paste_request(self, room, client):
+        if not room.leases.request(client, time.time()):
+            self.logger.info('Paste request of {0} in {1} is already queued.'.format(
+                self._get_client_nickname(client), room.name))
+
+    def _withdraw_paste_request(self, room, client):
+        if room.paste_permission_holder == client:
+            room.paste_permission_holder = None
+        room.leases.withdraw(client)
+
+    def _grant_paste_permission(self, room, requester_client, requested_at):
+        '''Hands the paste permission to the requester, returns False if it couldn't be told'''
+        # The requester may have left the room since its request
+        if requester_client not in room.members:
+            return False
+        package = self.packager.make_paste_granted_package()
+        package = self.packager.add_sender_to_package(package, self.identifier)
+        package = self.packager.add_room_to_package(package, room.name)
+        nickname = self._get_client_nickname(requester_client)
+        try:
+            room.paste_permission_holder = requester_client
+            self.server.send_to(requester_client, package)
+        except ConnectionBroken:
+            room.paste_permission_holder = None
+            self.logger.debug('Paste request permission sending failed to: {0}'.format(nickname))
+            return False
+
+        self.paste_wait_seconds.observe(time.time() - requested_at)
+        self.logger.debug('Paste request granted to: {0} in {1} for {2}s'.format(
+            nickname, room.name, self.max_paste_time))
+        self._broadcast_paste_permission(room, nickname)
+        return True
+
+    def _send_history_page(self, room, client, request_data):
+        try:
+            before, before_time, limit = self.packager.unpack_history_request(request_data)
+        except PackageVerificationFailed:
+            self.logger.error('Invalid history request from: {0}'.format(self._get_client_nickname(client)))
+            return
+
+        self.history.refresh()
+        entries = self.history.page(room.name, before, before_time, limit or MAX_PAGE_SIZE)
+        page = [dict(paste_id=entry.paste_id, timestamp=entry.timestamp, version=entry.version,
+                     sender=entry.sender, size=entry.length) for entry in entries]
+        self._send_package(client, self.packager.make_history_page_package(page), room)
+
+    def _send_history_paste(self, room, client, paste_id):
+        self.history.refresh()
+        if paste_id is None:
+            entry = self.history.latest(room.name)
+        elif isinstance(paste_id, (int, long)):
+            entry = self.history.find(room.name, paste_id)
+        else:
+            self.logger.error('Invalid history paste id from: {0}'.format(self._get_client_nickname(client)))
+            return
+
+        text = None if entry is None else self.history.read(entry)
+        if text is None:
+            package = self.packager.make_history_paste_package(paste_id, None)
+        else:
+            package = self.packager.make_history_paste_package(
+                entry.paste_id, text, entry.timestamp, entry.version, entry.sender)
+        self._send_package(client, package, room)
+
+    def _is_local_client(self, client):
+        return self._get_client_address(client)[0] in ('127.0.0.1', self.server().getsockname()[0])
+
+    def _send_metrics(self, client):
+        # Metrics describe every client, so only someone on the server's machine may read them
+        if not self._is_local_client(client):
+            self.logger.info('Metrics request of {0} refused.'.format(self._get_client_nickname(client)))
+            return
+        self._send_package(client, self.packager.make_admin_metrics_package(self.server.metrics.render()))
 
     def identify_package(self, sender_client, package):
+        if sender_client not in self.client_list:
+            self._identify_client(sender_client, package)
+            return
+
         try:
-            package_type, _package_data = self.packager.process_package(package, False)
+            package_type, package_data = self.packager.process_package(package, False)
         except PackageVerificationFailed:
-            self.logger.error('Package verification failed: {0}'.format(str(package)))
+            self.logger.error('Package verification failed: %s', PackageSummary(package))
+            return
+
+        if package_type in (PKG_ROOM_JOIN, PKG_ROOM_LEAVE):
+            self._room_requested(sender_client, package_type, package_data)
+            return
+        elif package_type == PKG_ADMIN_METRICS:
+            self._send_metrics(sender_client)
+            return
+        elif package_type in (PKG_PASTE_ACCEPTED, PKG_PASTE_REJECTED):
             return
-        
+
+        try:
+            room_name = self.packager.verify_room_name(self.packager.get_package_room(package))
+        except PackageVerificationFailed:
+            self.logger.error('Package with an invalid room: %s', PackageSummary(package))
+            return
+        room = self.rooms.get(room_name)
+        if room is None or sender_client not in room.members:
+            self.logger.info('{0} is not in room {1}.'.format(self._get_client_nickname(sender_client), room_name))
+            return
+
         if package_type == PKG_PASTE_REQUEST:
-            self.paste_requests.put(sender_client)
-            self.paste_request_received.set()
+            self._queue_paste_request(room, sender_client)
             return
-        elif package_type == PKG_PASTE:
-            if sender_client != self.paste_permission_holder:
+        elif package_type in (PKG_PASTE, PKG_PASTE_DELTA, PKG_PASTE_CHUNK, PKG_PASTE_ABORT, PKG_PASTE_REF,
+                              PKG_PASTE_RELEASE, PKG_PASTE_RENEW):
+            if sender_client != room.paste_permission_holder:
                 self.logger.info('This paste has timed out, and will be ignored.')
                 return
-            self.paste_received.set()
+            if package_type == PKG_PASTE_RELEASE:
+                self._release_paste_permission(room, sender_client)
+            elif package_type == PKG_PASTE_RENEW:
+                self._renew_paste_permission(room, sender_client)
+            elif package_type == PKG_PASTE:
+                self._accept_paste(room, sender_client, package_data)
+            elif package_type == PKG_PASTE_DELTA:
+                self._accept_paste_delta(room, sender_client, package_data)
+            elif package_type == PKG_PASTE_CHUNK:
+                self._accept_paste_chunk(room, sender_client, package_data)
+            elif package_type == PKG_PASTE_REF:
+                self._accept_paste_ref(room, sender_client, package_data)
+            else:
+                self._cancel_paste_stream(room, sender_client, package_data)
+            return
+        elif package_type == PKG_PASTE_SNAPSHOT_REQUEST:
+            self._send_snapshot(room, sender_client)
+            return
+        elif package_type == PKG_PASTE_FETCH:
+            self._send_paste_body(room, sender_client, package_data)
+            return
+        elif package_type in (PKG_HISTORY, PKG_HISTORY_PASTE):
+            if self.history is None:
+                self.logger.info('History request of {0} ignored, no history kept.'.format(
+                    self._get_client_nickname(sender_client)))
+            elif package_type == PKG_HISTORY:
+                self._send_history_page(room, sender_client, package_data)
+            else:
+                self._send_history_paste(room, sender_client, package_data)
+            return
+        elif package_type != PKG_MESSAGE:
+            # Client lists and paste notifications only come from the server, a client could fake them
+            self.logger.info('Package of type {0} from {1} ignored, only the server sends it.'.format(
+                package_type, self._get_client_nickname(sender_client)))
+            return
+
+        self._broadcast_package(room, package, sender_client)
+
+    def _open_history(self, history):
+        try:
+            history.open()
+            self.history = history
+        except (IOError, OSError) as exc:
+            self.logger.error('Paste history failed in {0}, running without: {1}'.format(history.directory, str(exc)))
 
-        self._broadcast_package(package, sender_client)
+    def _close_history(self):
+        if self.history is not None:
+            self.history.close()
+            self.history = None
 
-    def host(self, port):
-        server_address = self.server.host(port)
+    def host(self, port, metrics_port=None, reuse_port=False, history=None, paste_policy=POLICY_FIFO):
+        # The history is opened first, so the first rooms already get their last paste back
+        if history is not None:
+            self._open_history(history)
+        self.paste_policy = paste_policy
+        try:
+            server_address = self.server.host(port, reuse_port)
+        except ConnectionBroken:
+            self._close_history()
+            raise
+        self.timers.start()
         self.client_list[self.server()] = self.identifier
-        paste_request_thread = threading.Thread(target=self._paste_request_processor)
-        paste_request_thread.start()
+        if metrics_port is not None:
+            try:
+                self.metrics_endpoint.start(metrics_port)
+            except socket.error as se:
+                self.logger.error('Metrics endpoint failed on port {0}: {1}'.format(metrics_port, str(se)))
         return server_address
-        
+
     def close_server(self):
-        self.paste_request_processor_running.clear()
+        self.metrics_endpoint.stop()
         self.server.close_server()
-        self.paste_request_received.set()
-        self.paste_request_processor_running.wait()
+        with self.rooms_lock:
+            rooms, self.rooms = self.rooms.values(), dict()
+        for room in rooms:
+            room.close()
+        self.timers.stop()
+        self._close_history()
@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+'''
+p2paste chat server sharded over worker processes
+
+Every worker is a ChatServer listening on the same port with SO_REUSEPORT, so the
+kernel spreads the clients between them and each worker does the TLS and encoding
+work of its own clients only. The workers are tied together by a bus of pipes to
+the supervising process, the hub:
+
+    - broadcasts, paste chunks, published pastes and stream aborts are relayed
+      by the hub to every other worker, which sends them on to its own clients
+    - workers report each member joining or leaving a room, the hub passes it
+      on to every other worker and closes the room once it's empty everywhere.
+      Every worker sends the client list deltas of its own clients, with the
+      members of the other workers in them
+    - the paste leases live in the hub only, one queue per room, so the
+      requests of a room are granted one at a time in the order the hub got
+      them, whichever worker they came from, with the same expiry, release,
+      renewal and chunk activity rules as a single server. A worker names its
+      client in the requests by a token that stays the same while it's connected
+
+Every bus message names its room. A worker keeps the blackboard of a room that
+only has members on other workers, so a client joining it there gets a snapshot.
+Each worker numbers the broadcasts it sends to its own clients, so a client that
+reconnects to another worker gets snapshots instead of a replay.
+
+With a paste history, the hub writes the log as it relays the pastes, and the
+workers follow it read-only to answer the history requests of their clients.
+
+A worker relays a paste before it ends the paste turn, so every worker sees the
+pastes in the order they were granted. The bus messages a worker gets are handled
+on its listener thread, in between the packages of its clients, as the rooms are
+only ever changed there.
+'''
+
+from p2paste.chatserver import ChatServer
+from p2paste.network.server import ConnectionBroken, make_listening_socket
+from p2paste.packager import DataPackager, PKG_PASTE_DELTA
+from p2paste.rooms import Room
+from p2paste.leases import TimerWheel, PasteLeases, POLICY_FIFO
+from Queue import Queue
+import multiprocessing
+import itertools
+import threading
+import signal
+import socket
+import time
+
+
+# Hub messages every other worker gets as they are
+RELAYED_MESSAGES = ('broadcast', 'chunk', 'paste', 'abort')
+
+
+class RemotePeer(object):
+    '''Client of another worker, stands in as the sender of what the hub relays from it'''
+
+    __slots__ = ('nickname',)
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+
+class ShardedChatServer(ChatServer):
+    '''ChatServer of a worker process, sharing its rooms and paste queues over the bus'''
+
+    def __init__(self, worker_id, bus, *args):
+        super(ShardedChatServer, self).__init__(*args)
+        self.worker_id = worker_id
+        self.bus = bus
+        self.bus_lock = threading.Lock()
+        # Token -> client and client -> token, the hub's name of a client in its paste requests
+        self.paste_tokens = dict()
+        self.client_tokens = dict()
+        self.next_paste_token = itertools.count()
+        # Room name -> token of the client holding the permission there
+        self.paste_holder_tokens = dict()
+        self.bus_handlers = dict(
+            broadcast=self._bus_broadcast,
+            member_joined=self._bus_member_joined,
+            member_left=self._bus_member_left,
+            grant=self._bus_grant,
+            expired=self._bus_expired,
+            renewed=self._bus_renewed,
+            chunk=self._bus_chunk,
+            paste=self._bus_paste,
+            abort=self._bus_abort
+        )
+
+    def _publish(self, *message):
+        with self.bus_lock:
+            self.bus.send(message)
+
+    def _get_client_nickname(self, client):
+        if isinstance(client, RemotePeer):
+            return client.nickname
+        return super(ShardedChatServer, self)._get_client_nickname(client)
+
+    def _get_local_recipients(self, room):
+        return self._get_recipients(room, self.server())
+
+    def _open_paste_leases(self, room):
+        # The hub runs the paste leases
+        pass
+
+    def _room_emptied(self, room):
+        # The room and its blackboard stay while it has members on other workers
+        if room.remote_members:
+            return False
+        return super(ShardedChatServer, self)._room_emptied(room)
+
+    def _broadcast_package(self, room, package, sender, recipients=None, replayable=False):
+        # Packages meant for the whole room reach its members on the other workers as well
+        if recipients is None and not isinstance(sender, RemotePeer):
+            self._publish('broadcast', room.name, self._get_client_nickname(sender), package)
+        super(ShardedChatServer, self)._broadcast_package(room, package, sender, recipients, replayable)
+
+    def _member_joined(self, room, client):
+        self._publish('member_joined', room.name, self.member_ids[client], self._get_client_nickname(client))
+        super(ShardedChatServer, self)._member_joined(room, client)
+
+    def _member_left(self, room, client):
+        self._publish('member_left', room.name, self.member_ids[client])
+        super(ShardedChatServer, self)._member_left(room, client)
+
+    def _client_token(self, client):
+        token = self.client_tokens.get(client)
+        if token is None:
+            token = self.client_tokens[client] = next(self.next_paste_token)
+            self.paste_tokens[token] = client
+        return token
+
+    def _queue_paste_request(self, room, client):
+        # The hub ignores a request of a client already waiting or holding the lease
+        self._publish('paste_request', room.name, self._client_token(client), time.time())
+
+    def _withdraw_paste_request(self, room, client):
+        token = self.client_tokens.get(client)
+        if token is None:
+            return
+        if self.paste_holder_tokens.get(room.name) == token:
+            del self.paste_holder_tokens[room.name]
+            room.paste_permission_holder = None
+        self._publish('withdraw', room.name, token)
+
+    def _end_paste_turn(self, room):
+        token = self.paste_holder_tokens.pop(room.name, None)
+        room.paste_permission_holder = None
+        if token is not None:
+            self._publish('release', room.name, token)
+
+    def _extend_paste_turn(self, room):
+        token = self.paste_holder_tokens.get(room.name)
+        if token is not None:
+            self._publish('activity', room.name, token)
+
+    def _renew_paste_permission(self, room, client):
+        # Answered by the hub, see _bus_renewed
+        self._publish('renew', room.name, self._client_token(client))
+
+    def _record_paste(self, room, sender_client, incremental_package=None):
+        # The hub writes the history, from the pastes it relays
+        pass
+
+    def _publish_paste(self, room, sender_client, incremental_package=None, incremental_recipients=()):
+        self._publish('paste', room.name, self._get_client_nickname(sender_client), room.blackboard.text,
+                      room.blackboard.version, incremental_package)
+        super(ShardedChatServer, self)._publish_paste(room, sender_client, incremental_package, incremental_recipients)
+
+    def _relay_paste_chunk(self, room, sender_client, chunk_package, recipients):
+        self._publish('chunk', room.name, self._get_client_nickname(sender_client), chunk_package)
+        super(ShardedChatServer, self)._relay_paste_chunk(room, sender_client, chunk_package, recipients)
+
+    def _abort_paste_stream(self, room, notify_sender=True):
+        stream = room.paste_stream
+        if stream is None or not isinstance(stream['sender'], RemotePeer):
+            if stream is not None:
+                self._publish('abort', room.name, stream['paste_id'])
+            super(ShardedChatServer, self)._abort_paste_stream(room, notify_sender)
+            return
+
+        room.paste_stream = None
+        abort_package = self.packager.make_paste_abort_package(stream['paste_id'])
+        recipients = [client for client in stream['recipients'] if client in room.members]
+        self._broadcast_package(room, abort_package, stream['sender'], recipients)
+
+    def _bus_broadcast(self, room_name, nickname, package):
+        room = self.rooms.get(room_name)
+        if room is not None:
+            # Room-wide, so it's numbered for replay here as well, a remote sender isn't published again
+            self._broadcast_package(room, package, RemotePeer(nickname))
+
+    def _bus_member_joined(self, room_name, member_id, nickname):
+        # Every worker opens the room, so its members are known to whoever joins it here
+        room = self._open_room(room_name)
+        room.remote_members[member_id] = nickname
+        self._client_list_changed(room)
+
+    def _bus_member_left(self, room_name, member_id):
+        room = self.rooms.get(room_name)
+        if room is None or room.remote_members.pop(member_id, None) is None:
+            return
+        if not room.members and not room.remote_members:
+            self._close_room(room)
+            return
+        self._client_list_changed(room)
+
+    def _bus_grant(self, room_name, token, requested_at):
+        client = self.paste_tokens.get(token)
+        room = self.rooms.get(room_name)
+        if room is None:
+            self._publish('release', room_name, token)
+            return
+        self.paste_holder_tokens[room_name] = token
+        if client is None or not self._grant_paste_permission(room, client, requested_at):
+            self._end_paste_turn(room)
+
+    def _bus_expired(self, room_name, token):
+        room = self.rooms.get(room_name)
+        if room is None or self.paste_holder_tokens.get(room_name) != token:
+            return
+        del self.paste_holder_tokens[room_name]
+        self._paste_lease_expired(room, self.paste_tokens.get(token))
+
+    def _bus_renewed(self, room_name, token, renewed):
+        client = self.paste_tokens.get(token)
+        room = self.rooms.get(room_name)
+        if client is not None and room is not None:
+            self._send_package(client, self.packager.make_paste_renew_package(renewed), room)
+
+    def client_disconnected(self, disconnected_client):
+        super(ShardedChatServer, self).client_disconnected(disconnected_client)
+        token = self.client_tokens.pop(disconnected_client, None)
+        if token is not None:
+            del self.paste_tokens[token]
+
+    def _bus_chunk(self, room_name, nickname, chunk_package):
+        room = self.rooms.get(room_name)
+        if room is None:
+            return
+        paste_id, index, _total_size, _chunk, _final = self.packager.unpack_paste_chunk(chunk_package['data'])
+        if index == 0:
+            self._abort_paste_stream(room)
+            room.paste_stream = dict(
+                paste_id=paste_id,
+                sender=RemotePeer(nickname),
+                parts=[],
+                size=0,
+                recipients=[client for client in self._get_local_recipients(room) if client in self.chunk_clients]
+            )
+        stream = room.paste_stream
+        if stream is None or stream['paste_id'] != paste_id:
+            return
+        self._broadcast_package(room, chunk_package, stream['sender'], stream['recipients'])
+
+    def _bus_paste(self, room_name, nickname, text, version, incremental_package):
+        # Rooms without local members keep following the blackboard, for whoever joins them here
+        room = self._open_room(room_name)
+        incremental_recipients = ()
+        if incremental_package is not None and incremental_package['type'] == PKG_PASTE_DELTA:
+            base_version, _changes = self.packager.unpack_paste_delta(incremental_package['data'])
+            incremental_recipients = self._delta_recipients(room, self.server(), base_version)
+        elif incremental_package is not None and room.paste_stream is not None:
+            paste_id = self.packager.unpack_paste_chunk(incremental_package['data'])[0]
+            if room.paste_stream['paste_id'] == paste_id:
+                incremental_recipients = room.paste_stream['recipients']
+                room.paste_stream = None
+
+        room.blackboard.load(text, version)
+        self._distribute_blackboard(
+            room, RemotePeer(nickname), self._get_local_recipients(room), incremental_package, incremental_recipients)
+
+    def _bus_abort(self, room_name, paste_id):
+        room = self.rooms.get(room_name)
+        if room is None:
+            return
+        stream = room.paste_stream
+        if stream is not None and stream['paste_id'] == paste_id and isinstance(stream['sender'], RemotePeer):
+            self._abort_paste_stream(room, notify_sender=False)
+
+    def serve(self, port, metrics_port=None, history=None):
+        '''Hosts on the shared port and handles the bus until the hub stops the worker'''
+        try:
+            address = self.host(port, metrics_port, reuse_port=True, history=history)
+        except ConnectionBroken:
+            self._publish('failed', None)
+            return
+        self._publish('ready', address)
+
+        while True:
+            try:
+                message = self.bus.recv()
+            except (EOFError, IOError):
+                self.logger.error('Worker {0} lost the bus.'.format(self.worker_id))
+                break
+            if message[0] == 'stop':
+                break
+            self.server.call_on_listener(self.bus_handlers[message[0]], *message[1:])
+
+        if self.running:
+            self.close_server()
+
+
+def _run_worker(worker_id, bus, port, metrics_port, history, *args):
+    # The hub shuts the workers down, a ^C reaches the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    ShardedChatServer(worker_id, bus, *args).serve(port, metrics_port, history)
+    bus.close()
+
+
+class _WorkerLink(object):
+    '''Hub end of the bus to one worker, writes go through a queue so readers never block on them'''
+
+    def __init__(self, worker_id, process, bus):
+        self.worker_id = worker_id
+        self.process = process
+        self.bus = bus
+        self.alive = True
+        self.outbox = Queue()
+        self.writer_thread = threading.Thread(target=self._write)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def send(self, message):
+        if self.alive:
+            self.outbox.put(message)
+
+    def _write(self):
+        while True:
+            message = self.outbox.get()
+            if message is None:
+                return
+            try:
+                self.bus.send(message)
+            except (IOError, EOFError):
+                self.alive = False
+                return
+
+    def close(self):
+        self.outbox.put(None)
+        self.writer_thread.join()
+        self.bus.close()
+
+
+class ChatCluster(object):
+    '''
+    Same interface as ChatServer, hosting with worker processes on one port instead, the
+    process it runs in is the hub. Every worker gets a metrics endpoint of its own, on
+    metrics_port + its worker number.
+    '''
+
+    def __init__(self, worker_count, logger, identifier, welcome_message, max_paste_time, *args):
+        self.worker_count = worker_count
+        self.logger = logger
+        self.packager = DataPackager(logger)
+        self.max_paste_time = max_paste_time
+        self.worker_args = (logger, identifier, welcome_message, max_paste_time) + args
+
+        self.links = []
+        self.reader_threads = []
+        # Room name -> Room holding the paste leases, its requesters are (worker id, token) pairs
+        self.rooms = dict()
+        # Room name -> member id -> worker id of the member
+        self.members = dict()
+        self.rooms_lock = threading.RLock()
+        self.history = None
+        self.paste_timers = TimerWheel(logger)
+        self.paste_policy = POLICY_FIFO
+        self.cluster_running = threading.Event()
+
+    @property
+    def running(self):
+        return self.cluster_running.is_set()
+
+    def _start_worker(self, worker_id, port, metrics_port):
+        hub_end, worker_end = multiprocessing.Pipe()
+        history = None if self.history is None else self.history.follower()
+        process = multiprocessing.Process(
+            target=_run_worker,
+            args=(worker_id, worker_end, port, None if metrics_port is None else metrics_port + worker_id,
+                  history) + self.worker_args
+        )
+        process.daemon = True
+        process.start()
+        worker_end.close()
+        return _WorkerLink(worker_id, process, hub_end)
+
+    def host(self, port, metrics_port=None, history=None, paste_policy=POLICY_FIFO):
+        # Holding the port while the workers start also picks it when asked for any free one
+        try:
+            port_holder = make_listening_socket(port, True)
+        except socket.error as se:
+            self.logger.error('{0}: {1}'.format(se.__class__.__name__, str(se)))
+            raise ConnectionBroken
+
+        if history is not None:
+            try:
+                history.open()
+                self.history = history
+            except (IOError, OSError) as exc:
+                self.logger.error('Paste history failed in {0}, running without: {1}'.format(
+                    history.directory, str(exc)))
+
+        try:
+            port = port_holder.getsockname()[1]
+            self.links = [self._start_worker(worker_id, port, metrics_port)
+                          for worker_id in xrange(self.worker_count)]
+            replies = [link.bus.recv() for link in self.links]
+        finally:
+            port_holder.close()
+
+        self.paste_policy = paste_policy
+        self.paste_timers.start()
+        self.cluster_running.set()
+        if any(kind != 'ready' for kind, _address in replies):
+            self.logger.error('Hosting failed in a worker, shutting the cluster down.')
+            self.close_server()
+            raise ConnectionBroken
+
+        for link in self.links:
+            reader_thread = threading.Thread(target=self._read_bus, args=(link,))
+            reader_thread.daemon = True
+            reader_thread.start()
+            self.reader_threads.append(reader_thread)
+        self.logger.info('Cluster of {0} workers running on port {1}.'.format(self.worker_count, port))
+        return replies[0][1]
+
+    def _open_room(self, room_name):
+        with self.rooms_lock:
+            room = self.rooms.get(room_name)
+            if room is None:
+                room = self.rooms[room_name] = Room(room_name)
+                self.members[room_name] = dict()
+                room.leases = PasteLeases(
+                    self.paste_timers, self.max_paste_time,
+                    lambda requester, requested_at: self._grant_paste_permission(room, requester, requested_at),
+                    lambda requester: self._paste_lease_expired(room, requester),
+                    self.paste_policy)
+            return room
+
+    def _grant_paste_permission(self, room, requester, requested_at):
+        worker_id, token = requester
+        link = self.links[worker_id]
+        if not link.alive:
+            return False
+        link.send(('grant', room.name, token, requested_at))
+        return True
+
+    def _paste_lease_expired(self, room, requester):
+        worker_id, token = requester
+        self.links[worker_id].send(('expired', room.name, token))
+
+    def _relay(self, sender_link, message):
+        for link in self.links:
+            if link is not sender_link:
+                link.send(message)
+
+    def _member_joined(self, link, room_name, member_id, nickname):
+        with self.rooms_lock:
+            self._open_room(room_name)
+            self.members[room_name][member_id] = link.worker_id
+            # Sent under the lock, so every worker sees the joins and leaves in the same order
+            self._relay(link, ('member_joined', room_name, member_id, nickname))
+
+    def _members_left(self, link, room_name, member_ids):
+        '''Tells the other workers the members left, and closes the room once it's empty everywhere'''
+        closed_room = None
+        with self.rooms_lock:
+            members = self.members.get(room_name)
+            if members is None:
+                return
+            for member_id in member_ids:
+                if members.pop(member_id, None) is not None:
+                    self._relay(link, ('member_left', room_name, member_id))
+            if not members:
+                closed_room = self.rooms.pop(room_name)
+                del self.members[room_name]
+
+        if closed_room is not None:
+            closed_room.close()
+
+    def _record_paste(self, room_name, nickname, text, version, incremental_package):
+        base_version = changes = None
+        if incremental_package is not None and incremental_package['type'] == PKG_PASTE_DELTA:
+            base_version, changes = self.packager.unpack_paste_delta(incremental_package['data'])
+        try:
+            self.history.append(room_name, nickname, text, version, base_version=base_version, changes=changes)
+        except (IOError, OSError) as exc:
+            self.logger.error('Writing the paste history failed: {0}'.format(str(exc)))
+
+    def _handle_message(self, link, message):
+        kind = message[0]
+        if kind == 'paste' and self.history is not None:
+            # Logged before the relay, so the other workers find it when their rooms reopen
+            self._record_paste(*message[1:])
+        if kind in RELAYED_MESSAGES:
+            self._relay(link, message)
+        elif kind == 'member_joined':
+            self._member_joined(link, *message[1:])
+        elif kind == 'member_left':
+            self._members_left(link, message[1], [message[2]])
+        elif kind == 'paste_request':
+            self._open_room(message[1]).leases.request((link.worker_id, message[2]), message[3])
+        elif kind in ('release', 'withdraw', 'activity', 'renew'):
+            room = self.rooms.get(message[1])
+            if room is None:
+                return
+            requester = (link.worker_id, message[2])
+            if kind == 'release':
+                room.leases.release(requester)
+            elif kind == 'withdraw':
+                room.leases.withdraw(requester)
+            elif kind == 'activity':
+                room.leases.extend(requester)
+            else:
+                link.send(('renewed', room.name, message[2], room.leases.renew(requester)))
+
+    def _read_bus(self, link):
+        while True:
+            try:
+                message = link.bus.recv()
+            except (EOFError, IOError):
+                break
+            self._handle_message(link, message)
+
+        link.alive = False
+        if not self.running:
+            return
+        self.logger.error('Worker {0} exited.'.format(link.worker_id))
+        with self.rooms_lock:
+            for room_name, members in self.members.items():
+                self._members_left(link, room_name, [member_id for member_id, worker_id in members.items()
+                                                     if worker_id == link.worker_id])
+        for room in self.rooms.values():
+            for requester in room.leases.requesters():
+                if requester[0] == link.worker_id:
+                    room.leases.withdraw(requester)
+        if not any(other.alive for other in self.links):
+            self.cluster_running.clear()
+
+    def close_server(self):
+        self.cluster_running.clear()
+        with self.rooms_lock:
+            rooms, self.rooms, self.members = self.rooms.values(), dict(), dict()
+        for room in rooms:
+            room.close()
+        for link in self.links:
+            link.send(('stop',))
+        for link in self.links:
+            link.process.join()
+            link.close()
+        for reader_thread in self.reader_threads:
+            reader_thread.join()
+        self.paste_timers.stop()
+        if self.history is not None:
+            self.history.close()
+            self.history = None
+        self.links = []
+        self.reader_threads = []
+        self.logger.info('Cluster closed.')
@@ -8,10 +8,21 @@ from Tkinter import (Frame, PanedWindow, Button, Label, Entry, Text, Listbox, Sc
                      NONE, BOTH, HORIZONTAL, VERTICAL, LEFT, RIGHT, TOP, BOTTOM, X, Y,
                      WORD, INSERT, END, NORMAL, DISABLED)
 from ttk import Style
+from Queue import Queue, Empty
 
 import re
 
 
+# Milliseconds between two drains of the network events, and the most handled in one go
+DISPATCH_INTERVAL = 50
+DISPATCH_BATCH = 500
+
+# Characters of a paste written to the pastebox per tick of the event loop
+PASTE_CHUNK = 1 << 16
+# A lazily rendered paste gets its next chunk once the view shows past this share of what is rendered
+LAZY_RENDER_THRESHOLD = 0.9
+
+
 class InvalidIPAddress(Exception):
     pass
 
@@ -27,11 +38,49 @@ class InvalidNickName(Exception):
 
 class UIFrame(Frame):
 
-    def __init__(self, min_port_number, parent):
+    def __init__(self, min_port_number, chat_scrollback, large_paste_size, parent):
         Frame.__init__(self, parent, background='white')  
         self.parent = parent
         self.min_port_number = min_port_number
+        # Lines kept in the chatbox, the oldest are trimmed once a tenth more came in
+        self.chat_scrollback = chat_scrollback
+        # Member ids of the client list rows, in the same order
+        self.client_ids = []
+        # (handler, args) of the events the network threads raised, handled on the Tk thread
+        self.events = Queue()
+        # Chat lines waiting to be written to the chatbox together
+        self.chat_lines = []
+        # Pastes of more characters are rendered as the view scrolls down, and read-only until they all are
+        self.large_paste_size = large_paste_size
+        # The paste last received, None once the pastebox was edited or cleared, the characters of it
+        # written to the pastebox so far and the pending call writing more
+        self.paste_source = None
+        self.paste_rendered = 0
+        self.paste_loader = None
+        self.paste_lazy = False
+        self.paste_permission = DISABLED
         self._setup_ui()
+        self.after(DISPATCH_INTERVAL, self._dispatch_events)
+
+    def threadsafe(self, handler):
+        '''Wraps a handler, so calling it from any thread queues the call for the Tk thread'''
+        def queue_call(*args):
+            self.events.put((handler, args))
+        return queue_call
+
+    def _dispatch_events(self):
+        '''Handles the queued events, the chat lines among them reach the chatbox in one update'''
+        try:
+            for _index in xrange(DISPATCH_BATCH):
+                try:
+                    handler, args = self.events.get_nowait()
+                except Empty:
+                    break
+                handler(*args)
+            self._flush_chat()
+        finally:
+            # A full batch leaves the rest for right after Tk had a chance to redraw
+            self.after(1 if not self.events.empty() else DISPATCH_INTERVAL, self._dispatch_events)
     
     def _setup_ui(self):
         self.parent.title('p2paste')
@@ -62,6 +111,16 @@ class UIFrame(Frame):
         self.button_host.pack(side=LEFT, padx=2, pady=2)
         self.button_close_server = Button(frame_top, text="close server")
         self.button_close_server.pack(side=LEFT, padx=2)
+        label_room = Label(frame_top, text="room:")
+        label_room.pack(side=LEFT, padx=2, pady=2)
+        self.entry_room = Entry(frame_top, width=12)
+        self.entry_room.pack(side=LEFT, padx=2, pady=2)
+        self.button_join_room = Button(frame_top, text="join")
+        self.button_join_room.pack(side=LEFT, padx=2)
+        self.button_leave_room = Button(frame_top, text="leave")
+        self.button_leave_room.pack(side=LEFT, padx=2)
+        self.label_rooms = Label(frame_top, text="")
+        self.label_rooms.pack(side=LEFT, padx=2, pady=2)
         
         '''Bottom frame with a PanedWindow, the main screen part'''
         frame_bottom = Frame(self)
@@ -107,20 +166,24 @@ class UIFrame(Frame):
         self.button_paste_pastebox.pack(side=LEFT, padx=2, pady=2)
         self.button_send_pastebox = Button(frame_paste_controls, text="send")
         self.button_send_pastebox.pack(side=LEFT, padx=2, pady=2)
+        self.button_cancel_pastebox = Button(frame_paste_controls, text="cancel")
+        self.button_cancel_pastebox.pack(side=LEFT, padx=2, pady=2)
+        self.label_paste_progress = Label(frame_paste_controls, text="")
+        self.label_paste_progress.pack(side=LEFT, padx=2, pady=2)
         '''Pastebox with scrollbars'''
         sbx_text_paste = Scrollbar(frame_paste, orient=HORIZONTAL)
         sbx_text_paste.pack(side=BOTTOM, fill=X, padx=2)
-        sby_text_paste = Scrollbar(frame_paste)
-        sby_text_paste.pack(side=RIGHT, fill=Y, pady=2)
+        self.sby_text_paste = Scrollbar(frame_paste)
+        self.sby_text_paste.pack(side=RIGHT, fill=Y, pady=2)
         self.text_paste = Text(
             frame_paste,
             wrap=NONE,
             xscrollcommand=sbx_text_paste.set,
-            yscrollcommand=sby_text_paste.set
+            yscrollcommand=self._paste_scrolled
         )
         self.text_paste.pack(fill=BOTH, expand=True, padx=2, pady=2)
         sbx_text_paste.config(command=self.text_paste.xview)
-        sby_text_paste.config(command=self.text_paste.yview)
+        self.sby_text_paste.config(command=self.text_paste.yview)
         pw_center.add(frame_paste)
         self.pastebox_disabled()
         
@@ -147,10 +210,26 @@ class UIFrame(Frame):
         pw_main.add(frame_chatlist)
 
     def _message_to_chatbox(self, message):
+        # Written once the events at hand are handled, or once the Tk thread is idle
+        if not self.chat_lines:
+            self.after_idle(self._flush_chat)
+        self.chat_lines.append(message)
+
+    def _flush_chat(self):
+        if not self.chat_lines:
+            return
+        lines, self.chat_lines = self.chat_lines, []
+        # Scrolled up to read something, the view stays where it is
+        following = self.text_chat.yview()[1] >= 1.0
         self.text_chat.config(state=NORMAL)
-        self.text_chat.insert(END, '{0}\n'.format(message))
-        self.text_chat.yview(END)                    
+        self.text_chat.insert(END, u''.join(u'{0}\n'.format(line) for line in lines))
+        line_count = int(self.text_chat.index('end-1c').split('.')[0])
+        # The text always ends with an empty line
+        if line_count - 1 > self.chat_scrollback + self.chat_scrollback // 10:
+            self.text_chat.delete('1.0', '{0}.0'.format(line_count - self.chat_scrollback))
         self.text_chat.config(state=DISABLED)
+        if following:
+            self.text_chat.yview(END)
         
     def log_error(self, message):
         message = '^ERROR: {0}'.format(message)
@@ -214,34 +293,160 @@ class UIFrame(Frame):
         port_entered = self.entry_port.get()
         return self._validate_port(port_entered)
 
+    def get_room_name(self):
+        return self.entry_room.get().strip()
+
+    def set_rooms(self, room, joined_rooms):
+        '''Lists the joined rooms, the one shown in brackets'''
+        names = ['[{0}]'.format(name) if name == room else name for name in joined_rooms]
+        self.label_rooms.config(text=' '.join(names))
+
     def get_chat_message(self):
         message = self.entry_chat.get()
         self.entry_chat.delete(0, END)
         return message
                 
     def add_chat_message(self, sender, message):
-        self._message_to_chatbox('{0}: {1}'.format(sender, message))
+        self._message_to_chatbox(u'{0}: {1}'.format(sender, message))
     
     def clear_client_list(self):
         self.listbox_clients.delete(0, END)
+        self.client_ids = []
     
     def set_client_list(self, sender, client_list):
+        '''Replaces the list with the (member id, nickname) pairs'''
         self.clear_client_list()
-        for nickname in client_list:
+        for member_id, nickname in client_list:
+            self.client_ids.append(member_id)
+            self.listbox_clients.insert(END, nickname)
+
+    def update_client_list(self, sender, joined, left):
+        '''Removes the rows of the members that left and adds the ones that joined, the rest stay put'''
+        for member_id in left:
+            if member_id in self.client_ids:
+                index = self.client_ids.index(member_id)
+                del self.client_ids[index]
+                self.listbox_clients.delete(index)
+        for member_id, nickname in joined:
+            self.client_ids.append(member_id)
             self.listbox_clients.insert(END, nickname)
     
+    def _paste_edited(self):
+        return bool(int(self.text_paste.edit_modified()))
+
+    def _paste_pending(self):
+        '''Whether part of the paste is still to be written to the pastebox'''
+        return self.paste_source is not None and self.paste_rendered < len(self.paste_source)
+
     def get_paste_data(self):
-        return self.text_paste.get(1.0, END)
-    
+        # A paste shown as it came in is sent as it is, rather than read back out of the widget
+        if self.paste_source is not None and not self._paste_edited():
+            return self.paste_source
+        # The Text widget always ends with an extra newline, which is not part of the paste
+        return self.text_paste.get(1.0, 'end-1c')
+
+    def _cancel_paste_load(self):
+        if self.paste_loader is not None:
+            self.after_cancel(self.paste_loader)
+            self.paste_loader = None
+
     def set_paste_data(self, sender, paste_data):
+        '''Shows a paste, the first chunk right away and the rest over the next ticks, or as the view scrolls down'''
+        self._cancel_paste_load()
+        self.paste_source = paste_data
+        self.paste_rendered = 0
+        self.paste_lazy = len(paste_data) > self.large_paste_size
         self.text_paste.config(state=NORMAL)
         self.text_paste.delete(1.0, END)
-        self.text_paste.insert(END, paste_data)
+        self._render_paste_chunk()
+        self.clear_paste_notification()
+
+    def _render_paste_chunk(self):
+        self.paste_loader = None
+        source = self.paste_source
+        start = self.paste_rendered
+        end = min(len(source), start + PASTE_CHUNK)
+        # Chunks end with a whole line, unless the line alone is longer than a chunk
+        if end < len(source):
+            line_end = source.rfind(u'\n', start, end)
+            if line_end > start:
+                end = line_end + 1
+        self.text_paste.config(state=NORMAL)
+        self.text_paste.insert(END, source[start:end])
+        self.paste_rendered = end
+        self.text_paste.edit_modified(False)
+        if self._paste_pending() and not self.paste_lazy:
+            self.paste_loader = self.after(1, self._render_paste_chunk)
+        self._paste_render_state()
+
+    def _paste_render_state(self):
+        '''The pastebox is read-only and the progress shown until the whole paste is rendered'''
+        if not self._paste_pending():
+            self.text_paste.config(state=self.paste_permission)
+            self.label_paste_progress.config(text='')
+            return
         self.text_paste.config(state=DISABLED)
+        percent = 100 * self.paste_rendered // len(self.paste_source)
+        if self.paste_lazy:
+            self.label_paste_progress.config(text='showing {0}%, scroll for more'.format(percent))
+        else:
+            self.label_paste_progress.config(text='loading: {0}%'.format(percent))
+
+    def _paste_scrolled(self, first, last):
+        self.sby_text_paste.set(first, last)
+        # Nearing the end of a lazily rendered paste renders the next chunk
+        if self.paste_loader is None and self._paste_pending() and float(last) >= LAZY_RENDER_THRESHOLD:
+            self.paste_loader = self.after_idle(self._render_paste_chunk)
+
+    def apply_paste_changes(self, sender, changes, paste_data):
+        '''
+        Redraws only the changed parts of the pastebox, last change first so earlier offsets stay valid.
+        A pastebox edited or cleared since doesn't hold the text the changes are to, paste_data is shown instead.
+        '''
+        if self.paste_source is None or self._paste_edited():
+            self.set_paste_data(sender, paste_data)
+            return
+        # Changes past what is rendered so far only change the paste, it is rendered changed
+        partial = self._paste_pending()
+        self.paste_source = paste_data
+        rendered = self.paste_rendered
+        self.text_paste.config(state=NORMAL)
+        for start, end, replacement in reversed(changes):
+            start_index = '1.0 + {0} chars'.format(start)
+            if partial:
+                if start >= rendered:
+                    continue
+                if end > rendered:
+                    self.text_paste.delete(start_index, END)
+                    rendered = start
+                    continue
+            self.text_paste.delete(start_index, '1.0 + {0} chars'.format(end))
+            self.text_paste.insert(start_index, replacement)
+            rendered += len(replacement) - (end - start)
+        self.paste_rendered = rendered
+        self.text_paste.edit_modified(False)
+        self._paste_render_state()
         self.clear_paste_notification()
 
+    def set_paste_progress(self, sender, transferred, total_size):
+        if transferred >= total_size:
+            self.label_paste_progress.config(text='')
+            return
+        percent = 100 * transferred // max(total_size, 1)
+        self.label_paste_progress.config(text='{0}: {1}%'.format(sender, percent))
+
+    def paste_aborted(self, sender, paste_id):
+        self.label_paste_progress.config(text='')
+        self.log_info('Paste of {0} was cancelled.'.format(sender))
+
     def clear_pastebox(self, event):
+        if self.paste_permission == DISABLED:
+            return
+        self._cancel_paste_load()
+        self.paste_source = None
+        self.text_paste.config(state=NORMAL)
         self.text_paste.delete(1.0, END)
+        self.label_paste_progress.config(text='')
 
     def selectall_pastebox(self, event):
         self.text_paste.tag_add('sel', 1.0, END)
@@ -260,7 +465,19 @@ class UIFrame(Frame):
     def copy_chat(self, event):
         self._copy_from(self.text_chat)
 
+    def _paste_all_selected(self):
+        try:
+            return (self.text_paste.compare('sel.first', '==', 1.0) and
+                    self.text_paste.compare('sel.last', '>=', 'end-1c'))
+        except TclError:
+            return False
+
     def copy_pastebox(self, event):
+        # All of a partly rendered paste selected copies what isn't rendered yet too
+        if self._paste_pending() and self._paste_all_selected():
+            self.clipboard_clear()
+            self.clipboard_append(self.paste_source)
+            return
         self._copy_from(self.text_paste)
     
     def paste_pastebox(self, event):
@@ -271,7 +488,8 @@ class UIFrame(Frame):
         self.button_clear_pastebox.config(state=state)
         self.button_paste_pastebox.config(state=state)
         self.button_send_pastebox.config(state=state)
-        self.text_paste.config(state=state)
+        self.paste_permission = state
+        self.text_paste.config(state=DISABLED if self._paste_pending() else state)
         request_state = NORMAL if state == DISABLED else DISABLED
         self.button_request_paste.config(state=request_state)
     
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+'''
+Paste history, an append-only log of every published blackboard version
+
+The log is a directory of segment files, each named after the id of its first
+paste. A record is a header followed by the utf-8 room name, sender and body:
+
+    crc32 of the rest | paste id | timestamp | version | base paste id | length | room size | sender size | body size
+
+The body is the utf-8 text of the paste when the base paste id is 0. Otherwise it is
+the changes, as JSON, that turn the text of the base paste, the room's previous one,
+into this one. A small edit of a large paste only logs the edit. Every
+SNAPSHOT_INTERVAL versions, and at the start of every segment, the whole text is
+logged again, so reading a paste applies a bounded number of changes and the
+retention never drops the base of a kept paste. The length is the paste's
+number of characters.
+
+The records are indexed in memory by paste id and timestamp, per room, and the
+index is rebuilt by scanning the segments on open. A torn record at the end of the
+last segment, left by a crash in the middle of an append, is cut off. The bodies
+stay on disk and are read through mmap, so paging through a long history never
+loads it into the heap.
+
+Once the log grows past the retention size, or its oldest segment past the
+retention age, the oldest segments are deleted whenever a new segment is started.
+The segment being written is always kept.
+
+One process writes the log. Any number of followers may read it from other
+processes, see PasteHistory.follower and refresh.
+'''
+
+from p2paste.blackboard import apply_changes
+import threading
+import bisect
+import json
+import struct
+import mmap
+import zlib
+import time
+import os
+
+
+RECORD_HEADER = struct.Struct('>IQdQQIHHI')
+CRC_SIZE = 4
+SEGMENT_SUFFIX = '.log'
+# Most entries a history page may have
+MAX_PAGE_SIZE = 50
+# Most versions of a room logged as changes in a row, before its whole text is logged again
+SNAPSHOT_INTERVAL = 32
+
+
+class HistoryEntry(object):
+    '''
+    Index entry of a paste, position and size locate its body in the segment. Depth is the
+    number of changes logged since the room's last whole text, 0 for a whole text.
+    '''
+
+    __slots__ = ('paste_id', 'timestamp', 'version', 'base', 'length', 'room', 'sender', 'segment', 'position',
+                 'size', 'depth')
+
+    def __init__(self, paste_id, timestamp, version, base, length, room, sender, segment, position, size, depth=0):
+        self.paste_id = paste_id
+        self.timestamp = timestamp
+        self.version = version
+        self.base = base
+        self.length = length
+        self.room = room
+        self.sender = sender
+        self.segment = segment
+        self.position = position
+        self.size = size
+        self.depth = depth
+
+
+class _RoomIndex(object):
+    '''Entries of one room in paste id order, with the keys kept apart for bisect'''
+
+    def __init__(self):
+        self.paste_ids = []
+        self.timestamps = []
+        self.entries = []
+
+    def add(self, entry):
+        self.paste_ids.append(entry.paste_id)
+        self.timestamps.append(entry.timestamp)
+        self.entries.append(entry)
+
+    def end_before(self, paste_id=None, timestamp=None):
+        '''Number of entries older than the paste id, or written before the timestamp'''
+        if paste_id is not None:
+            return bisect.bisect_left(self.paste_ids, paste_id)
+        if timestamp is not None:
+            return bisect.bisect_left(self.timestamps, timestamp)
+        return len(self.entries)
+
+
+class PasteHistory(object):
+
+    def __init__(self, logger, directory, segment_size, max_bytes=None, max_age=None, writable=True):
+        self.logger = logger
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.writable = writable
+        self.lock = threading.Lock()
+
+        # First paste ids of the segments, oldest first, and the bytes indexed of each
+        self.segments = []
+        self.segment_sizes = dict()
+        self.maps = dict()
+        self.paste_ids = []
+        self.entries = []
+        self.rooms = dict()
+        self.active_file = None
+        self.next_paste_id = 1
+
+    def follower(self):
+        '''Unopened read-only history of the same log, for another process'''
+        return PasteHistory(self.logger, self.directory, self.segment_size, self.max_bytes, self.max_age, False)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, '{0:020d}{1}'.format(segment, SEGMENT_SUFFIX))
+
+    def _list_segments(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in names
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def _map(self, segment, size):
+        '''Read-only map of at least the first size bytes of the segment, remapped as the segment grows'''
+        segment_map = self.maps.get(segment)
+        if segment_map is not None and len(segment_map) >= size:
+            return segment_map
+        if segment_map is not None:
+            segment_map.close()
+            del self.maps[segment]
+        with open(self._segment_path(segment), 'rb') as segment_file:
+            size = max(size, os.fstat(segment_file.fileno()).st_size)
+            segment_map = self.maps[segment] = mmap.mmap(segment_file.fileno(), size, access=mmap.ACCESS_READ)
+        return segment_map
+
+    def _find(self, paste_id):
+        index = bisect.bisect_left(self.paste_ids, paste_id)
+        if index == len(self.entries) or self.paste_ids[index] != paste_id:
+            return None
+        return self.entries[index]
+
+    def _index(self, entry):
+        if entry.base:
+            base_entry = self._find(entry.base)
+            entry.depth = 0 if base_entry is None else base_entry.depth + 1
+        self.paste_ids.append(entry.paste_id)
+        self.entries.append(entry)
+        room_index = self.rooms.get(entry.room)
+        if room_index is None:
+            room_index = self.rooms[entry.room] = _RoomIndex()
+        room_index.add(entry)
+        self.next_paste_id = entry.paste_id + 1
+
+    def _scan_segment(self, segment):
+        '''Indexes the records appended to the segment since the last scan, returns its size on disk'''
+        try:
+            file_size = os.path.getsize(self._segment_path(segment))
+        except OSError:
+            return 0
+        position = self.segment_sizes[segment]
+        if file_size <= position:
+            return file_size
+
+        segment_map = self._map(segment, file_size)
+        while position + RECORD_HEADER.size <= file_size:
+            (crc, paste_id, timestamp, version, base, length, room_size, sender_size,
+             body_size) = RECORD_HEADER.unpack_from(segment_map, position)
+            names_position = position + RECORD_HEADER.size
+            body_position = names_position + room_size + sender_size
+            record_end = body_position + body_size
+            if record_end > file_size or zlib.crc32(segment_map[position + CRC_SIZE:record_end]) & 0xffffffff != crc:
+                # Torn, or still being written by another process
+                break
+            room = segment_map[names_position:names_position + room_size].decode('utf-8')
+            sender = segment_map[names_position + room_size:body_position].decode('utf-8')
+            self._index(HistoryEntry(paste_id, timestamp, version, base, length, room, sender, segment, body_position,
+                                     body_size))
+            position = record_end
+
+        self.segment_sizes[segment] = position
+        return file_size
+
+    def _forget_segments(self, segments):
+        for segment in segments:
+            self.segments.remove(segment)
+            del self.segment_sizes[segment]
+            segment_map = self.maps.pop(segment, None)
+            if segment_map is not None:
+                segment_map.close()
+
+        entries, self.paste_ids, self.entries, self.rooms = self.entries, [], [], dict()
+        for entry in entries:
+            if entry.segment not in segments:
+                self._index(entry)
+
+    def _scan(self):
+        on_disk = self._list_segments()
+        removed = [segment for segment in self.segments if segment not in on_disk]
+        if removed:
+            self._forget_segments(removed)
+
+        file_size = 0
+        for segment in on_disk:
+            if segment not in self.segment_sizes:
+                self.segments.append(segment)
+                self.segment_sizes[segment] = 0
+            file_size = self._scan_segment(segment)
+        return file_size
+
+    def _apply_retention(self):
+        now = time.time()
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            # The oldest segment ends where the next one begins
+            oldest_end = bisect.bisect_left(self.paste_ids, self.segments[1])
+            newest_timestamp = self.entries[oldest_end - 1].timestamp if oldest_end else 0
+            too_large = self.max_bytes is not None and sum(self.segment_sizes.values()) > self.max_bytes
+            too_old = self.max_age is not None and newest_timestamp < now - self.max_age
+            if not too_large and not too_old:
+                break
+            os.remove(self._segment_path(oldest))
+            self._forget_segments([oldest])
+            self.logger.info('History segment {0} dropped by the retention.'.format(oldest))
+
+    def _cut_back(self, segment):
+        '''
+        Cuts off what a failed append wrote of its record, and whatever is still buffered of it. Left
+        without an active file if that fails too, the next append tries again.
+        '''
+        active_file, self.active_file = self.active_file, None
+        if active_file is not None:
+            try:
+                active_file.close()
+            except (IOError, OSError):
+                # The buffer is dropped with the file anyway
+                pass
+        active_file = open(self._segment_path(segment), 'ab')
+        active_file.truncate(self.segment_sizes[segment])
+        self.active_file = active_file
+
+    def _start_segment(self):
+        if self.active_file is not None:
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+            self.active_file.close()
+        segment = self.next_paste_id
+        self.segments.append(segment)
+        self.segment_sizes[segment] = 0
+        self.active_file = open(self._segment_path(segment), 'ab')
+        self._apply_retention()
+
+    def open(self):
+        '''Indexes the log, raises IOError or OSError when it can't be read or written'''
+        with self.lock:
+            if not self.writable:
+                self._scan()
+                return
+
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            file_size = self._scan()
+            if self.segments:
+                last_segment = self.segments[-1]
+                self.active_file = open(self._segment_path(last_segment), 'ab')
+                if file_size > self.segment_sizes[last_segment]:
+                    self.logger.error('Torn record cut off the end of history segment {0}.'.format(last_segment))
+                    self.active_file.truncate(self.segment_sizes[last_segment])
+            if not self.segments or self.segment_sizes[self.segments[-1]] >= self.segment_size:
+                self._start_segment()
+            else:
+                self._apply_retention()
+            self.logger.info('History of {0} pastes opened in {1}.'.format(len(self.entries), self.directory))
+
+    def refresh(self):
+        '''Indexes what the writer appended since, followers only'''
+        if self.writable:
+            return
+        with self.lock:
+            self._scan()
+
+    def _delta_base(self, room, segment, base_version, changes, changes_data, length):
+        '''The room's latest entry, if the changes are to be logged against it, or else None'''
+        room_index = self.rooms.get(room)
+        if room_index is None or changes_data is None:
+            return None
+        latest = room_index.entries[-1]
+        if latest.version != base_version or latest.segment != segment or latest.depth + 1 >= SNAPSHOT_INTERVAL:
+            return None
+        # Changes as large as the text are better off as the text
+        if len(changes_data) >= length:
+            return None
+        # A room reopened without its history starts over, and may repeat a version with another text
+        if latest.length + sum(len(replacement) - (end - start) for start, end, replacement in changes) != length:
+            return None
+        return latest
+
+    def append(self, room, sender, text, version, timestamp=None, base_version=None, changes=None):
+        '''
+        Writes a published blackboard version to the log, returns its entry. A version made by
+        changes to base_version is logged as the changes, if the room's latest entry is that version.
+        '''
+        room_data = room.encode('utf-8')
+        sender_data = sender.encode('utf-8')
+        changes_data = None if changes is None else json.dumps(changes)
+        with self.lock:
+            segment = self.segments[-1]
+            if self.active_file is None:
+                self._cut_back(segment)
+            if self.segment_sizes[segment] >= self.segment_size:
+                self._start_segment()
+                segment = self.segments[-1]
+
+            base_entry = self._delta_base(room, segment, base_version, changes, changes_data, len(text))
+            if base_entry is None:
+                base, body_data = 0, text.encode('utf-8')
+            else:
+                base, body_data = base_entry.paste_id, changes_data
+            paste_id = self.next_paste_id
+            timestamp = time.time() if timestamp is None else timestamp
+            header = RECORD_HEADER.pack(0, paste_id, timestamp, version, base, len(text), len(room_data),
+                                        len(sender_data), len(body_data))[CRC_SIZE:]
+            crc = zlib.crc32(body_data, zlib.crc32(room_data + sender_data, zlib.crc32(header))) & 0xffffffff
+            # Written piece by piece, the text can be large
+            try:
+                self.active_file.write(struct.pack('>I', crc))
+                self.active_file.write(header)
+                self.active_file.write(room_data + sender_data)
+                self.active_file.write(body_data)
+                self.active_file.flush()
+            except (IOError, OSError):
+                # A partial record would shift every later one off its indexed position
+                self._cut_back(segment)
+                raise
+
+            position = self.segment_sizes[segment]
+            body_position = position + RECORD_HEADER.size + len(room_data) + len(sender_data)
+            self.segment_sizes[segment] = body_position + len(body_data)
+            entry = HistoryEntry(paste_id, timestamp, version, base, len(text), room, sender, segment, body_position,
+                                 len(body_data))
+            self._index(entry)
+            return entry
+
+    def latest(self, room):
+        with self.lock:
+            room_index = self.rooms.get(room)
+            return room_index.entries[-1] if room_index else None
+
+    def page(self, room, before=None, before_time=None, limit=MAX_PAGE_SIZE):
+        '''Entries of the room older than the paste id before, or the timestamp before_time, newest first'''
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        with self.lock:
+            room_index = self.rooms.get(room)
+            if room_index is None:
+                return []
+            end = room_index.end_before(before, before_time)
+            return room_index.entries[max(0, end - limit):end][::-1]
+
+    def _read_body(self, entry):
+        if entry.segment not in self.segment_sizes:
+            return None
+        try:
+            segment_map = self._map(entry.segment, entry.position + entry.size)
+        except (IOError, OSError):
+            # Deleted by the writer since the last refresh
+            return None
+        return segment_map[entry.position:entry.position + entry.size]
+
+    def read(self, entry):
+        '''Text of the entry, None once the retention dropped it'''
+        with self.lock:
+            # Back to the last whole text, then its changes are applied in order
+            deltas = []
+            while entry is not None and entry.base:
+                deltas.append(entry)
+                entry = self._find(entry.base)
+            body = None if entry is None else self._read_body(entry)
+            if body is None:
+                return None
+            text = body.decode('utf-8')
+            for delta in reversed(deltas):
+                changes_data = self._read_body(delta)
+                if changes_data is None:
+                    return None
+                text = apply_changes(text, json.loads(changes_data))
+            return text
+
+    def find(self, room, paste_id):
+        with self.lock:
+            entry = self._find(paste_id)
+            return entry if entry is not None and entry.room == room else None
+
+    def close(self):
+        with self.lock:
+            if self.active_file is not None:
+                self.active_file.flush()
+                os.fsync(self.active_file.fileno())
+                self.active_file.close()
+                self.active_file = None
+            for segment_map in self.maps.values():
+                segment_map.close()
+            self.maps = dict()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+'''
+Paste permission leases
+
+The paste permission of a room is leased to one requester at a time. PasteLeases
+keeps the waiting requesters, one request each, and hands the lease on as soon as
+the holder pastes, gives it back, leaves or lets it expire. The lease timers of
+every room run on one TimerWheel, so no thread is parked waiting for a paste.
+'''
+
+from collections import OrderedDict
+import threading
+import math
+import time
+
+
+# First come, first served
+POLICY_FIFO = 'fifo'
+# Whoever had the lease least recently goes first, and the holder can't renew while others wait
+POLICY_FAIR = 'fair'
+POLICIES = (POLICY_FIFO, POLICY_FAIR)
+
+# Seconds per tick, and ticks per turn of the timer wheel
+TIMER_TICK = 0.05
+TIMER_SLOTS = 512
+
+
+class Timer(object):
+
+    __slots__ = ('slot', 'rounds', 'callback', 'args')
+
+    def __init__(self, slot, rounds, callback, args):
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+
+
+class TimerWheel(object):
+    '''Hashed timer wheel, scheduling and cancelling are O(1) and one thread fires every timer'''
+
+    def __init__(self, logger, tick=TIMER_TICK, slot_count=TIMER_SLOTS, dispatch=None):
+        self.logger = logger
+        # Given every due callback and its args instead of calling it, to run it on another thread
+        self.dispatch = dispatch
+        self.tick = tick
+        self.slots = [set() for _ in xrange(slot_count)]
+        self.cursor = 0
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self._run, name='TimerWheel')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def schedule(self, delay, callback, *args):
+        '''
+        Calls callback(*args) from the wheel's thread, or hands it to dispatch, in delay seconds
+        rounded up to the next tick
+        '''
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        with self.lock:
+            slot = (self.cursor + ticks) % len(self.slots)
+            timer = Timer(slot, (ticks - 1) // len(self.slots), callback, args)
+            self.slots[slot].add(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            self.slots[timer.slot].discard(timer)
+
+    def _advance(self):
+        with self.lock:
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            slot = self.slots[self.cursor]
+            due = [timer for timer in slot if not timer.rounds]
+            slot.difference_update(due)
+            for timer in slot:
+                timer.rounds -= 1
+
+        for timer in due:
+            try:
+                if self.dispatch is None:
+                    timer.callback(*timer.args)
+                else:
+                    self.dispatch(timer.callback, *timer.args)
+            except Exception:
+                self.logger.exception('Timer callback failed.')
+
+    def _run(self):
+        next_tick = time.time() + self.tick
+        while self.running.is_set():
+            delay = next_tick - time.time()
+            if delay > self.tick:
+                # The clock was set back
+                next_tick = time.time() + self.tick
+                delay = self.tick
+            if delay > 0:
+                time.sleep(delay)
+            next_tick += self.tick
+            self._advance()
+
+
+class PasteLeases(object):
+    '''
+    Paste permission queue of a room. grant(requester, requested_at) is called as a requester
+    gets the lease, and returns False if it couldn't be told. expire(requester) is called when
+    a lease runs out. Both are called with the queue locked, and may call back into it.
+    '''
+
+    def __init__(self, timers, lease_time, grant, expire, policy=POLICY_FIFO):
+        self.timers = timers
+        self.lease_time = lease_time
+        self.grant = grant
+        self.expire = expire
+        self.policy = policy
+        # Requester -> time of its request, in the order of the requests
+        self.waiting = OrderedDict()
+        # Requester -> time it last got the lease, for the fair policy
+        self.last_granted = dict()
+        self.holder = None
+        self.timer = None
+        self.lease_id = 0
+        self.lock = threading.RLock()
+        self.open = True
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def requesters(self):
+        with self.lock:
+            return ([] if self.holder is None else [self.holder]) + list(self.waiting)
+
+    def request(self, requester, requested_at):
+        '''Queues the request, False if the requester already holds or waits for the lease'''
+        with self.lock:
+            if not self.open or requester == self.holder or requester in self.waiting:
+                return False
+            self.waiting[requester] = requested_at
+            self._grant_next()
+            return True
+
+    def withdraw(self, requester):
+        '''Drops the request of a requester that left, or ends its lease'''
+        with self.lock:
+            self.last_granted.pop(requester, None)
+            if requester in self.waiting:
+                del self.waiting[requester]
+            else:
+                self.release(requester)
+
+    def release(self, requester):
+        '''Ends the lease before it expires, the next requester gets it right away'''
+        with self.lock:
+            if requester is None or requester != self.holder:
+                return False
+            self._end_lease()
+            self._grant_next()
+            return True
+
+    def extend(self, requester):
+        '''Restarts the lease timer, as the holder is still busy pasting'''
+        with self.lock:
+            if requester is None or requester != self.holder:
+                return False
+            self._start_timer()
+            return True
+
+    def renew(self, requester):
+        '''Restarts the lease timer on the holder's request, the fair policy refuses while others wait'''
+        with self.lock:
+            if self.policy == POLICY_FAIR and self.waiting:
+                return False
+            return self.extend(requester)
+
+    def close(self):
+        with self.lock:
+            self.open = False
+            self.waiting.clear()
+            self._end_lease()
+
+    def _start_timer(self):
+        if self.timer is not None:
+            self.timers.cancel(self.timer)
+        self.lease_id += 1
+        self.timer = self.timers.schedule(self.lease_time, self._expired, self.lease_id)
+
+    def _end_lease(self):
+        if self.timer is not None:
+            self.timers.cancel(self.timer)
+            self.timer = None
+        self.holder = None
+
+    def _next_requester(self):
+        if self.policy == POLICY_FAIR:
+            # Ties, newcomers among them, keep the order of the requests
+            return min(self.waiting, key=lambda requester: self.last_granted.get(requester, 0))
+        return next(iter(self.waiting))
+
+    def _grant_next(self):
+        while self.open and self.holder is None and self.waiting:
+            requester = self._next_requester()
+            requested_at = self.waiting.pop(requester)
+            self.holder = requester
+            self.last_granted[requester] = time.time()
+            self._start_timer()
+            if not self.grant(requester, requested_at):
+                self._end_lease()
+
+    def _expired(self, lease_id):
+        with self.lock:
+            if lease_id != self.lease_id or self.holder is None:
+                return
+            requester = self.holder
+            self._end_lease()
+            self.expire(requester)
+            self._grant_next()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+'''
+Log handlers shared by the gui application and the server daemon
+'''
+
+from p2paste.network.traffic import TRACE_LOGGER_NAME
+from p2paste import settings
+
+import logging
+import os
+
+
+LOG_FORMAT = '%(asctime)-15s: by: %(threadName)s[%(thread)d] from: %(module)s/%(funcName)s/%(lineno)d %(levelname)s: %(message)s'
+
+
+def make_log_handler(log_path, default_filename):
+    try:
+        log_handler = logging.FileHandler(log_path)
+    except IOError:
+        log_handler = logging.FileHandler(os.path.join(settings.PROJECT_ROOT, default_filename))
+    log_handler.setLevel(logging.DEBUG)
+    log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    return log_handler
+
+
+def setup_trace_logger(trace_payloads):
+    # Payload dumps never reach the regular logs, and are only produced when asked for
+    trace_logger = logging.getLogger(TRACE_LOGGER_NAME)
+    trace_logger.propagate = False
+    if trace_payloads:
+        trace_logger.setLevel(logging.DEBUG)
+        trace_logger.addHandler(make_log_handler(settings.TRACE_LOG_PATH, 'trace.log'))
+    else:
+        trace_logger.setLevel(logging.CRITICAL)
+    return trace_logger
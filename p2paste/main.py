@@ -7,16 +7,19 @@ from Tkinter import Tk
 from p2paste.chatserver import ChatServer
 from p2paste.chatclient import ChatClient, ConnectionBroken
 from p2paste.gui import UIFrame, InvalidAddress, InvalidPortNumber, InvalidNickName
+from p2paste.logs import make_log_handler, setup_trace_logger
+from p2paste.history import PasteHistory
+from p2paste.network.limits import ServerLimits
 from p2paste import settings
 
 import logging
-import os
 
 
 class MainFrame(object):
     
     def __init__(self, client_logger, server_logger, *args, **kwargs):
-        self.ui_frame = UIFrame(settings.PORT_NUMBER_BOTTOM_BOUNDARY, *args, **kwargs)
+        self.ui_frame = UIFrame(settings.PORT_NUMBER_BOTTOM_BOUNDARY, settings.CHAT_SCROLLBACK, settings.LARGE_PASTE_SIZE,
+                                *args, **kwargs)
         self.bind_ui_events()
         self.logger = client_logger
         self._setup_chat_client(client_logger)
@@ -25,15 +28,26 @@ class MainFrame(object):
     def _setup_chat_client(self, logger):
         self.chat_client = ChatClient(
             logger,
+            settings.PASTE_CHUNK_SIZE,
             settings.CLIENT_TIMEOUT,
             settings.SSL_VERSION,
-            settings.CERTIFICATE_PATH
+            settings.CERTIFICATE_PATH,
+            settings.COMPRESSION_THRESHOLD,
+            settings.LOG_SAMPLE_RATE
         )
-        self.chat_client.message_handler.bind(self.ui_frame.add_chat_message)
-        self.chat_client.paste_handler.bind(self.ui_frame.set_paste_data)
-        self.chat_client.client_list_handler.bind(self.ui_frame.set_client_list)
-        self.chat_client.paste_granted_handler.bind(self.ui_frame.pastebox_enabled)
-        self.chat_client.paste_notification_handler.bind(self.ui_frame.set_paste_notification)
+        # The handlers are called from the client's threads, and Tk may only be touched from its own
+        threadsafe = self.ui_frame.threadsafe
+        self.chat_client.message_handler.bind(threadsafe(self.ui_frame.add_chat_message))
+        self.chat_client.paste_handler.bind(threadsafe(self.ui_frame.set_paste_data))
+        self.chat_client.paste_delta_handler.bind(threadsafe(self.ui_frame.apply_paste_changes))
+        self.chat_client.paste_progress_handler.bind(threadsafe(self.ui_frame.set_paste_progress))
+        self.chat_client.paste_abort_handler.bind(threadsafe(self.ui_frame.paste_aborted))
+        self.chat_client.client_list_handler.bind(threadsafe(self.ui_frame.set_client_list))
+        self.chat_client.client_list_delta_handler.bind(threadsafe(self.ui_frame.update_client_list))
+        self.chat_client.paste_granted_handler.bind(threadsafe(self.ui_frame.pastebox_enabled))
+        self.chat_client.paste_notification_handler.bind(threadsafe(self.ui_frame.set_paste_notification))
+        self.chat_client.room_handler.bind(threadsafe(self.ui_frame.set_rooms))
+        self.chat_client.connection_handler.bind(threadsafe(self.connection_changed))
         
     def _setup_chat_server(self, logger):
         self.chat_server = ChatServer(
@@ -44,7 +58,12 @@ class MainFrame(object):
             settings.SERVER_TIMEOUT,
             settings.SSL_VERSION,
             settings.CERTIFICATE_PATH,
-            settings.KEY_PATH
+            settings.KEY_PATH,
+            settings.OUTBOUND_BUFFER_SIZE,
+            settings.COMPRESSION_THRESHOLD,
+            settings.LOG_SAMPLE_RATE,
+            ServerLimits(settings.INBOUND_BUFFER_SIZE, settings.FRAME_SIZE_LIMITS, settings.MEMORY_CEILING,
+                         settings.MEMORY_POLICY, settings.RATE_LIMITS, settings.RATE_POLICY)
         )
 
     def bind_ui_events(self):
@@ -55,12 +74,33 @@ class MainFrame(object):
         self.ui_frame.button_copy_chat.bind('<Button-1>', self.ui_frame.copy_chat)
         self.ui_frame.button_request_paste.bind('<Button-1>', self.click_paste_request)
         self.ui_frame.button_send_pastebox.bind('<Button-1>', self.click_paste_send)
+        self.ui_frame.button_cancel_pastebox.bind('<Button-1>', self.click_paste_cancel)
         self.ui_frame.button_clear_pastebox.bind('<Button-1>', self.ui_frame.clear_pastebox)
         self.ui_frame.button_selectall_pastebox.bind('<Button-1>', self.ui_frame.selectall_pastebox)
         self.ui_frame.button_paste_pastebox.bind('<Button-1>', self.ui_frame.paste_pastebox)
         self.ui_frame.button_copy_pastebox.bind('<Button-1>', self.ui_frame.copy_pastebox)
         self.ui_frame.button_host.bind('<Button-1>', self.click_host)
         self.ui_frame.button_close_server.bind('<Button-1>', self.click_close_server)
+        self.ui_frame.button_join_room.bind('<Button-1>', self.click_join_room)
+        self.ui_frame.entry_room.bind('<Return>', self.click_join_room)
+        self.ui_frame.button_leave_room.bind('<Button-1>', self.click_leave_room)
+
+    def click_join_room(self, event):
+        try:
+            room_name = self.ui_frame.get_room_name()
+            if not self.chat_client.join_room(room_name):
+                self.ui_frame.log_error('Joining room {0} failed, invalid name or the server has no rooms.'.format(
+                    room_name))
+        except ConnectionBroken:
+            self.ui_frame.log_error('You are disconnected.')
+
+    def click_leave_room(self, event):
+        try:
+            room_name = self.ui_frame.get_room_name() or self.chat_client.room
+            if not self.chat_client.leave_room(room_name):
+                self.ui_frame.log_info("You can't leave room {0}.".format(room_name))
+        except ConnectionBroken:
+            self.ui_frame.log_error('You are disconnected.')
 
     def click_connect(self, event):
         if self.chat_client.connected:
@@ -70,6 +110,7 @@ class MainFrame(object):
             address = self.ui_frame.get_connect_address()
             nickname = self.ui_frame.get_nickname()
             self.chat_client.connect(address, nickname)
+            self.ui_frame.set_rooms(self.chat_client.room, sorted(self.chat_client.blackboards))
             self.ui_frame.log_info('Connected to {0}:{1}'.format(address[0], address[1]))
         except (InvalidAddress, InvalidNickName) as exc:
             self.ui_frame.log_error(str(exc))
@@ -77,10 +118,17 @@ class MainFrame(object):
             self.logger.error('Connection failed to {0}:{1}'.format(address[0], address[1]))
             self.ui_frame.log_error('Connection failed to {0}:{1}'.format(address[0], address[1]))
                      
+    def connection_changed(self, connected):
+        if connected:
+            self.ui_frame.log_info('Reconnected.')
+        else:
+            self.ui_frame.pastebox_disabled()
+            self.ui_frame.log_error('Connection lost, reconnecting...')
+
     def click_disconnect(self, event):
-        if self.chat_client.connected:
-            self.chat_client.disconnect()
-            self.ui_frame.clear_client_list()
+        # Also gives up reconnecting after a lost connection
+        self.chat_client.disconnect()
+        self.ui_frame.clear_client_list()
         self.ui_frame.log_info('Disconnected.')
     
     def click_chat_send(self, event):
@@ -103,6 +151,19 @@ class MainFrame(object):
         finally:
             self.ui_frame.pastebox_disabled()
 
+    def click_paste_cancel(self, event):
+        if self.chat_client.cancel_paste():
+            return
+        # Nothing streaming, an unused permission is given back to whoever waits next
+        try:
+            if self.chat_client.release_paste():
+                self.ui_frame.pastebox_disabled()
+                self.ui_frame.log_info('Paste permission given back.')
+            else:
+                self.ui_frame.log_info('No paste is being sent.')
+        except ConnectionBroken:
+            self.ui_frame.log_error('You are disconnected.')
+
     def click_paste_request(self, event):
         try:
             self.chat_client.send_paste_request()
@@ -121,7 +182,12 @@ class MainFrame(object):
             port = settings.DEFAULT_PORT
 
         try:
-            address = self.chat_server.host(port)
+            history = None
+            if settings.HISTORY_PATH:
+                history = PasteHistory(self.chat_server.logger, settings.HISTORY_PATH, settings.HISTORY_SEGMENT_SIZE,
+                                       settings.HISTORY_MAX_BYTES, settings.HISTORY_MAX_AGE)
+            address = self.chat_server.host(port, settings.METRICS_PORT, history=history,
+                                            paste_policy=settings.PASTE_POLICY)
             self.ui_frame.log_info('Server running at {0}:{1}'.format(address[0], address[1]))
         except ConnectionBroken:
             self.logger.error('Hosting failed on port: {0}'.format(port))
@@ -141,25 +207,12 @@ class MainFrame(object):
 
 
 def setup_loggers():
-    
-    def make_log_handler(log_path, default_filename):
-        try:
-            log_handler = logging.FileHandler(log_path)
-        except IOError:
-            log_handler = logging.FileHandler(os.path.join(settings.PROJECT_ROOT, default_filename))
-        log_handler.setLevel(logging.DEBUG)
-        log_handler.setFormatter(
-            logging.Formatter('%(asctime)-15s: by: %(threadName)s[%(thread)d] from: %(module)s/%(funcName)s/%(lineno)d %(levelname)s: %(message)s')
-        )
-        return log_handler
-
-    logging.getLogger('').setLevel(logging.DEBUG)
-    client_log_handler = make_log_handler(settings.CLIENT_LOG_PATH, 'client.log')
+    logging.getLogger('').setLevel(settings.LOG_LEVEL)
     client_logger = logging.getLogger('client_logger')
-    client_logger.addHandler(client_log_handler)
-    server_log_handler = make_log_handler(settings.SERVER_LOG_PATH, 'server.log')
+    client_logger.addHandler(make_log_handler(settings.CLIENT_LOG_PATH, 'client.log'))
     server_logger = logging.getLogger('server_logger')
-    server_logger.addHandler(server_log_handler)
+    server_logger.addHandler(make_log_handler(settings.SERVER_LOG_PATH, 'server.log'))
+    setup_trace_logger(settings.TRACE_PAYLOADS)
     return client_logger, server_logger
 
 
@@ -3,16 +3,67 @@
 Networking base module
 '''
 
+from network.codec import JSON_CODEC, encode_payload, decompress_payload, codec_of
+from network.traffic import TrafficLog
+from network.metrics import MetricsRegistry
 import socket
 import struct
 import errno
-import json
+import time
+import ssl
+
+
+HEADER_FORMAT = '!L'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECEIVE_SIZE = 65536
+WRITE_SIZE = 65536
+# Small frames queued for a connection are joined into writes of up to one TLS record of data,
+# so a burst of them costs one record and one syscall instead of one each
+COALESCE_SIZE = 16384
+# Receive buffers grown past this for a large frame are given back once they're drained
+IDLE_BUFFER_LIMIT = 4 * 1024 * 1024
+# Largest frame a receive buffer takes by default, and largest payload one decompresses to
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+WOULD_BLOCK_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK)
+SSL_WANT_ERRORS = (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+# Refused whatever the ssl version allows, and the frames are compressed by the codec layer already
+SSL_CONTEXT_OPTIONS = ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION
 
 
 class ConnectionBroken(Exception):
     pass
 
 
+class FrameTooLarge(ValueError):
+    '''A frame over its size limit, refused before it's buffered or passed on'''
+
+    def __init__(self, message, package_type=None):
+        super(FrameTooLarge, self).__init__(message)
+        self.package_type = package_type
+
+
+def set_no_delay(plain_socket):
+    '''Frames are written whole, or joined by the outbound queue already, Nagle would only hold them back'''
+    plain_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def make_ssl_context(ssl_version, certificate_path, key_path=None, server_side=False):
+    '''
+    TLS context shared by every connection, so the certificates are only read and parsed once.
+    A server context keeps the sessions it negotiated and hands out session tickets, a returning
+    peer that offers one resumes without the full handshake. Raises ssl.SSLError or IOError.
+    '''
+    context = ssl.SSLContext(ssl_version)
+    context.options |= SSL_CONTEXT_OPTIONS
+    if server_side:
+        context.load_cert_chain(certificate_path, key_path)
+    else:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(certificate_path)
+    return context
+
+
 class EventHandler(object):
     def __init__(self):
         self.handler = None
@@ -24,44 +75,296 @@ class EventHandler(object):
         return self.handler is None
     
     def __call__(self, *args, **kargs):
-        self.handler(*args, **kargs)
+        # Headless clients only bind what they care about
+        if self.handler is not None:
+            self.handler(*args, **kargs)
+
+
+def pack_header(size):
+    return struct.pack(HEADER_FORMAT, socket.htonl(size))
+
+
+def unpack_header(header):
+    return socket.ntohl(struct.unpack(HEADER_FORMAT, header)[0])
+
+
+def unpack_header_from(buffer, offset):
+    return socket.ntohl(struct.unpack_from(HEADER_FORMAT, buffer, offset)[0])
+
+
+def package_type_of(package):
+    return package.get('type') if isinstance(package, dict) else None
+
+
+class Frame(object):
+    '''Immutable encoded frame (header and payload), shared by every recipient it is queued for'''
+
+    __slots__ = ('data', 'view', 'raw_size', 'compress_time', 'created', 'fanout', 'queues')
+
+    def __init__(self, payload, raw_size=None, compress_time=0.0):
+        self.data = pack_header(len(payload)) + payload
+        self.view = memoryview(self.data)
+        self.raw_size = len(payload) if raw_size is None else raw_size
+        self.compress_time = compress_time
+        self.created = time.time()
+        # Recipients still waiting for a broadcast frame to be written
+        self.fanout = 0
+        # Outbound queues holding the frame, it's counted against the server's memory ceiling once
+        self.queues = 0
+
+    @property
+    def payload_size(self):
+        return len(self.data) - HEADER_SIZE
+
+    def __len__(self):
+        return len(self.data)
+
+
+class FrameReader(object):
+    '''
+    Receive buffer of a connection. The socket reads straight into its free space with
+    recv_into, and complete payloads are handed out as memoryview slices of it, which
+    stay valid until the next read. A header announcing more than max_frame_size raises
+    FrameTooLarge, before any room is made for the frame.
+    '''
+
+    def __init__(self, size=RECEIVE_SIZE, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._replace_buffer(bytearray(size))
+        self.start = 0
+        self.end = 0
+        self.received_total = 0
+        # End of the incomplete frame at the start of the buffer, 0 while its header isn't in
+        self.frame_end = 0
+
+    def _replace_buffer(self, buffer):
+        # Payloads handed out earlier may still point into the old buffer, so it's
+        # replaced instead of resized
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _frame_end(self, offset):
+        size = unpack_header_from(self.buffer, offset)
+        if size > self.max_frame_size:
+            raise FrameTooLarge('Frame of {0} bytes announced, at most {1} accepted.'.format(
+                size, self.max_frame_size))
+        return offset + HEADER_SIZE + size
+
+    def _wanted(self):
+        '''Bytes still missing from the frame at the start of the buffer, one read worth when that's unknown'''
+        buffered = self.end - self.start
+        if buffered < HEADER_SIZE:
+            return RECEIVE_SIZE
+        missing = self._frame_end(self.start) - self.end
+        return missing if missing > 0 else RECEIVE_SIZE
+
+    def _reserve(self, size):
+        if len(self.buffer) - self.end >= size:
+            return
+
+        buffered = self.end - self.start
+        if len(self.buffer) >= buffered + size:
+            self.buffer[:buffered] = self.view[self.start:self.end].tobytes()
+        else:
+            # Doubling stops at the largest frame, and a read past its end
+            limit = max(HEADER_SIZE + self.max_frame_size + RECEIVE_SIZE, buffered + size)
+            grown = bytearray(min(max(2 * len(self.buffer), buffered + size), limit))
+            grown[:buffered] = self.view[self.start:self.end].tobytes()
+            self._replace_buffer(grown)
+        if self.frame_end:
+            self.frame_end -= self.start
+        self.start = 0
+        self.end = buffered
+
+    def receive_into(self, receiver_socket):
+        '''Reads from the socket into the buffer, room for a whole frame is made once its header is in'''
+        free_space = len(self.buffer) - self.end
+        # Room for the rest of a frame that won't fit is made while little of it is
+        # buffered, so a large frame is never moved once it's coming in
+        if free_space < RECEIVE_SIZE or self.frame_end > len(self.buffer):
+            self._reserve(self._wanted())
+            free_space = len(self.buffer) - self.end
+        received = receiver_socket.recv_into(self.view[self.end:], free_space)
+        self.end += received
+        self.received_total += received
+        return received
+
+    def frames(self):
+        '''Cuts every complete frame off the buffer and returns their payloads'''
+        if self.end < self.frame_end:
+            return []
+
+        frames = []
+        self.frame_end = 0
+        while self.end - self.start >= HEADER_SIZE:
+            payload_start = self.start + HEADER_SIZE
+            payload_end = self._frame_end(self.start)
+            if payload_end > self.end:
+                self.frame_end = payload_end
+                break
+            frames.append(self.view[payload_start:payload_end])
+            self.start = payload_end
+
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > IDLE_BUFFER_LIMIT:
+                self._replace_buffer(bytearray(RECEIVE_SIZE))
+        return frames
 
 
 class NetworkBase(object):
 
-    def __init__(self, logger):
+    def __init__(self, logger, log_sample_rate=1):
         self.logger = logger
+        self.traffic = TrafficLog(logger, log_sample_rate)
+        self.metrics = MetricsRegistry()
+        self.frames_sent = self.metrics.counter(
+            'p2paste_frames_sent_total', 'Frames sent, by package type, broadcasts count once per recipient', ('type',))
+        self.frames_received = self.metrics.counter(
+            'p2paste_frames_received_total', 'Frames received, by package type', ('type',))
+        self.encode_seconds = self.metrics.histogram(
+            'p2paste_encode_seconds', 'Time spent encoding and compressing a frame')
+        self.decode_seconds = self.metrics.histogram(
+            'p2paste_decode_seconds', 'Time spent decompressing and decoding a frame')
+        self.frames_refused = self.metrics.counter(
+            'p2paste_frames_refused_total', 'Frames refused for their size, by package type where it was known',
+            ('type',))
+        # Package type -> largest payload accepted of it once decompressed, on top of the frame reader's limit
+        self.frame_size_limits = dict()
+
+    def _encode(self, outgoing_data, codec, compressor, threshold):
+        started = time.time()
+        encoded = encode_payload(outgoing_data, codec, compressor, threshold)
+        self.encode_seconds.observe(time.time() - started)
+        return encoded
 
-    def nb_send(self, target_socket, outgoing_data):
+    def nb_send(self, target_socket, outgoing_data, codec=JSON_CODEC, compressor=None, threshold=0, stats=None):
         try:
-            json_data = json.dumps(outgoing_data)
-            value = socket.htonl(len(json_data))
-            size = struct.pack('!L', value)
-            target_socket.write(size)
-            target_socket.write(json_data)
+            payload, raw_size, compress_time = self._encode(outgoing_data, codec, compressor, threshold)
+            self.frames_sent.inc(1, (package_type_of(outgoing_data),))
+            if stats is not None:
+                stats.add_compressed(raw_size, len(payload), compress_time)
+            # One write, so the header doesn't go out in a TLS record and a segment of its own
+            target_socket.sendall(pack_header(len(payload)) + payload)
+            return HEADER_SIZE + len(payload)
         except (socket.error, socket.timeout, struct.error, ValueError) as exc:
             self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
             raise ConnectionBroken
         
-    def nb_receive(self, receiver_socket):
+    def nb_frame(self, outgoing_data, codec=JSON_CODEC, compressor=None, threshold=0):
+        try:
+            return Frame(*self._encode(outgoing_data, codec, compressor, threshold))
+        except (struct.error, TypeError, ValueError) as exc:
+            self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
+            raise ConnectionBroken
+
+    def nb_send_available(self, target_socket, outbound):
+        '''
+        Writes queued frames until the socket would block. Returns the completed frames with their
+        latencies, and the number of frames each write completed.
+        '''
+        completed = []
+        frames_per_write = []
+        try:
+            while outbound:
+                try:
+                    sent = target_socket.send(outbound.next_write())
+                except ssl.SSLError as exc:
+                    if exc.args[0] in SSL_WANT_ERRORS:
+                        break
+                    raise
+                except socket.error as exc:
+                    if exc.errno in WOULD_BLOCK_ERRORS:
+                        break
+                    raise
+
+                if not sent:
+                    break
+                written = outbound.advance(sent)
+                completed.extend(written)
+                frames_per_write.append(len(written))
+            return completed, frames_per_write
+        except (socket.error, socket.timeout) as exc:
+            self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
+            raise ConnectionBroken
+
+    def _decode_frame(self, frame, frame_reader, stats, peer):
+        started = time.time()
+        payload = decompress_payload(frame, stats, frame_reader.max_frame_size)
+        package = codec_of(payload).decode(payload)
+        self.decode_seconds.observe(time.time() - started)
+        package_type = package_type_of(package)
+        limit = self.frame_size_limits.get(package_type)
+        if limit is not None and len(payload) > limit:
+            raise FrameTooLarge('Package of {0} bytes, at most {1} accepted of its type.'.format(
+                len(payload), limit), package_type)
+        self.frames_received.inc(1, (package_type,))
+        self.traffic.received(peer, package, HEADER_SIZE + len(frame))
+        return package
+
+    def _refused(self, exc, peer):
+        self.frames_refused.inc(1, (exc.package_type,))
+        self.logger.error('{0}: {1}'.format(peer, str(exc)))
+        return ConnectionBroken()
+
+    def nb_receive(self, receiver_socket, frame_reader, stats=None, peer=None):
+        '''
+        Blocking read of whatever the socket has, returns the packages it completed, possibly none.
+        Records already decrypted by the SSL layer are drained too, select wouldn't report them.
+        '''
         try:
-            size = struct.calcsize('!L')
-            size = receiver_socket.read(size)
-            size = socket.ntohl(struct.unpack('!L', size)[0])
-            self.logger.debug('Unpacked size: {0}'.format(str(size)))
-            in_data = ''
-            while len(in_data) < size:
-                in_data += receiver_socket.read(size - len(in_data))
-                
-            if not in_data:
+            if not frame_reader.receive_into(receiver_socket):
                 raise ConnectionBroken
-            
-            self.logger.debug('Received buffer: {0}'.format(str(in_data)))
-            return json.loads(in_data)
+            while receiver_socket.pending():
+                frame_reader.receive_into(receiver_socket)
+            return [self._decode_frame(frame, frame_reader, stats, peer) for frame in frame_reader.frames()]
+        except FrameTooLarge as exc:
+            raise self._refused(exc, peer)
+        except (socket.error, socket.timeout, struct.error, ValueError) as exc:
+            self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
+            raise ConnectionBroken
+
+    def nb_read_available(self, receiver_socket, frame_reader, peer=None):
+        '''
+        Drains a non-blocking socket and returns the payloads of every complete frame received so
+        far, still encoded. They point into the receive buffer, and are only valid until the next read.
+        '''
+        try:
+            while True:
+                try:
+                    received = frame_reader.receive_into(receiver_socket)
+                except ssl.SSLError as exc:
+                    if exc.args[0] in SSL_WANT_ERRORS:
+                        break
+                    raise
+                except socket.error as exc:
+                    if exc.errno in WOULD_BLOCK_ERRORS:
+                        break
+                    raise
+
+                if not received:
+                    raise ConnectionBroken
+
+            return frame_reader.frames()
+        except FrameTooLarge as exc:
+            raise self._refused(exc, peer)
         except (socket.error, socket.timeout, struct.error, ValueError) as exc:
             self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
             raise ConnectionBroken
 
+    def nb_decode(self, frame, frame_reader, stats=None, peer=None):
+        '''Decompresses and decodes a payload nb_read_available returned'''
+        try:
+            return self._decode_frame(frame, frame_reader, stats, peer)
+        except FrameTooLarge as exc:
+            raise self._refused(exc, peer)
+        except (struct.error, ValueError) as exc:
+            self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
+            raise ConnectionBroken
+
     def nb_close_socket(self, target_socket):
         try:
             try:
@@ -3,81 +3,125 @@
 Networking client module
 '''
 
-from network.base import NetworkBase, EventHandler, ConnectionBroken
+from network.base import NetworkBase, EventHandler, ConnectionBroken, FrameReader, make_ssl_context, set_no_delay
+from network.codec import JSON_CODEC, SUPPORTED_CODECS, get_codec
+from network.compression import CompressionStats, SUPPORTED_COMPRESSIONS, get_compressor
 from Queue import Queue
 import threading
 import select
 import socket
-import ssl
 
 
 class Client(NetworkBase):
 
-    data_handler = EventHandler()
-    
-    def __init__(self, logger, max_timeout, ssl_version, certificate_path):
-        super(Client, self).__init__(logger)
+    def __init__(self, logger, max_timeout, ssl_version, certificate_path, compression_threshold, log_sample_rate=1):
+        super(Client, self).__init__(logger, log_sample_rate)
+        # Handlers belong to the instance, so several clients can live in one process
+        self.data_handler = EventHandler()
+        # Called from the listener when the connection breaks, not when disconnect is called
+        self.connection_lost_handler = EventHandler()
         self.max_timeout = max_timeout
         self.ssl_version = ssl_version
         self.certificate_path = certificate_path
+        # Built on the first connect and kept for every reconnect
+        self.ssl_context = None
+        self.compression_threshold = compression_threshold
         
         self.connected = threading.Event()
         self.listener_stopped = threading.Event()        
         self.received_queue = Queue()
+        # Streamed pastes are sent from their own thread, frames must not interleave on the socket
+        self.send_lock = threading.Lock()
+        self.codec = JSON_CODEC
+        self.compressor = None
+        self.compression_stats = CompressionStats()
+        self.frame_reader = FrameReader()
+        self.peer = None
 
     def __call__(self):
         return self.client_socket
 
+    @property
+    def supported_codecs(self):
+        return SUPPORTED_CODECS
+
+    def set_codec(self, codec_name):
+        self.codec = get_codec(codec_name)
+        self.logger.info('Switched to {0} codec.'.format(self.codec.name))
+
+    @property
+    def supported_compressions(self):
+        return SUPPORTED_COMPRESSIONS
+
+    def set_compression(self, compression_name):
+        self.compressor = get_compressor(compression_name)
+        self.logger.info('Switched to {0} compression.'.format(compression_name))
+
     def send(self, outgoing_data):
-        self.nb_send(self.client_socket, outgoing_data)
-        self.logger.debug('Data sent to {0} with: {1}'.format(self.client_socket.getpeername(), str(outgoing_data)))
+        with self.send_lock:
+            size = self.nb_send(self.client_socket, outgoing_data, self.codec, self.compressor,
+                                self.compression_threshold, self.compression_stats)
+        self.traffic.sent(self.peer, outgoing_data, size)
     
     def receive(self, receiver_socket):
-        return self.nb_receive(receiver_socket)
+        return self.nb_receive(receiver_socket, self.frame_reader, self.compression_stats, self.peer)
 
     def _listener(self):
+        lost = False
         while self.connected.is_set():
             try:
                 sread, _swrite, _sexc = select.select([self.client_socket], [], [], 1)
             except (select.error, socket.error, socket.timeout) as exc:
                 self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
                 self.connected.clear()
+                lost = True
                 break
 
             for active_socket in sread:
                 try:
-                    incoming_data = self.receive(active_socket)
-                    self.data_handler(incoming_data)
+                    for incoming_data in self.receive(active_socket):
+                        self.data_handler(incoming_data)
                 except ConnectionBroken:
                     self.connected.clear()
+                    lost = True
                     break
 
         self.listener_stopped.set()
+        if lost:
+            self.nb_close_socket(self.client_socket)
+            self.logger.info('Connection lost.')
+            self.connection_lost_handler()
 
     def connect(self, address):
         try:
+            if self.ssl_context is None:
+                self.ssl_context = make_ssl_context(self.ssl_version, self.certificate_path)
             unsecured_client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket = ssl.wrap_socket(
-                unsecured_client_socket,
-                ca_certs=self.certificate_path,
-                cert_reqs=ssl.CERT_REQUIRED,
-                ssl_version=self.ssl_version
-            )
+            set_no_delay(unsecured_client_socket)
+            self.client_socket = self.ssl_context.wrap_socket(unsecured_client_socket)
             self.client_socket.settimeout(self.max_timeout)
             self.client_socket.connect(address)
+            self.codec = JSON_CODEC
+            self.compressor = None
+            self.frame_reader = FrameReader()
+            self.peer = self.client_socket.getpeername()
 
-            self.logger.debug('Connected to: {0}'.format(self.client_socket.getpeername()))
-            self.logger.debug('Cipher: {0}'.format(self.client_socket.cipher()))
+            self.logger.debug('Connected to: {0}'.format(self.peer))
+            self.logger.debug('Protocol: {0}, cipher: {1}'.format(
+                self.client_socket.version(), self.client_socket.cipher()))
             
             self.connected.set()
             self.listener_thread = threading.Thread(target=self._listener)
             self.listener_thread.start()
             self.logger.info('Connection routine successful.')
-        except (socket.error, socket.timeout) as se:
+        except (socket.error, socket.timeout, IOError) as se:
             self.logger.error('{0}: {1}'.format(se.__class__.__name__, str(se)))
             raise ConnectionBroken 
 
     def disconnect(self):
+        if not self.connected.is_set():
+            # The listener lost the connection, and closed the socket already
+            return
         self.listener_stopped.clear()
         self.connected.clear()
         self.listener_stopped.wait()
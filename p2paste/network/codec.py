@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+'''
+Wire codecs, turning packages into frame payloads and back
+
+JSON payloads always start with '{', every other codec starts its payload with a
+marker byte that has the high bit set and carries the codec id, so a receiver can
+decode any frame without knowing what the peer negotiated. A compressed payload
+is the marker byte with the compression id in its low bits, followed by the
+compressed payload of the codec.
+
+Received payloads may be memoryviews of the receive buffer, the binary codec
+decodes them in place.
+'''
+
+from network.compression import COMPRESSORS_BY_ID
+import codecs
+import struct
+import json
+import time
+
+
+MARKER_BIT = 0x80
+CODEC_ID_SHIFT = 4
+CODEC_ID_MASK = 0x07
+COMPRESSION_MASK = 0x0F
+
+# Lists and maps nested deeper than this are refused rather than recursed into
+MAX_NESTING = 32
+
+
+class CodecError(ValueError):
+    pass
+
+
+class JsonCodec(object):
+
+    name = 'json'
+    codec_id = 0
+
+    def encode(self, package):
+        return json.dumps(package)
+
+    def decode(self, payload):
+        try:
+            package = json.loads(_as_bytes(payload))
+        except (ValueError, RuntimeError) as exc:
+            # Nesting deep enough to hit the recursion limit is a RuntimeError
+            raise CodecError('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
+        if not isinstance(package, dict):
+            raise CodecError('Package is not an object.')
+        return package
+
+
+class BinaryCodec(object):
+    '''
+    Struct based codec: marker, type tag and a field bitmask, followed by the
+    sender, the data and any extra keys as tagged values. Strings, paste bodies
+    included, are raw length-prefixed UTF-8.
+    '''
+
+    name = 'binary'
+    codec_id = 1
+
+    HAS_SENDER = 0x01
+    HAS_DATA = 0x02
+    HAS_EXTRAS = 0x04
+
+    PACKAGE_HEADER = struct.Struct('!BBB')
+    LENGTH = struct.Struct('!L')
+    INTEGER = struct.Struct('!q')
+    FLOAT = struct.Struct('!d')
+
+    (TAG_NONE, TAG_TRUE, TAG_FALSE, TAG_INTEGER, TAG_FLOAT,
+     TAG_STRING, TAG_STRING_LIST, TAG_LIST, TAG_MAP) = 'NTFidsSlm'
+
+    def __init__(self):
+        self.marker = MARKER_BIT | (self.codec_id << CODEC_ID_SHIFT)
+
+    def _encode_value(self, value, parts):
+        # Strings are by far the most common values, so they are checked first
+        if isinstance(value, basestring):
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            parts.append(self.TAG_STRING + self.LENGTH.pack(len(value)))
+            parts.append(value)
+        elif value is None:
+            parts.append(self.TAG_NONE)
+        elif value is True:
+            parts.append(self.TAG_TRUE)
+        elif value is False:
+            parts.append(self.TAG_FALSE)
+        elif isinstance(value, (list, tuple)) and value and all(isinstance(item, basestring) for item in value):
+            # Nickname lists and the like: every length up front, then the bytes back to back
+            items = [item.encode('utf-8') if isinstance(item, unicode) else item for item in value]
+            parts.append(self.TAG_STRING_LIST + struct.pack('!L{0}L'.format(len(items)), len(items), *map(len, items)))
+            parts.extend(items)
+        elif isinstance(value, (list, tuple)):
+            parts.append(self.TAG_LIST + self.LENGTH.pack(len(value)))
+            for item in value:
+                self._encode_value(item, parts)
+        elif isinstance(value, dict):
+            parts.append(self.TAG_MAP + self.LENGTH.pack(len(value)))
+            for key, item in value.iteritems():
+                self._encode_value(key, parts)
+                self._encode_value(item, parts)
+        elif isinstance(value, (int, long)):
+            parts.append(self.TAG_INTEGER + self.INTEGER.pack(value))
+        elif isinstance(value, float):
+            parts.append(self.TAG_FLOAT + self.FLOAT.pack(value))
+        else:
+            raise CodecError('Unable to encode value of type: {0}'.format(type(value).__name__))
+
+    def _decode_string(self, payload, offset):
+        length = self.LENGTH.unpack_from(payload, offset)[0]
+        offset += self.LENGTH.size
+        end = offset + length
+        if end > len(payload):
+            raise CodecError('String runs past the end of the payload.')
+        return codecs.utf_8_decode(payload[offset:end], 'strict', True)[0], end
+
+    def _decode_count(self, payload, offset, item_size):
+        '''Item count of a list, checked against the bytes left, as every item takes at least item_size'''
+        count = self.LENGTH.unpack_from(payload, offset)[0]
+        offset += self.LENGTH.size
+        if count * item_size > len(payload) - offset:
+            raise CodecError('{0} items can\'t fit in the rest of the payload.'.format(count))
+        return count, offset
+
+    def _decode_value(self, payload, offset, depth=0):
+        tag = payload[offset]
+        offset += 1
+        if tag == self.TAG_STRING:
+            return self._decode_string(payload, offset)
+        if tag == self.TAG_NONE:
+            return None, offset
+        if tag == self.TAG_TRUE:
+            return True, offset
+        if tag == self.TAG_FALSE:
+            return False, offset
+        if tag == self.TAG_INTEGER:
+            return self.INTEGER.unpack_from(payload, offset)[0], offset + self.INTEGER.size
+        if tag == self.TAG_FLOAT:
+            return self.FLOAT.unpack_from(payload, offset)[0], offset + self.FLOAT.size
+
+        if depth >= MAX_NESTING:
+            raise CodecError('Values nested more than {0} deep.'.format(MAX_NESTING))
+        if tag == self.TAG_STRING_LIST:
+            length, offset = self._decode_count(payload, offset, self.LENGTH.size)
+            lengths = struct.unpack_from('!{0}L'.format(length), payload, offset)
+            offset += self.LENGTH.size * length
+            items = []
+            for item_length in lengths:
+                items.append(codecs.utf_8_decode(payload[offset:offset + item_length], 'strict', True)[0])
+                offset += item_length
+            if offset > len(payload):
+                raise CodecError('String list runs past the end of the payload.')
+            return items, offset
+        if tag == self.TAG_LIST:
+            length, offset = self._decode_count(payload, offset, 1)
+            items = []
+            for _index in xrange(length):
+                item, offset = self._decode_value(payload, offset, depth + 1)
+                items.append(item)
+            return items, offset
+        if tag == self.TAG_MAP:
+            length, offset = self._decode_count(payload, offset, 2)
+            items = dict()
+            for _index in xrange(length):
+                key, offset = self._decode_value(payload, offset, depth + 1)
+                if not isinstance(key, basestring):
+                    raise CodecError('Map key of type: {0}'.format(type(key).__name__))
+                items[key], offset = self._decode_value(payload, offset, depth + 1)
+            return items, offset
+        raise CodecError('Unknown value tag: {0!r}'.format(tag))
+
+    def encode(self, package):
+        fields = 0
+        parts = []
+        if 'sender' in package:
+            fields |= self.HAS_SENDER
+            self._encode_value(package['sender'], parts)
+        if package.get('data') is not None:
+            fields |= self.HAS_DATA
+            self._encode_value(package['data'], parts)
+        extras = dict((key, value) for key, value in package.iteritems() if key not in ('type', 'sender', 'data'))
+        if extras:
+            fields |= self.HAS_EXTRAS
+            self._encode_value(extras, parts)
+
+        try:
+            header = self.PACKAGE_HEADER.pack(self.marker, package['type'], fields)
+        except (KeyError, struct.error) as exc:
+            raise CodecError(str(exc))
+        return header + ''.join(parts)
+
+    def decode(self, payload):
+        try:
+            _marker, package_type, fields = self.PACKAGE_HEADER.unpack_from(payload)
+            offset = self.PACKAGE_HEADER.size
+            package = dict(type=package_type, data=None)
+            if fields & self.HAS_SENDER:
+                package['sender'], offset = self._decode_value(payload, offset)
+            if fields & self.HAS_DATA:
+                package['data'], offset = self._decode_value(payload, offset)
+            if fields & self.HAS_EXTRAS:
+                extras, offset = self._decode_value(payload, offset)
+                if not isinstance(extras, dict):
+                    raise CodecError('Extra keys are not a map.')
+                package.update(extras)
+        except CodecError:
+            raise
+        except Exception as exc:
+            # Whatever a malformed payload sets off, only its frame is lost
+            raise CodecError('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
+        return package
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+
+CODECS = dict((codec.name, codec) for codec in (BINARY_CODEC, JSON_CODEC))
+CODECS_BY_ID = dict((codec.codec_id, codec) for codec in (BINARY_CODEC, JSON_CODEC))
+
+# Preferred order when negotiating, the first one supported by both sides wins
+SUPPORTED_CODECS = (BINARY_CODEC.name, JSON_CODEC.name)
+
+
+def _as_bytes(payload):
+    if isinstance(payload, memoryview):
+        return payload.tobytes()
+    return payload
+
+
+def get_codec(name):
+    return CODECS.get(name, JSON_CODEC)
+
+
+def negotiate_codec(offered_codecs):
+    for name in SUPPORTED_CODECS:
+        if name in (offered_codecs or ()):
+            return CODECS[name]
+    return JSON_CODEC
+
+
+def codec_of(payload):
+    '''Identifies the codec of a received payload from its first byte'''
+    if not payload:
+        raise CodecError('Empty payload.')
+
+    marker = ord(payload[0])
+    if not marker & MARKER_BIT:
+        return JSON_CODEC
+    try:
+        return CODECS_BY_ID[(marker >> CODEC_ID_SHIFT) & CODEC_ID_MASK]
+    except KeyError:
+        raise CodecError('Unknown codec marker: {0:#x}'.format(marker))
+
+
+def encode_payload(package, codec, compressor=None, threshold=0):
+    '''
+    Encodes the package, and compresses it if it's at least threshold bytes long.
+    Returns the payload, its size before compression and the seconds spent compressing.
+    '''
+    payload = codec.encode(package)
+    if compressor is None or len(payload) < threshold:
+        return payload, len(payload), 0.0
+
+    started = time.time()
+    compressed = compressor.compress(payload)
+    elapsed = time.time() - started
+    if len(compressed) + 1 >= len(payload):
+        return payload, len(payload), elapsed
+
+    marker = MARKER_BIT | (codec.codec_id << CODEC_ID_SHIFT) | compressor.compression_id
+    return chr(marker) + compressed, len(payload), elapsed
+
+
+def peek_package_type(payload):
+    '''Package type of an uncompressed binary payload, read off its header, None for any other payload'''
+    if len(payload) < BinaryCodec.PACKAGE_HEADER.size or ord(payload[0]) != BINARY_CODEC.marker:
+        return None
+    return ord(payload[1])
+
+
+def decompress_payload(payload, stats=None, max_size=None):
+    '''Payload as the codec wrote it, decompressed to at most max_size bytes if it was compressed'''
+    if payload and ord(payload[0]) & MARKER_BIT and ord(payload[0]) & COMPRESSION_MASK:
+        compression_id = ord(payload[0]) & COMPRESSION_MASK
+        try:
+            compressor = COMPRESSORS_BY_ID[compression_id]
+        except KeyError:
+            raise CodecError('Unsupported compression: {0}'.format(compression_id))
+
+        started = time.time()
+        payload = compressor.decompress(_as_bytes(payload[1:]), max_size)
+        if stats is not None:
+            stats.add_decompressed(time.time() - started)
+    return payload
+
+
+def decode_payload(payload, stats=None, max_size=None):
+    payload = decompress_payload(payload, stats, max_size)
+    return codec_of(payload).decode(payload)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+'''
+Payload compression, negotiated per connection
+
+zlib is always available, zstd only when the zstandard package is installed.
+'''
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CompressionError(ValueError):
+    pass
+
+
+def _within(decompressed, max_size):
+    # Only max_size + 1 bytes are ever inflated, a small frame can't expand into gigabytes
+    if len(decompressed) > max_size:
+        raise CompressionError('Payload decompresses to more than {0} bytes.'.format(max_size))
+    return decompressed
+
+
+class ZlibCompressor(object):
+
+    name = 'zlib'
+    compression_id = 1
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, max_size=None):
+        try:
+            if max_size is None:
+                return zlib.decompress(data)
+            decompressed = zlib.decompressobj().decompress(data, max_size + 1)
+        except zlib.error as exc:
+            raise CompressionError(str(exc))
+        return _within(decompressed, max_size)
+
+
+class ZstdCompressor(object):
+
+    name = 'zstd'
+    compression_id = 2
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data, max_size=None):
+        try:
+            if max_size is None:
+                return zstandard.ZstdDecompressor().decompress(data)
+            decompressed = zstandard.ZstdDecompressor().stream_reader(data).read(max_size + 1)
+        except zstandard.ZstdError as exc:
+            raise CompressionError(str(exc))
+        return _within(decompressed, max_size)
+
+
+class CompressionStats(object):
+    '''Bytes before and after compression, and the time spent on it'''
+
+    def __init__(self):
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+
+    def add_compressed(self, raw_bytes, wire_bytes, seconds):
+        self.raw_bytes += raw_bytes
+        self.wire_bytes += wire_bytes
+        self.compress_time += seconds
+
+    def add_decompressed(self, seconds):
+        self.decompress_time += seconds
+
+    @property
+    def ratio(self):
+        if not self.wire_bytes:
+            return 1.0
+        return float(self.raw_bytes) / self.wire_bytes
+
+
+COMPRESSORS = [ZlibCompressor()]
+if zstandard is not None:
+    COMPRESSORS.insert(0, ZstdCompressor())
+
+COMPRESSORS_BY_NAME = dict((compressor.name, compressor) for compressor in COMPRESSORS)
+COMPRESSORS_BY_ID = dict((compressor.compression_id, compressor) for compressor in COMPRESSORS)
+
+# Preferred order when negotiating, the first one supported by both sides wins
+SUPPORTED_COMPRESSIONS = tuple(compressor.name for compressor in COMPRESSORS)
+
+
+def get_compressor(name):
+    return COMPRESSORS_BY_NAME.get(name)
+
+
+def negotiate_compression(offered_compressions):
+    for name in SUPPORTED_COMPRESSIONS:
+        if name in (offered_compressions or ()):
+            return COMPRESSORS_BY_NAME[name]
+    return None
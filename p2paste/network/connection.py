@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+Server side state of a single client connection
+'''
+
+from network.base import FrameReader, WRITE_SIZE, COALESCE_SIZE
+from network.codec import JSON_CODEC
+from network.compression import CompressionStats
+from network.limits import RateLimiter
+from collections import deque
+import itertools
+import time
+
+
+class LatencySamples(object):
+    '''Keeps the most recent delivery latencies of a connection'''
+
+    def __init__(self, max_samples=1024):
+        self.samples = deque(maxlen=max_samples)
+
+    def add(self, latency):
+        self.samples.append(latency)
+
+    def __iter__(self):
+        return iter(list(self.samples))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, percent):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        index = min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class OutboundQueue(object):
+    '''Bounded buffer of encoded frames waiting for the socket to become writable'''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.frames = deque()
+        self.size = 0
+        self.offset = 0
+        self.sent_total = 0
+        # Bytes handed to the socket and not all written yet. TLS wants the same bytes again
+        # after a would-block, so the batch is only rebuilt once it's written.
+        self.batch = None
+        self.batch_offset = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, frame):
+        if self.size + len(frame) > self.max_size:
+            return False
+
+        self.frames.append((frame, time.time()))
+        self.size += len(frame)
+        return True
+
+    def next_write(self):
+        '''
+        Bytes to write next: the small frames at the head joined together, or a slice of a large
+        frame, which isn't copied
+        '''
+        if self.batch is None:
+            frame, _enqueued_at = self.frames[0]
+            remaining = len(frame) - self.offset
+            if remaining >= COALESCE_SIZE or len(self.frames) == 1:
+                self.batch = frame.view[self.offset:self.offset + WRITE_SIZE]
+            else:
+                parts = [frame.data[self.offset:]]
+                for frame, _enqueued_at in itertools.islice(self.frames, 1, None):
+                    if remaining + len(frame) > COALESCE_SIZE:
+                        break
+                    parts.append(frame.data)
+                    remaining += len(frame)
+                self.batch = memoryview(''.join(parts))
+            self.batch_offset = 0
+        return self.batch[self.batch_offset:]
+
+    def advance(self, sent):
+        '''Consumes written bytes, returns the frames they completed with their queueing latencies'''
+        self.batch_offset += sent
+        if self.batch_offset == len(self.batch):
+            self.batch = None
+        self.size -= sent
+        self.sent_total += sent
+
+        completed = []
+        now = time.time()
+        while sent:
+            frame, enqueued_at = self.frames[0]
+            written = min(sent, len(frame) - self.offset)
+            self.offset += written
+            sent -= written
+            if self.offset < len(frame):
+                break
+            self.frames.popleft()
+            self.offset = 0
+            completed.append((frame, now - enqueued_at))
+        return completed
+
+    def clear(self):
+        '''Drops every queued frame, and returns them'''
+        dropped = [frame for frame, _enqueued_at in self.frames]
+        self.frames.clear()
+        self.size = 0
+        self.offset = 0
+        self.batch = None
+        return dropped
+
+
+class Connection(object):
+
+    (HANDSHAKING, ESTABLISHED, CLOSED) = range(3)
+
+    def __init__(self, secured_socket, address, handshake_timeout, max_outbound_size, max_inbound_size,
+                 rate_limits):
+        self.socket = secured_socket
+        self.fd = secured_socket.fileno()
+        self.address = address
+        self.state = Connection.HANDSHAKING
+        self.poll_events = 0
+        self.accepted_at = time.time()
+        self.handshake_deadline = self.accepted_at + handshake_timeout
+        self.frame_reader = FrameReader(max_frame_size=max_inbound_size)
+        # Bytes of the receive buffer counted against the server's memory ceiling
+        self.buffered = len(self.frame_reader.buffer)
+        self.codec = JSON_CODEC
+        self.compressor = None
+        self.compression_stats = CompressionStats()
+        self.outbound = OutboundQueue(max_outbound_size)
+        self.latencies = LatencySamples()
+        # Picked to free memory past the server's memory ceiling, nothing is queued for it anymore
+        self.evicted = False
+        self.rate_limiter = RateLimiter(rate_limits)
+        # [payload, package once decoded] of the frames received and not handled yet. They are only
+        # left over while the client is throttled, which stops reading from it until this time.
+        self.pending = deque()
+        self.throttled_until = None
+
+    @property
+    def established(self):
+        return self.state == Connection.ESTABLISHED
+
+    def handshake_expired(self, now):
+        return not self.established and now > self.handshake_deadline
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''
+Memory and rate limits of the server
+
+Every connection may buffer one incoming frame of up to its inbound budget, and
+queue up to its outbound budget of frames for the client. On top of those, the
+memory ceiling bounds what all the connections hold together. Past the ceiling,
+the memory policy decides what gives:
+
+    drop        broadcasts aren't queued for the clients holding more than their share
+    disconnect  the clients holding the most are disconnected, slowest first
+    degrade     no client is read from until the queues drained well below the ceiling,
+                the clients holding the most are disconnected if that takes too long
+
+Each connection also gets a token bucket per rate limited package type, and one
+for all its frames. The latter is checked before a frame is decompressed or
+decoded, so even frames whose type can't be read off the header cost nothing
+past their rate. A frame over a rate is either dropped, or held back with
+everything the client sent after it, and the client isn't read from until the
+bucket has a token again.
+'''
+
+from network.base import MAX_FRAME_SIZE
+import time
+
+
+POLICY_DROP = 'drop'
+POLICY_DISCONNECT = 'disconnect'
+POLICY_DEGRADE = 'degrade'
+MEMORY_POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_DEGRADE)
+
+# A degraded server reads again once it holds less than this share of the ceiling
+RESUME_RATIO = 0.75
+
+RATE_DROP = 'drop'
+RATE_THROTTLE = 'throttle'
+RATE_POLICIES = (RATE_DROP, RATE_THROTTLE)
+
+# Rate limit key every frame counts against, whatever its package type
+ALL_FRAMES = 'all'
+
+# Tokens are refilled in floating point, a bucket this close to a whole token has one
+TOKEN_EPSILON = 1e-6
+
+
+class ServerLimits(object):
+    '''Limits a server is created with, handed to the worker processes of a cluster as they are'''
+
+    def __init__(self, inbound_buffer_size=MAX_FRAME_SIZE, frame_size_limits=None, memory_ceiling=None,
+                 memory_policy=POLICY_DISCONNECT, rate_limits=None, rate_policy=RATE_THROTTLE):
+        if memory_policy not in MEMORY_POLICIES:
+            raise ValueError('Unknown memory policy: {0}'.format(memory_policy))
+        if rate_policy not in RATE_POLICIES:
+            raise ValueError('Unknown rate policy: {0}'.format(rate_policy))
+        self.inbound_buffer_size = inbound_buffer_size
+        # Package type -> largest payload accepted once decompressed, other types are bound by the inbound budget
+        self.frame_size_limits = dict(frame_size_limits or ())
+        # None, or 0, for no ceiling
+        self.memory_ceiling = memory_ceiling or None
+        self.memory_policy = memory_policy
+        # Package type, or ALL_FRAMES -> (frames per second, burst) a client may send, other types aren't limited
+        self.rate_limits = dict(rate_limits or ())
+        self.rate_policy = rate_policy
+
+
+class MemoryBudget(object):
+    '''
+    Bytes held for the connections of a server: every queued frame once, however many
+    outbound queues share it, the receive buffers, and what the server's handlers hold on
+    to of the received packages. Frames are counted under the server's outbound lock, the
+    rest only changes on the listener thread.
+    '''
+
+    def __init__(self, ceiling):
+        self.ceiling = ceiling
+        self.queued_bytes = 0
+        self.buffered_bytes = 0
+        self.held_bytes = 0
+
+    @property
+    def used(self):
+        return self.queued_bytes + self.buffered_bytes + self.held_bytes
+
+    def exceeded(self, extra=0):
+        return self.ceiling is not None and self.used + extra > self.ceiling
+
+    @property
+    def resume_level(self):
+        return None if self.ceiling is None else int(self.ceiling * RESUME_RATIO)
+
+    def recovered(self):
+        '''Far enough below the ceiling to stop degrading'''
+        return self.ceiling is None or self.used < self.resume_level
+
+    def frame_queued(self, frame):
+        frame.queues += 1
+        if frame.queues == 1:
+            self.queued_bytes += len(frame)
+
+    def frame_released(self, frame):
+        frame.queues -= 1
+        if not frame.queues:
+            self.queued_bytes -= len(frame)
+
+    def buffer_resized(self, change):
+        self.buffered_bytes += change
+
+    def held_resized(self, change):
+        self.held_bytes += change
+
+
+class TokenBucket(object):
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def take(self, now):
+        '''Takes a token, returns 0 if there was one, or else the seconds until there is'''
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens + TOKEN_EPSILON >= 1:
+            self.tokens = max(0.0, self.tokens - 1)
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    '''Token buckets of a connection, made as the first frame of their type comes in, and its throttle counts'''
+
+    def __init__(self, rate_limits):
+        self.rate_limits = rate_limits
+        self.buckets = dict()
+        # Package type -> frames dropped or held back
+        self.throttled = dict()
+
+    def admit(self, package_type, now):
+        '''0 if a frame of the type may be handled now, or else the seconds until it may'''
+        rate_limit = self.rate_limits.get(package_type)
+        if rate_limit is None:
+            return 0
+        bucket = self.buckets.get(package_type)
+        if bucket is None:
+            bucket = self.buckets[package_type] = TokenBucket(*rate_limit)
+        return bucket.take(now)
+
+    def count(self, package_type):
+        self.throttled[package_type] = self.throttled.get(package_type, 0) + 1
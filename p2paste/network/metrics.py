@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+'''
+In-process metrics, rendered in the Prometheus text exposition format
+
+Updating a counter or a histogram is a dict update or two, without locking, as
+they sit on the send and receive paths. Values that are cheap to read at scrape
+time (connected clients, queue depths, per-connection byte counts) are callback
+metrics, which cost nothing until they're rendered.
+'''
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from bisect import bisect_left
+import threading
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0)
+WRITE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(u'{0}="{1}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = dict()
+
+    def inc(self, amount=1, label_values=()):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        return [(self.name, label_values, (), value) for label_values, value in self.values.items()]
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def set(self, value, label_values=()):
+        self.values[label_values] = value
+
+
+class CallbackMetric(object):
+    '''Counter or gauge read from a function returning {label values: value} at scrape time'''
+
+    def __init__(self, name, description, kind, labels, read):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.labels = labels
+        self.read = read
+
+    def samples(self):
+        return [(self.name, label_values, (), value) for label_values, value in self.read().items()]
+
+
+class Histogram(object):
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = ()
+        self.buckets = tuple(buckets)
+        # One slot per bucket plus the +Inf one, kept non-cumulative until rendered
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            samples.append((self.name + '_bucket', (), (('le', _format_value(bound)),), cumulative))
+        samples.append((self.name + '_sum', (), (), self.total))
+        samples.append((self.name + '_count', (), (), cumulative))
+        return samples
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self._register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self._register(Gauge(name, description, labels))
+
+    def callback(self, name, description, kind, read, labels=()):
+        return self._register(CallbackMetric(name, description, kind, labels, read))
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, description, buckets))
+
+    def snapshot(self):
+        '''Every sample as a flat dict, keyed the way render writes them'''
+        return dict(
+            (name + _format_labels(metric.labels, label_values, extra_labels), value)
+            for metric in self.metrics
+            for name, label_values, extra_labels, value in metric.samples()
+        )
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(u'# HELP {0} {1}'.format(metric.name, metric.description))
+            lines.append(u'# TYPE {0} {1}'.format(metric.name, metric.kind))
+            for name, label_values, extra_labels, value in metric.samples():
+                lines.append(u'{0}{1} {2}'.format(
+                    name, _format_labels(metric.labels, label_values, extra_labels), _format_value(value)))
+        return u'\n'.join(lines) + u'\n'
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsEndpoint(object):
+    '''Serves the rendered metrics over HTTP on localhost, for a Prometheus scraper'''
+
+    def __init__(self, logger, render):
+        self.logger = logger
+        self.render = render
+        self.http_server = None
+
+    def start(self, port):
+        self.http_server = HTTPServer(('127.0.0.1', port), _MetricsRequestHandler)
+        self.http_server.render = self.render
+        endpoint_thread = threading.Thread(target=self.http_server.serve_forever)
+        endpoint_thread.daemon = True
+        endpoint_thread.start()
+        self.logger.info('Metrics served on: {0}'.format(self.http_server.server_address))
+        return self.http_server.server_address
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
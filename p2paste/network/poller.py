@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+'''
+Readiness notification module, picks the best polling mechanism of the platform
+'''
+
+import select
+import socket
+
+
+EVENT_READ = 0x001
+EVENT_WRITE = 0x004
+EVENT_ERROR = 0x008 | 0x010
+
+
+class EpollPoller(object):
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def register(self, fd, events):
+        self.epoll.register(fd, events | EVENT_ERROR)
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, events | EVENT_ERROR)
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        return self.epoll.poll(timeout)
+
+    def close(self):
+        self.epoll.close()
+
+
+class PollPoller(object):
+
+    def __init__(self):
+        self.poller = select.poll()
+
+    def register(self, fd, events):
+        self.poller.register(fd, events | EVENT_ERROR)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events | EVENT_ERROR)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        return self.poller.poll(int(timeout * 1000))
+
+    def close(self):
+        pass
+
+
+class SelectPoller(object):
+    '''Fallback for platforms without epoll or poll (Windows)'''
+
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, events):
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+        if events & EVENT_READ:
+            self.readers.add(fd)
+        if events & EVENT_WRITE:
+            self.writers.add(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        sread, swrite, sexc = select.select(self.readers, self.writers, self.readers | self.writers, timeout)
+        events = dict()
+        for fd in sread:
+            events[fd] = events.get(fd, 0) | EVENT_READ
+        for fd in swrite:
+            events[fd] = events.get(fd, 0) | EVENT_WRITE
+        for fd in sexc:
+            events[fd] = events.get(fd, 0) | EVENT_ERROR
+        return events.items()
+
+    def close(self):
+        self.readers.clear()
+        self.writers.clear()
+
+
+class Waker(object):
+    '''Socket pair used by other threads to interrupt a poll in progress'''
+
+    def __init__(self):
+        if hasattr(socket, 'socketpair'):
+            self.reader, self.writer = socket.socketpair()
+        else:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            self.writer = socket.create_connection(listener.getsockname())
+            self.reader, _address = listener.accept()
+            listener.close()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def wake(self):
+        try:
+            self.writer.send('x')
+        except socket.error:
+            # The pair is already full, the poller will wake up anyway
+            pass
+
+    def consume(self):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+def make_poller():
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
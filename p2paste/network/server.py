@@ -3,118 +3,720 @@
 Networking server module
 '''
 
-from network.base import NetworkBase, EventHandler, ConnectionBroken
+from network.base import (NetworkBase, EventHandler, ConnectionBroken, WOULD_BLOCK_ERRORS,
+                          RECEIVE_SIZE, package_type_of, make_ssl_context, set_no_delay)
+from network.connection import Connection
+from network.limits import (ServerLimits, MemoryBudget, POLICY_DROP, POLICY_DISCONNECT, POLICY_DEGRADE, RATE_THROTTLE,
+                            ALL_FRAMES)
+from network.codec import negotiate_codec, peek_package_type
+from network.compression import negotiate_compression
+from network.poller import make_poller, Waker, EVENT_READ, EVENT_WRITE, EVENT_ERROR
+from network.metrics import WRITE_BUCKETS
+from collections import deque
 import threading
 import select
 import socket
+import errno
+import time
 import ssl
+import sys
+
+
+# Longest the listener waits for events, throttled clients are handled again sooner
+POLL_TIMEOUT = 1
+
+# Python 2 doesn't name it, the value is the Linux one
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
+
+def make_listening_socket(port, reuse_port=False):
+    '''Non-blocking socket bound to the port on the host address, not listening yet'''
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            server_socket.close()
+            raise socket.error(errno.ENOPROTOOPT, 'SO_REUSEPORT is not supported on this platform')
+        server_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    server_socket.setblocking(False)
+    server_socket.bind((socket.gethostbyname(socket.gethostname()), port))
+    return server_socket
 
 
 class Server(NetworkBase):
-    
-    connect_handler = EventHandler()
-    disconnect_handler = EventHandler()
-    data_handler = EventHandler()
-    
-    def __init__(self, logger, max_timeout, ssl_version, certificate_path, key_path):
-        super(Server, self).__init__(logger)
+
+    def __init__(self, logger, max_timeout, ssl_version, certificate_path, key_path, max_outbound_size,
+                 compression_threshold, log_sample_rate=1, limits=None):
+        super(Server, self).__init__(logger, log_sample_rate)
+        self.connect_handler = EventHandler()
+        self.disconnect_handler = EventHandler()
+        self.data_handler = EventHandler()
         self.max_timeout = max_timeout
         self.ssl_version = ssl_version
         self.certificate_path = certificate_path
         self.key_path = key_path
-        
+        # Built by host, once for every connection
+        self.ssl_context = None
+        self.max_outbound_size = max_outbound_size
+        self.compression_threshold = compression_threshold
+        # Frame size limits, inbound budget and memory ceiling, the defaults set no ceiling
+        self.limits = limits or ServerLimits()
+        self.frame_size_limits = self.limits.frame_size_limits
+        self.memory = MemoryBudget(self.limits.memory_ceiling)
+        # Connections evicted past the memory ceiling, for the listener to disconnect
+        self.evictions = set()
+        # Set by the degrade policy while the server is past its memory ceiling, since paused_at
+        self.reading_paused = False
+        self.paused_at = None
+        # Connections not read from until their throttled_until, only the listener touches them
+        self.throttled = set()
+        # (callback, args) other threads hand to the listener thread, run in order between two polls
+        self.calls = deque()
+
         self.open_connections = dict()
+        self.connections = dict()
+        self.handshakes = dict()
+        self.poller = None
+        self.waker = None
+        self.outbound_lock = threading.Lock()
+        self.pending_writes = set()
         self.server_running = threading.Event()
         self.listener_stopped = threading.Event()
-    
+        self._register_metrics()
+
+    def _register_metrics(self):
+        self.metrics.callback('p2paste_connected_clients', 'Clients with an established connection', 'gauge',
+                              lambda: {(): len(self._established_connections())})
+        self.metrics.callback('p2paste_received_bytes_total', 'Bytes received, by client', 'counter',
+                              lambda: self._per_connection(lambda connection: connection.frame_reader.received_total),
+                              ('peer',))
+        self.metrics.callback('p2paste_sent_bytes_total', 'Bytes sent, by client', 'counter',
+                              lambda: self._per_connection(lambda connection: connection.outbound.sent_total),
+                              ('peer',))
+        self.metrics.callback('p2paste_outbound_queued_bytes', 'Bytes waiting in the outbound queue, by client', 'gauge',
+                              lambda: self._per_connection(lambda connection: connection.outbound.size),
+                              ('peer',))
+        self.delivery_seconds = self.metrics.histogram(
+            'p2paste_delivery_seconds', 'Time a frame waits in the outbound queue of a client until it is written')
+        self.fanout_seconds = self.metrics.histogram(
+            'p2paste_broadcast_fanout_seconds', 'Time from encoding a broadcast frame until every recipient got it')
+        self.frames_per_write = self.metrics.histogram(
+            'p2paste_frames_per_write', 'Frames completed by each socket write, the small ones queued for a client '
+            'are written together', WRITE_BUCKETS)
+        self.metrics.callback('p2paste_memory_used_bytes', 'Bytes held in queued frames, once however many clients '
+                              'share a frame, in receive buffers and by the handlers', 'gauge',
+                              lambda: {(): self.memory.used})
+        self.metrics.callback('p2paste_reading_paused', 'Whether reading from clients is paused past the memory '
+                              'ceiling', 'gauge', lambda: {(): int(self.reading_paused)})
+        self.frames_dropped = self.metrics.counter(
+            'p2paste_frames_dropped_total', 'Broadcast frames not queued for a client holding more than its share, '
+            'past the memory ceiling')
+        self.evicted_clients = self.metrics.counter(
+            'p2paste_evicted_clients_total', 'Clients disconnected to get back below the memory ceiling')
+        self.metrics.callback('p2paste_throttled_frames_total', 'Frames over their rate limit, dropped or held back, '
+                              'by client and package type', 'counter', self._throttle_samples, ('peer', 'type'))
+        self.handshake_seconds = self.metrics.histogram(
+            'p2paste_tls_handshake_seconds', 'Time from accepting a connection until its TLS handshake is done')
+        self.metrics.callback('p2paste_tls_sessions_total',
+                              'TLS handshakes accepted, and sessions resumed (hits) or not found (misses)', 'counter',
+                              self._session_stats, ('result',))
+
+    def _established_connections(self):
+        return [connection for connection in self.connections.values() if connection.established]
+
+    def _throttle_samples(self):
+        return dict((('{0}:{1}'.format(*address), package_type), count)
+                    for address, counts in self.throttle_counts().items()
+                    for package_type, count in counts.items())
+
+    def _per_connection(self, read):
+        return dict((('{0}:{1}'.format(*connection.address),), read(connection))
+                    for connection in self._established_connections())
+
     def __call__(self):
         return self.server_socket
-    
+
     @property
     def all_clients(self):
         return self.open_connections
-    
+
+    def _queue_frame(self, target_socket, frame, shared_by=1, droppable=False):
+        connection = self._connection_of(target_socket)
+        if connection is None or not connection.established:
+            return False
+
+        with self.outbound_lock:
+            if connection.evicted or not connection.established:
+                return False
+            added = 0 if frame.queues else len(frame)
+            if self.memory.exceeded(added):
+                if self.limits.memory_policy == POLICY_DROP and droppable and self._over_share(connection):
+                    # Lost to this client, so the broadcast is done once the others got it
+                    self.frames_dropped.inc()
+                    frame.fanout -= 1
+                    return True
+                if self.limits.memory_policy == POLICY_DISCONNECT:
+                    self._evict_slow_consumers(self.memory.ceiling - added)
+                    if connection.evicted:
+                        return False
+            if not connection.outbound.push(frame):
+                self.logger.error('{0}: Outbound buffer full, client is not reading.'.format(connection.address))
+                return False
+            self.memory.frame_queued(frame)
+            self.pending_writes.add(connection.fd)
+        # The compression of a shared frame is paid once, and split between its recipients
+        connection.compression_stats.add_compressed(frame.raw_size, frame.payload_size, frame.compress_time / shared_by)
+        return True
+
+    def _frame_for(self, connection, outgoing_data):
+        return self.nb_frame(outgoing_data, connection.codec, connection.compressor, self.compression_threshold)
+
+    def _wake_listener(self):
+        if threading.current_thread() is not self.listener_thread:
+            self.waker.wake()
+
+    def call_on_listener(self, callback, *args):
+        '''
+        Runs callback(*args) on the listener thread, after the events at hand. Whatever closes
+        sockets, or changes what the data handler does, is run there instead of on another thread.
+        '''
+        self.calls.append((callback, args))
+        self._wake_listener()
+
+    def _run_calls(self):
+        # Calls queued by the ones run here wait for the next round
+        for _index in xrange(len(self.calls)):
+            callback, args = self.calls.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                self.logger.exception('Call on the listener thread failed.')
+
+    def send_frame_to(self, target_socket, frame):
+        queued = self._queue_frame(target_socket, frame)
+        self._wake_listener()
+        if not queued:
+            raise ConnectionBroken
+
+    def broadcast(self, target_sockets, outgoing_data):
+        '''
+        Encodes (and compresses) the data once per wire format in use among the targets, and
+        queues the same frame for each of them. Returns the sockets it couldn't be queued for.
+        '''
+        groups = dict()
+        failed_sockets = []
+        for target_socket in target_sockets:
+            connection = self._connection_of(target_socket)
+            if connection is None:
+                failed_sockets.append(target_socket)
+                continue
+            groups.setdefault((connection.codec, connection.compressor), []).append(connection)
+
+        for recipients in groups.itervalues():
+            frame = self._frame_for(recipients[0], outgoing_data)
+            frame.fanout = len(recipients)
+            failed_recipients = 0
+            for connection in recipients:
+                if not self._queue_frame(connection.socket, frame, len(recipients), droppable=True):
+                    failed_sockets.append(connection.socket)
+                    failed_recipients += 1
+            if failed_recipients:
+                with self.outbound_lock:
+                    frame.fanout -= failed_recipients
+                    delivered = not frame.fanout and failed_recipients < len(recipients)
+                if delivered:
+                    self.fanout_seconds.observe(time.time() - frame.created)
+
+        self._wake_listener()
+        self.frames_sent.inc(len(target_sockets) - len(failed_sockets), (package_type_of(outgoing_data),))
+        if groups:
+            self.traffic.sent('{0} clients'.format(len(target_sockets)), outgoing_data, len(frame))
+        return failed_sockets
+
     def send_to(self, target_socket, outgoing_data):
-        self.nb_send(target_socket, outgoing_data)
-        self.logger.debug('Data sent to {0} with: {1}'.format(target_socket.getpeername(), str(outgoing_data)))
-    
-    def receive_from(self, target_socket):
-        return self.nb_receive(target_socket)
-    
+        connection = self._connection_of(target_socket)
+        if connection is None:
+            raise ConnectionBroken
+        frame = self._frame_for(connection, outgoing_data)
+        self.send_frame_to(target_socket, frame)
+        self.frames_sent.inc(1, (package_type_of(outgoing_data),))
+        self.traffic.sent(connection.address, outgoing_data, len(frame))
+
+    def negotiate_codec(self, target_socket, offered_codecs):
+        '''Picks the codec used for everything sent to the client from now on'''
+        connection = self._connection_of(target_socket)
+        if connection is None:
+            raise ConnectionBroken
+        connection.codec = negotiate_codec(offered_codecs)
+        return connection.codec.name
+
+    def negotiate_compression(self, target_socket, offered_compressions):
+        '''Picks the compression of large frames sent to the client, None if they have nothing in common'''
+        connection = self._connection_of(target_socket)
+        if connection is None:
+            raise ConnectionBroken
+        connection.compressor = negotiate_compression(offered_compressions)
+        return connection.compressor.name if connection.compressor else None
+
+    def compression_stats(self):
+        '''Compression ratio and seconds spent (de)compressing of every established client, keyed by address'''
+        return dict(
+            (connection.address, dict(
+                ratio=connection.compression_stats.ratio,
+                compress_time=connection.compression_stats.compress_time,
+                decompress_time=connection.compression_stats.decompress_time
+            ))
+            for connection in self._established_connections()
+        )
+
+    def throttle_counts(self):
+        '''Frames over their rate limit of every established client by package type, keyed by address'''
+        return dict(
+            (connection.address, dict(connection.rate_limiter.throttled))
+            for connection in self._established_connections()
+        )
+
+    def delivery_latencies(self, percent):
+        '''Queue-to-wire latency percentile of every established client, keyed by address'''
+        return dict(
+            (connection.address, connection.latencies.percentile(percent))
+            for connection in self._established_connections()
+        )
+
+    def _connection_of(self, target_socket):
+        try:
+            connection = self.connections.get(target_socket.fileno())
+        except socket.error:
+            return None
+        if connection is not None and connection.socket is target_socket:
+            return connection
+        return None
+
+    def _set_poll_events(self, connection, events):
+        if connection.poll_events != events:
+            self.poller.modify(connection.fd, events)
+            connection.poll_events = events
+
+    def _read_events(self, connection):
+        return 0 if self.reading_paused or connection.throttled_until is not None else EVENT_READ
+
+    def _held_by(self, connection):
+        '''Memory a connection holds over what an idle one does'''
+        return connection.outbound.size + connection.buffered - RECEIVE_SIZE
+
+    def _over_share(self, connection):
+        # The server socket is among the open connections
+        return connection.outbound.size * max(1, len(self.open_connections) - 1) > self.memory.ceiling
+
+    def _evict_slow_consumers(self, limit):
+        '''
+        Evicts the clients holding the most, until the rest fits in limit bytes. Their queues
+        are dropped right away, and the listener disconnects them. Called with the outbound
+        lock held.
+        '''
+        candidates = [connection for connection in self._established_connections() if not connection.evicted]
+        candidates.sort(key=self._held_by, reverse=True)
+        releasing = 0
+        for connection in candidates:
+            if self.memory.used - releasing <= limit or self._held_by(connection) <= 0:
+                break
+            self.logger.error('{0}: Evicted, {1} bytes held past the memory ceiling.'.format(
+                connection.address, self._held_by(connection)))
+            connection.evicted = True
+            for frame in connection.outbound.clear():
+                self.memory.frame_released(frame)
+            releasing += connection.buffered
+            self.evictions.add(connection)
+            self.evicted_clients.inc()
+        if self.evictions:
+            self._wake_listener()
+
+    def _disconnect_evicted(self):
+        with self.outbound_lock:
+            evictions, self.evictions = self.evictions, set()
+        for connection in evictions:
+            if self.connections.get(connection.fd) is connection:
+                self.disconnect_handler(connection.socket)
+
+    def _pause_reading(self, paused):
+        self.reading_paused = paused
+        self.paused_at = time.time() if paused else None
+        if paused:
+            self.logger.warning('Past the memory ceiling with {0} bytes, reading paused.'.format(self.memory.used))
+        else:
+            self.logger.warning('Down to {0} bytes, reading resumed.'.format(self.memory.used))
+        for connection in self._established_connections():
+            events = self._read_events(connection) | (EVENT_WRITE if connection.outbound else 0)
+            self._set_poll_events(connection, events)
+
+    def _apply_memory_policy(self):
+        self._disconnect_evicted()
+        if self.limits.memory_policy != POLICY_DEGRADE:
+            return
+        if not self.reading_paused and self.memory.exceeded():
+            self._pause_reading(True)
+        elif self.reading_paused and self.memory.recovered():
+            self._pause_reading(False)
+        elif self.reading_paused and time.time() - self.paused_at > self.max_timeout:
+            # Clients that don't read at all would keep the server paused for good
+            with self.outbound_lock:
+                self._evict_slow_consumers(self.memory.resume_level)
+            self.paused_at = time.time()
+            self._disconnect_evicted()
+
+    def _buffer_resized(self, connection):
+        with self.outbound_lock:
+            if connection.state == Connection.CLOSED:
+                return
+            size = len(connection.frame_reader.buffer)
+            self.memory.buffer_resized(size - connection.buffered)
+            connection.buffered = size
+            if self.limits.memory_policy == POLICY_DISCONNECT and self.memory.exceeded():
+                self._evict_slow_consumers(self.memory.ceiling)
+
+    def _drop_connection(self, connection):
+        with self.outbound_lock:
+            for frame in connection.outbound.clear():
+                self.memory.frame_released(frame)
+            if connection.state != Connection.CLOSED:
+                self.memory.buffer_resized(-connection.buffered)
+            connection.state = Connection.CLOSED
+        self.connections.pop(connection.fd, None)
+        self.handshakes.pop(connection.fd, None)
+        self.open_connections.pop(connection.socket, None)
+        try:
+            self.poller.unregister(connection.fd)
+        except (KeyError, ValueError, IOError, OSError):
+            pass
+        self.nb_close_socket(connection.socket)
+
     def _close_socket(self, target_socket):
+        connection = self._connection_of(target_socket)
+        if connection is not None:
+            self._drop_connection(connection)
+            return
         self.open_connections.pop(target_socket, None)
         self.nb_close_socket(target_socket)
-    
+
     def disconnect_client(self, target_socket):
         self._close_socket(target_socket)
-        
+
+    def _session_stats(self):
+        if self.ssl_context is None:
+            return dict()
+        stats = self.ssl_context.session_stats()
+        return dict(((result,), stats[result]) for result in ('accept', 'hits', 'misses', 'timeouts'))
+
     def _accept_new_connection(self):
+        while True:
+            try:
+                new_client_socket, address = self.server_socket.accept()
+            except socket.error as se:
+                if se.errno not in WOULD_BLOCK_ERRORS:
+                    self.logger.error('{0}: {1}'.format(se.__class__.__name__, str(se)))
+                return
+
+            try:
+                new_client_socket.setblocking(False)
+                set_no_delay(new_client_socket)
+                secured_client_socket = self.ssl_context.wrap_socket(
+                    new_client_socket,
+                    server_side=True,
+                    do_handshake_on_connect=False
+                )
+            except (socket.error, IOError) as se:
+                self.logger.error('{0}: {1} - {2}'.format(address, se.__class__.__name__, str(se)))
+                self.nb_close_socket(new_client_socket)
+                continue
+
+            connection = Connection(secured_client_socket, address, self.max_timeout, self.max_outbound_size,
+                                    self.limits.inbound_buffer_size, self.limits.rate_limits)
+            with self.outbound_lock:
+                self.memory.buffer_resized(connection.buffered)
+            self.connections[connection.fd] = connection
+            self.handshakes[connection.fd] = connection
+            self.poller.register(connection.fd, EVENT_READ)
+            connection.poll_events = EVENT_READ
+            try:
+                self._continue_handshake(connection)
+            except Exception:
+                self._client_failed(connection)
+
+    def _continue_handshake(self, connection):
+        try:
+            connection.socket.do_handshake()
+        except ssl.SSLError as se:
+            if se.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self._set_poll_events(connection, EVENT_READ)
+                return
+            if se.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self._set_poll_events(connection, EVENT_WRITE)
+                return
+            self.logger.error('{0}: {1} - {2}'.format(connection.address, se.__class__.__name__, str(se)))
+            self._drop_connection(connection)
+            return
+        except socket.error as se:
+            self.logger.error('{0}: {1} - {2}'.format(connection.address, se.__class__.__name__, str(se)))
+            self._drop_connection(connection)
+            return
+
+        connection.state = Connection.ESTABLISHED
+        self.handshake_seconds.observe(time.time() - connection.accepted_at)
+        self.handshakes.pop(connection.fd, None)
+        self._set_poll_events(connection, self._read_events(connection))
+        self.open_connections[connection.socket] = connection.address
+        self.connect_handler(connection.socket)
+
+    def _expire_handshakes(self):
+        now = time.time()
+        for connection in self.handshakes.values():
+            if connection.handshake_expired(now):
+                self.logger.error('{0}: TLS handshake timed out.'.format(connection.address))
+                self._drop_connection(connection)
+
+    def _receive_packages(self, connection):
+        try:
+            frames = self.nb_read_available(connection.socket, connection.frame_reader, connection.address)
+        except ConnectionBroken as exc:
+            self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
+            self.disconnect_handler(connection.socket)
+            return
+
+        self._buffer_resized(connection)
+        # Frame, its package once decoded, and whether it's within the rate of all frames
+        connection.pending.extend([frame, None, False] for frame in frames)
+        self._handle_pending(connection)
+
+    def _decode_pending(self, connection, entry):
         try:
-            new_client_socket, address = self.server_socket.accept()
-            secured_client_socket = ssl.wrap_socket(
-                new_client_socket,
-                server_side=True,
-                certfile=self.certificate_path,
-                keyfile=self.key_path,
-                ssl_version=self.ssl_version
-            )
-            secured_client_socket.settimeout(self.max_timeout)
-            self.open_connections[secured_client_socket] = address
-            self.connect_handler(secured_client_socket)
-        except (socket.error, socket.timeout) as se:
-            self.logger.error('{0}: {1} - {2}'.format(address, se.__class__.__name__, str(se)))
-            self._close_socket(secured_client_socket)
-
-    def _process_active_sockets(self, all_active_sockets):
-        for active_socket in all_active_sockets:
-            if active_socket == self.server_socket:
+            entry[1] = self.nb_decode(entry[0], connection.frame_reader, connection.compression_stats,
+                                      connection.address)
+        except ConnectionBroken as exc:
+            self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
+            self.disconnect_handler(connection.socket)
+            return None
+        return entry[1]
+
+    def _handle_pending(self, connection):
+        '''
+        Hands the received packages to the data handler, in order. The rate of all frames is checked
+        before a frame is decoded, the rate of its type before too where the type can be read off the
+        header, and before it's handled anyway. Returns False while the client is throttled.
+        '''
+        pending = connection.pending
+        while pending:
+            # A handler may have dropped the client while processing the previous package
+            if connection.socket not in self.open_connections:
+                pending.clear()
+                return True
+            entry = pending[0]
+            if not entry[2]:
+                if self._over_rate(connection, ALL_FRAMES):
+                    if self.limits.rate_policy == RATE_THROTTLE:
+                        return False
+                    pending.popleft()
+                    continue
+                entry[2] = True
+
+            package_type = peek_package_type(entry[0]) if entry[1] is None else package_type_of(entry[1])
+            if package_type is None:
+                if self._decode_pending(connection, entry) is None:
+                    return True
+                package_type = package_type_of(entry[1])
+
+            if self._over_rate(connection, package_type):
+                if self.limits.rate_policy == RATE_THROTTLE:
+                    return False
+                pending.popleft()
+                continue
+
+            pending.popleft()
+            if entry[1] is None and self._decode_pending(connection, entry) is None:
+                return True
+            self.data_handler(connection.socket, entry[1])
+        return True
+
+    def _over_rate(self, connection, key):
+        '''
+        Takes a token of the rate limit, returns True if there was none. The connection is
+        then throttled, or else the frame is to be dropped, as the rate policy says.
+        '''
+        now = time.time()
+        wait = connection.rate_limiter.admit(key, now)
+        if not wait:
+            return False
+        connection.rate_limiter.count(key)
+        if self.limits.rate_policy == RATE_THROTTLE:
+            self.logger.debug('{0}: Throttled for {1:.3f}s.'.format(connection.address, wait))
+            connection.throttled_until = now + wait
+            self.throttled.add(connection)
+            self._set_poll_events(connection, connection.poll_events & ~EVENT_READ)
+        return True
+
+    def _resume_throttled(self):
+        now = time.time()
+        for connection in list(self.throttled):
+            if connection.throttled_until > now:
+                continue
+            self.throttled.discard(connection)
+            connection.throttled_until = None
+            try:
+                # A dropped client's frames are cleared by _handle_pending
+                if self._handle_pending(connection) and self.connections.get(connection.fd) is connection:
+                    events = self._read_events(connection) | (connection.poll_events & EVENT_WRITE)
+                    self._set_poll_events(connection, events)
+            except Exception:
+                self._client_failed(connection)
+
+    def _client_failed(self, connection):
+        '''
+        Disconnects a client whose package broke the handling of it, the other clients carry on.
+        Called from the exception handler.
+        '''
+        self.logger.exception('{0}: Handling the client failed, disconnecting it.'.format(connection.address))
+        connection.pending.clear()
+        connection.throttled_until = None
+        self.throttled.discard(connection)
+        if self.connections.get(connection.fd) is not connection:
+            return
+        try:
+            self.disconnect_handler(connection.socket)
+        except Exception:
+            self.logger.exception('{0}: Disconnecting the client failed.'.format(connection.address))
+        if self.connections.get(connection.fd) is connection:
+            self._drop_connection(connection)
+
+    def _poll_timeout(self):
+        if not self.throttled:
+            return POLL_TIMEOUT
+        due = min(connection.throttled_until for connection in self.throttled)
+        return min(POLL_TIMEOUT, max(0, due - time.time()))
+
+    def _flush_outbound(self, connection):
+        try:
+            with self.outbound_lock:
+                completed, frames_per_write = self.nb_send_available(connection.socket, connection.outbound)
+                drained = not connection.outbound
+                broadcasts_done = []
+                for frame, _latency in completed:
+                    self.memory.frame_released(frame)
+                    if frame.fanout:
+                        frame.fanout -= 1
+                        if not frame.fanout:
+                            broadcasts_done.append(frame)
+        except ConnectionBroken as exc:
+            self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
+            self.disconnect_handler(connection.socket)
+            return
+
+        now = time.time()
+        for frame_count in frames_per_write:
+            self.frames_per_write.observe(frame_count)
+        for _frame, latency in completed:
+            connection.latencies.add(latency)
+            self.delivery_seconds.observe(latency)
+        for frame in broadcasts_done:
+            self.fanout_seconds.observe(now - frame.created)
+        self._set_poll_events(connection, self._read_events(connection) | (0 if drained else EVENT_WRITE))
+
+    def _flush_pending_writes(self):
+        with self.outbound_lock:
+            pending_writes, self.pending_writes = self.pending_writes, set()
+
+        for fd in pending_writes:
+            connection = self.connections.get(fd)
+            if connection is None:
+                continue
+            try:
+                self._flush_outbound(connection)
+            except Exception:
+                self._client_failed(connection)
+
+    def _process_events(self, events):
+        for fd, event in events:
+            if fd == self.server_fd:
                 self._accept_new_connection()
                 continue
+            if fd == self.waker.fileno():
+                self.waker.consume()
+                continue
+
+            connection = self.connections.get(fd)
+            if connection is None:
+                continue
             try:
-                active_socket.settimeout(self.max_timeout)
-                received_data = self.receive_from(active_socket)
-                self.data_handler(active_socket, received_data)
-            except ConnectionBroken as exc:
-                self.logger.error('{0}: {1}'.format(exc.__class__.__name__, str(exc)))
-                self.disconnect_handler(active_socket)
-    
+                self._process_connection_event(connection, event)
+            except Exception:
+                self._client_failed(connection)
+
+    def _process_connection_event(self, connection, event):
+        if not connection.established:
+            self._continue_handshake(connection)
+            return
+        if event & EVENT_WRITE:
+            self._flush_outbound(connection)
+        if connection.pending:
+            # Throttled, its frames still point into the receive buffer, so it isn't read from.
+            # A hang up or an error is all that's reported meanwhile, and it would be reported again.
+            if event & EVENT_ERROR and connection.fd in self.connections:
+                self.disconnect_handler(connection.socket)
+            return
+        if event & ~EVENT_WRITE and connection.fd in self.connections:
+            self._receive_packages(connection)
+
     def _listener(self):
         self.logger.info('Server listener started.')
-  
+
         while self.server_running.is_set():
             try:
-                sread, _swrite, _sexc = select.select(self.open_connections, [], [], 1)
-            except (select.error, socket.error) as se:
+                events = self.poller.poll(self._poll_timeout())
+            except (select.error, IOError, OSError, socket.error) as se:
+                if se.args and se.args[0] == errno.EINTR:
+                    continue
                 self.logger.error('{0}: {1}'.format(se.__class__.__name__, str(se)))
                 self.server_running.clear()
                 self._close_socket(self.server_socket)
                 break
-            except socket.timeout as st:
-                self.logger.error('{0}: {1}'.format(st.__class__.__name__, str(st)))
-                continue
-            
-            self._process_active_sockets(sread)
-            
+
+            self._process_events(events)
+            self._run_calls()
+            self._resume_throttled()
+            self._flush_pending_writes()
+            self._apply_memory_policy()
+            self._expire_handshakes()
+
         self.logger.info('Listener stopped.')
         self.listener_stopped.set()
 
-    def host(self, port):
+    def host(self, port, reuse_port=False):
+        '''
+        With reuse_port, several processes listen on the same port and the kernel spreads the
+        incoming connections between them
+        '''
+        try:
+            self.ssl_context = make_ssl_context(self.ssl_version, self.certificate_path, self.key_path, True)
+        except (ssl.SSLError, IOError) as exc:
+            self.logger.error('Loading the certificate failed: {0}: {1}'.format(exc.__class__.__name__, str(exc)))
+            raise ConnectionBroken
+
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.settimeout(self.max_timeout)
-            self.server_socket.bind((socket.gethostbyname(socket.gethostname()), port))
-            self.server_socket.listen(5)
+            self.server_socket = make_listening_socket(port, reuse_port)
+            self.server_socket.listen(socket.SOMAXCONN)
             self.logger.debug('Server socket opened on: {0}'.format(self.server_socket.getsockname()))
         except socket.error as se:
             self.logger.error('{0}: {1}'.format(se.__class__.__name__, str(se)))
             raise ConnectionBroken
-        
+
         self.open_connections[self.server_socket] = self.server_socket.getsockname()
+        self.server_fd = self.server_socket.fileno()
+        self.poller = make_poller()
+        self.poller.register(self.server_fd, EVENT_READ)
+        self.waker = Waker()
+        self.poller.register(self.waker.fileno(), EVENT_READ)
         self.server_running.set()
         self.listener_thread = threading.Thread(target=self._listener)
         self.listener_thread.start()
-        
+
         self.logger.info('Server started.')
         return self.server_socket.getsockname()
 
@@ -124,4 +726,6 @@ class Server(NetworkBase):
         self.listener_stopped.wait()
 
         self._close_socket(self.server_socket)
+        self.poller.close()
+        self.waker.close()
         self.logger.info('Server closed.')
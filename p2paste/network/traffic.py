@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+'''
+Logging of the packages going through the network layer
+
+Traffic records only carry the package type, sender and data size along with the
+peer, and are formatted by the logging module only when a handler emits them.
+Full payloads go to the separate trace logger, which stays silent unless it's
+explicitly enabled.
+'''
+
+import itertools
+import logging
+
+
+TRACE_LOGGER_NAME = 'p2paste.trace'
+
+
+class PackageSummary(object):
+    '''Describes a package without its data, formatted lazily'''
+
+    __slots__ = ('package',)
+
+    def __init__(self, package):
+        self.package = package
+
+    def __str__(self):
+        package = self.package
+        if not isinstance(package, dict):
+            return '<{0}>'.format(type(package).__name__)
+
+        data = package.get('data')
+        if isinstance(data, basestring):
+            size = '{0} chars'.format(len(data))
+        elif isinstance(data, (list, tuple)):
+            size = '{0} items'.format(len(data))
+        elif isinstance(data, dict):
+            size = '{0} keys'.format(len(data))
+        else:
+            size = type(data).__name__
+        return 'type={0} sender={1} data={2}'.format(package.get('type'), package.get('sender', '-'), size)
+
+
+class TrafficLog(object):
+    '''
+    DEBUG records of sent and received packages, only every sample_rate-th one of
+    them is written. The trace logger gets every payload in full once enabled.
+    '''
+
+    def __init__(self, logger, sample_rate=1, trace_logger=None):
+        self.logger = logger
+        self.sample_rate = max(1, int(sample_rate))
+        self.trace_logger = trace_logger or logging.getLogger(TRACE_LOGGER_NAME)
+        self.counter = itertools.count()
+
+    def _record(self, direction, peer, package, size):
+        if self.logger.isEnabledFor(logging.DEBUG) and next(self.counter) % self.sample_rate == 0:
+            self.logger.debug('%s %s: %s, %s bytes', direction, peer, PackageSummary(package), size)
+        if self.trace_logger.isEnabledFor(logging.DEBUG):
+            self.trace_logger.debug('%s %s: %r', direction, peer, package)
+
+    def sent(self, peer, package, size):
+        self._record('Sent to', peer, package, size)
+
+    def received(self, peer, package, size):
+        self._record('Received from', peer, package, size)
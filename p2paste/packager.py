@@ -7,7 +7,28 @@ import re
 
 
 VALID_PACKAGES = (PKG_IDENTIFY, PKG_CLIENT_LIST, PKG_MESSAGE, PKG_PASTE, 
-                  PKG_PASTE_REQUEST, PKG_PASTE_GRANTED, PKG_PASTE_NOTIFICATION) = range(7)
+                  PKG_PASTE_REQUEST, PKG_PASTE_GRANTED, PKG_PASTE_NOTIFICATION,
+                  PKG_PASTE_DELTA, PKG_PASTE_SNAPSHOT_REQUEST, PKG_PASTE_ACCEPTED,
+                  PKG_PASTE_REJECTED, PKG_PASTE_CHUNK, PKG_PASTE_ABORT, PKG_ADMIN_METRICS,
+                  PKG_ROOM_JOIN, PKG_ROOM_LEAVE, PKG_HISTORY, PKG_HISTORY_PASTE, PKG_PASTE_REF,
+                  PKG_PASTE_FETCH, PKG_PASTE_RELEASE, PKG_PASTE_RENEW, PKG_CLIENT_LIST_DELTA) = range(23)
+
+# Optional protocol features, offered by the client when identifying and
+# confirmed by the server in the welcome package
+FEATURE_PASTE_DELTA = 'paste_delta'
+FEATURE_PASTE_CHUNKS = 'paste_chunks'
+FEATURE_ROOMS = 'rooms'
+FEATURE_HISTORY = 'history'
+FEATURE_PASTE_HASH = 'paste_hash'
+FEATURE_PASTE_LEASES = 'paste_leases'
+FEATURE_RESUME = 'resume'
+FEATURE_CLIENT_LIST_DELTA = 'client_list_delta'
+SUPPORTED_FEATURES = (FEATURE_PASTE_DELTA, FEATURE_PASTE_CHUNKS, FEATURE_ROOMS, FEATURE_HISTORY, FEATURE_PASTE_HASH,
+                      FEATURE_PASTE_LEASES, FEATURE_RESUME, FEATURE_CLIENT_LIST_DELTA)
+
+# Every client is in the default room, packages without a room belong to it
+DEFAULT_ROOM = 'lobby'
+ROOM_NAME_PATTERN = re.compile(r'^[A-Za-z0-9\._#-]{1,32}$')
 
 
 class ClientIdentificationFailed(Exception):
@@ -37,9 +58,149 @@ class DataPackager(object):
         except KeyError:
             raise ClientIdentificationFailed
         
+    def _get_offered_names(self, package, key):
+        # Anything but a list of names counts as no offer, and the defaults are used
+        offered = package.get(key)
+        if not isinstance(offered, list) or not all(isinstance(name, basestring) for name in offered):
+            return []
+        return offered
+
+    def get_offered_codecs(self, package):
+        # Peers predating codec negotiation don't offer anything, and keep using JSON
+        return self._get_offered_names(package, 'codecs')
+
+    def add_codec_to_package(self, package, codec_name):
+        return dict(package, codec=codec_name)
+
+    def get_negotiated_codec(self, package):
+        return package.get('codec')
+
+    def get_offered_compressions(self, package):
+        return self._get_offered_names(package, 'compressions')
+
+    def add_compression_to_package(self, package, compression_name):
+        return dict(package, compression=compression_name)
+
+    def get_negotiated_compression(self, package):
+        return package.get('compression')
+
+    def get_offered_features(self, package):
+        return self._get_offered_names(package, 'features')
+
+    def add_features_to_package(self, package, features):
+        return dict(package, features=list(features))
+
+    def get_negotiated_features(self, package):
+        return package.get('features')
+
+    def add_version_to_package(self, package, version):
+        return dict(package, version=version)
+
+    def get_package_version(self, package):
+        return package.get('version', 0)
+
+    def add_sequence_to_package(self, package, sequence):
+        return dict(package, seq=sequence)
+
+    def get_package_sequence(self, package):
+        return package.get('seq')
+
+    def add_epoch_to_package(self, package, epoch):
+        return dict(package, epoch=epoch)
+
+    def get_package_epoch(self, package):
+        return package.get('epoch')
+
+    def get_resume(self, package):
+        '''
+        (epoch, {room: (last sequence number, blackboard version)}) a reconnecting client
+        offers when identifying, None for a new client
+        '''
+        resume = package.get('resume')
+        if resume is None:
+            return None
+        try:
+            rooms = dict((self.verify_room_name(room_name), (int(sequence), int(version)))
+                         for room_name, (sequence, version) in resume['rooms'].items())
+            return resume['epoch'], rooms
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise PackageVerificationFailed
+
+    def unpack_paste_delta(self, delta_data):
+        try:
+            base_version = int(delta_data['base'])
+            changes = []
+            for start, end, replacement in delta_data['changes']:
+                if not isinstance(start, (int, long)) or not isinstance(end, (int, long)) or \
+                        not 0 <= start <= end or not isinstance(replacement, basestring):
+                    raise ValueError
+                changes.append([start, end, replacement])
+            return base_version, changes
+        except (KeyError, TypeError, ValueError):
+            raise PackageVerificationFailed
+
+    def unpack_paste_chunk(self, chunk_data):
+        try:
+            if not isinstance(chunk_data['chunk'], basestring):
+                raise ValueError
+            return (chunk_data['paste_id'], int(chunk_data['index']), int(chunk_data['total']),
+                    chunk_data['chunk'], bool(chunk_data['final']))
+        except (KeyError, TypeError, ValueError):
+            raise PackageVerificationFailed
+
+    def unpack_paste_ref(self, ref_data):
+        try:
+            if not isinstance(ref_data['hash'], basestring):
+                raise ValueError
+            return ref_data['hash'], int(ref_data['size'])
+        except (KeyError, TypeError, ValueError):
+            raise PackageVerificationFailed
+
+    def unpack_paste_fetch(self, fetch_data):
+        '''(hash, text) of a fetched paste body, text is None when the server no longer has it'''
+        try:
+            paste_hash, text = fetch_data['hash'], fetch_data['text']
+            if not isinstance(paste_hash, basestring) or not isinstance(text, (basestring, type(None))):
+                raise ValueError
+            return paste_hash, text
+        except (KeyError, TypeError, ValueError):
+            raise PackageVerificationFailed
+
+    def unpack_client_list_delta(self, delta_data):
+        '''([(member id, nickname)] joined, [member id] left, whether it is the whole list) of a client list delta'''
+        try:
+            joined = [(member_id, nickname) for member_id, nickname in delta_data['joined']]
+            left = list(delta_data['left'])
+            if not all(isinstance(value, basestring) for pair in joined for value in pair) or \
+                    not all(isinstance(member_id, basestring) for member_id in left):
+                raise ValueError
+            return joined, left, bool(delta_data['full'])
+        except (KeyError, TypeError, ValueError):
+            raise PackageVerificationFailed
+
+    def unpack_history_request(self, request_data):
+        '''(before paste id, before timestamp, limit) of a history page request, any of them may be None'''
+        try:
+            before, before_time, limit = request_data['before'], request_data['before_time'], request_data['limit']
+            return (None if before is None else int(before), None if before_time is None else float(before_time),
+                    None if limit is None else int(limit))
+        except (KeyError, TypeError, ValueError):
+            raise PackageVerificationFailed
+
+    def add_room_to_package(self, package, room_name):
+        return dict(package, room=room_name)
+
+    def get_package_room(self, package):
+        return package.get('room', DEFAULT_ROOM)
+
+    def verify_room_name(self, room_name):
+        if not isinstance(room_name, basestring) or not ROOM_NAME_PATTERN.match(room_name):
+            raise PackageVerificationFailed
+        return room_name
+
     def add_sender_to_package(self, package, nickname):
-        package.update(sender=nickname)
-        return package
+        # Received packages are shared between handlers, so the original stays untouched
+        return dict(package, sender=nickname)
         
     def process_package(self, package, sender_needed=True):
         try:
@@ -53,8 +214,19 @@ class DataPackager(object):
         except KeyError:
             raise PackageVerificationFailed
     
-    def make_id_package(self, nickname):
-        return self._pack(PKG_IDENTIFY, nickname)
+    def make_id_package(self, nickname, codecs=None, compressions=None, features=None, resume=None):
+        package = self._pack(PKG_IDENTIFY, nickname)
+        if resume:
+            epoch, rooms = resume
+            package.update(resume=dict(epoch=epoch, rooms=dict(
+                (room_name, [sequence, version]) for room_name, (sequence, version) in rooms.items())))
+        if codecs:
+            package.update(codecs=list(codecs))
+        if compressions:
+            package.update(compressions=list(compressions))
+        if features:
+            package.update(features=list(features))
+        return package
     
     def make_message_package(self, message):
         return self._pack(PKG_MESSAGE, message)
@@ -62,15 +234,79 @@ class DataPackager(object):
     def make_paste_package(self, paste_data):
         return self._pack(PKG_PASTE, paste_data)
     
+    def make_paste_delta_package(self, base_version, changes):
+        return self._pack(PKG_PASTE_DELTA, dict(base=base_version, changes=changes))
+
+    def make_paste_ref_package(self, paste_hash, size):
+        # A paste by its content hash, for a receiver that may already have it
+        return self._pack(PKG_PASTE_REF, dict(hash=paste_hash, size=size))
+
+    def make_paste_fetch_request_package(self, paste_hash):
+        return self._pack(PKG_PASTE_FETCH, paste_hash)
+
+    def make_paste_fetch_package(self, paste_hash, text):
+        return self._pack(PKG_PASTE_FETCH, dict(hash=paste_hash, text=text))
+
+    def make_paste_snapshot_request_package(self):
+        return self._pack(PKG_PASTE_SNAPSHOT_REQUEST, None)
+
+    def make_paste_accepted_package(self, version):
+        return self._pack(PKG_PASTE_ACCEPTED, version)
+
+    def make_paste_rejected_package(self):
+        return self._pack(PKG_PASTE_REJECTED, None)
+
+    def make_paste_chunk_package(self, paste_id, index, total_size, chunk, final):
+        return self._pack(PKG_PASTE_CHUNK, dict(paste_id=paste_id, index=index, total=total_size,
+                                                chunk=chunk, final=final))
+
+    def make_paste_abort_package(self, paste_id):
+        return self._pack(PKG_PASTE_ABORT, paste_id)
+
+    def make_admin_metrics_package(self, metrics=None):
+        return self._pack(PKG_ADMIN_METRICS, metrics)
+
     def make_paste_request_package(self):
         return self._pack(PKG_PASTE_REQUEST, None)
 
     def make_paste_granted_package(self):
         return self._pack(PKG_PASTE_GRANTED, None)
     
+    def make_paste_release_package(self):
+        return self._pack(PKG_PASTE_RELEASE, None)
+
+    def make_paste_renew_package(self, renewed=None):
+        # Sent by the holder without data, answered with whether the lease was renewed
+        return self._pack(PKG_PASTE_RENEW, renewed)
+
     def make_paste_notification_package(self, nickname):
         return self._pack(PKG_PASTE_NOTIFICATION, nickname)
     
     def make_client_list_package(self, client_list):
         return self._pack(PKG_CLIENT_LIST, client_list)
+
+    def make_client_list_delta_package(self, joined, left=(), full=False):
+        # Members are keyed by id, nicknames needn't be unique. A full delta replaces the whole list.
+        return self._pack(PKG_CLIENT_LIST_DELTA, dict(joined=[[member_id, nickname] for member_id, nickname in joined],
+                                                      left=list(left), full=full))
+
+    def make_room_join_package(self, room_name):
+        return self._pack(PKG_ROOM_JOIN, room_name)
+
+    def make_room_leave_package(self, room_name):
+        return self._pack(PKG_ROOM_LEAVE, room_name)
+
+    def make_history_request_package(self, before=None, before_time=None, limit=None):
+        return self._pack(PKG_HISTORY, dict(before=before, before_time=before_time, limit=limit))
+
+    def make_history_page_package(self, entries):
+        return self._pack(PKG_HISTORY, entries)
+
+    def make_history_paste_request_package(self, paste_id=None):
+        # No paste id asks for the latest paste of the room
+        return self._pack(PKG_HISTORY_PASTE, paste_id)
+
+    def make_history_paste_package(self, paste_id, text, timestamp=None, version=None, sender=None):
+        return self._pack(PKG_HISTORY_PASTE, dict(paste_id=paste_id, text=text, timestamp=timestamp,
+                                                  version=version, sender=sender))
     
\ No newline at end of file
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''
+Chat rooms, each with its members, blackboard, paste permission leases, the
+recent broadcasts a reconnecting member may have missed and the client list as
+the members were last told it
+'''
+
+from p2paste.blackboard import Blackboard
+from collections import deque
+import threading
+
+
+# Room-wide broadcasts kept for replay, per room, and the most bytes of package data they may hold
+REPLAY_SIZE = 512
+REPLAY_BYTES = 4 * 1024 * 1024
+
+
+def _data_size(data):
+    '''Rough bytes held by package data, its strings and a few for anything else'''
+    if isinstance(data, basestring):
+        return len(data)
+    if isinstance(data, dict):
+        return sum(_data_size(key) + _data_size(value) for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return sum(_data_size(item) for item in data) + 8
+    return 8
+
+
+class Room(object):
+
+    def __init__(self, name, first_sequence=0):
+        self.name = name
+        self.members = set()
+        self.blackboard = Blackboard()
+        self.client_versions = dict()
+        self.paste_stream = None
+        self.paste_permission_holder = None
+        # PasteLeases of the room, left to the hub by the workers of a cluster
+        self.leases = None
+        # (sequence number, package, size) of the latest room-wide broadcasts. Numbering, recording
+        # and sending a broadcast, or adding a member and replaying to it, happen under the lock,
+        # so every member gets the numbers in order.
+        self.replay = deque()
+        self.replay_bytes = 0
+        # Broadcasts numbered up to this one can't be replayed, they were dropped or predate the room
+        self.replay_start = first_sequence
+        self.broadcast_lock = threading.Lock()
+        # Member id -> nickname of the members on the other workers of a cluster
+        self.remote_members = dict()
+        # Member id -> nickname, as the last client list delta left it, and the ids that full
+        # lists sent to newcomers since showed on top. Joins and leaves are sent out together,
+        # once the timer of the first one fires. Full lists and deltas are made and sent under
+        # the lock, so none overtakes another.
+        self.roster = dict()
+        self.shown = set()
+        self.roster_timer = None
+        self.roster_lock = threading.RLock()
+        self.open = True
+
+    def record(self, sequence, package):
+        '''
+        Keeps the broadcast for replay, dropping the oldest ones past REPLAY_SIZE or REPLAY_BYTES.
+        A broadcast larger than REPLAY_BYTES isn't kept, nor anything before it. Returns the
+        change in the bytes kept, nothing is kept once the room is closed.
+        '''
+        if not self.open:
+            return 0
+        size = _data_size(package)
+        if size > REPLAY_BYTES:
+            self.replay_start = sequence
+            return -self.forget_replay()
+        kept = self.replay_bytes
+        self.replay.append((sequence, package, size))
+        self.replay_bytes += size
+        while len(self.replay) > REPLAY_SIZE or self.replay_bytes > REPLAY_BYTES:
+            self.replay_start, _package, dropped_size = self.replay.popleft()
+            self.replay_bytes -= dropped_size
+        return self.replay_bytes - kept
+
+    def forget_replay(self):
+        '''Drops every broadcast kept for replay, returns the bytes they held'''
+        released, self.replay_bytes = self.replay_bytes, 0
+        self.replay.clear()
+        return released
+
+    def replay_since(self, sequence):
+        '''Packages of the broadcasts numbered after the sequence number, None if some are gone'''
+        if sequence < self.replay_start:
+            return None
+        return [package for package_sequence, package, _size in self.replay if package_sequence > sequence]
+
+    def close(self):
+        self.open = False
+        if self.leases is not None:
+            self.leases.close()
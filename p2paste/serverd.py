@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+'''
+Headless p2paste server, for hosting without the gui (and without Tkinter installed)
+
+    python -m p2paste.serverd --port 8956 --config /etc/p2paste.conf
+
+Every option defaults to the settings module, a config file overrides those and
+the command line overrides both. The config file uses a [server] section:
+
+    [server]
+    port = 8956
+    metrics_port = 9100
+    certificate = /etc/p2paste/cert.pem
+    key = /etc/p2paste/key.pem
+    log_path = /var/log/p2paste/server.log
+    log_level = INFO
+    workers = 4
+    paste_policy = fair
+    memory_ceiling = 536870912
+    memory_policy = degrade
+    rate_policy = drop
+    history_path = /var/lib/p2paste/history
+    history_max_bytes = 268435456
+
+With more than one worker, the clients are spread over that many processes on the
+same port, see the cluster module. An empty history_path keeps no paste history, and
+a memory_ceiling of 0 sets no ceiling.
+SIGTERM and SIGINT close the server gracefully. The chat server and the network
+layer are only imported once the options are read, so --help and option errors
+return right away.
+'''
+
+from ConfigParser import SafeConfigParser, Error as ConfigError
+import threading
+import argparse
+import logging
+import signal
+import site
+import sys
+import os
+
+
+CONFIG_SECTION = 'server'
+# Seconds between checks for a shutdown, a bare Event.wait would block signal handlers
+SHUTDOWN_POLL_INTERVAL = 1
+
+# (option, type, setting the default comes from)
+OPTIONS = (
+    ('port', int, 'DEFAULT_PORT'),
+    ('workers', int, 'SERVER_WORKERS'),
+    ('metrics_port', int, 'METRICS_PORT'),
+    ('certificate', str, 'CERTIFICATE_PATH'),
+    ('key', str, 'KEY_PATH'),
+    ('ssl_version', str, None),
+    ('paste_time', float, 'ALLOWED_PASTE_TIME'),
+    ('paste_policy', str, 'PASTE_POLICY'),
+    ('timeout', float, 'SERVER_TIMEOUT'),
+    ('outbound_buffer_size', int, 'OUTBOUND_BUFFER_SIZE'),
+    ('inbound_buffer_size', int, 'INBOUND_BUFFER_SIZE'),
+    ('memory_ceiling', int, 'MEMORY_CEILING'),
+    ('memory_policy', str, 'MEMORY_POLICY'),
+    ('rate_policy', str, 'RATE_POLICY'),
+    ('compression_threshold', int, 'COMPRESSION_THRESHOLD'),
+    ('welcome_message', str, 'SERVER_WELCOME_MESSAGE'),
+    ('log_path', str, 'SERVER_LOG_PATH'),
+    ('log_level', str, None),
+    ('log_sample_rate', int, 'LOG_SAMPLE_RATE'),
+    ('history_path', str, 'HISTORY_PATH'),
+    ('history_segment_size', int, 'HISTORY_SEGMENT_SIZE'),
+    ('history_max_bytes', int, 'HISTORY_MAX_BYTES'),
+    ('history_max_age', float, 'HISTORY_MAX_AGE'),
+)
+
+
+class InvalidConfiguration(Exception):
+    pass
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description='Hosts a p2paste chat server without the gui.')
+    parser.add_argument('--config', help='config file with a [{0}] section'.format(CONFIG_SECTION))
+    for name, option_type, _setting in OPTIONS:
+        parser.add_argument('--' + name.replace('_', '-'), dest=name, type=option_type)
+    parser.add_argument('--trace-payloads', action='store_true', default=None,
+                        help='dump every payload to the trace log')
+    return parser.parse_args(argv)
+
+
+def read_config_file(path):
+    parser = SafeConfigParser()
+    try:
+        if not parser.read(path):
+            raise InvalidConfiguration('Config file not found: {0}'.format(path))
+        if not parser.has_section(CONFIG_SECTION):
+            return dict()
+        values = dict()
+        for name, option_type, _setting in OPTIONS:
+            if parser.has_option(CONFIG_SECTION, name):
+                values[name] = option_type(parser.get(CONFIG_SECTION, name))
+        if parser.has_option(CONFIG_SECTION, 'trace_payloads'):
+            values['trace_payloads'] = parser.getboolean(CONFIG_SECTION, 'trace_payloads')
+        return values
+    except (ConfigError, ValueError) as exc:
+        raise InvalidConfiguration('Invalid config file {0}: {1}'.format(path, str(exc)))
+
+
+def resolve_options(arguments, settings):
+    '''Settings, overridden by the config file, overridden by the command line'''
+    from p2paste.leases import POLICIES
+    from p2paste.network.limits import MEMORY_POLICIES, RATE_POLICIES
+    import ssl
+
+    options = dict((name, getattr(settings, setting) if setting else None) for name, _type, setting in OPTIONS)
+    options['trace_payloads'] = settings.TRACE_PAYLOADS
+    if arguments.config:
+        options.update(read_config_file(arguments.config))
+    options.update((name, value) for name, value in vars(arguments).items()
+                   if value is not None and name != 'config')
+
+    if options['ssl_version'] is None:
+        options['ssl_version'] = settings.SSL_VERSION
+    elif not hasattr(ssl, options['ssl_version']):
+        raise InvalidConfiguration('Unknown ssl version: {0}'.format(options['ssl_version']))
+    else:
+        options['ssl_version'] = getattr(ssl, options['ssl_version'])
+
+    if options['log_level'] is None:
+        options['log_level'] = settings.LOG_LEVEL
+    elif not isinstance(logging.getLevelName(options['log_level'].upper()), int):
+        raise InvalidConfiguration('Unknown log level: {0}'.format(options['log_level']))
+    else:
+        options['log_level'] = logging.getLevelName(options['log_level'].upper())
+
+    if options['paste_policy'] not in POLICIES:
+        raise InvalidConfiguration('Unknown paste policy: {0}'.format(options['paste_policy']))
+    if options['memory_policy'] not in MEMORY_POLICIES:
+        raise InvalidConfiguration('Unknown memory policy: {0}'.format(options['memory_policy']))
+    if options['rate_policy'] not in RATE_POLICIES:
+        raise InvalidConfiguration('Unknown rate policy: {0}'.format(options['rate_policy']))
+    for name in ('outbound_buffer_size', 'inbound_buffer_size'):
+        if options[name] < 1:
+            raise InvalidConfiguration('{0} must be positive'.format(name))
+    if options['memory_ceiling'] is not None and options['memory_ceiling'] < 0:
+        raise InvalidConfiguration('memory_ceiling can\'t be negative')
+    if options['workers'] < 1:
+        raise InvalidConfiguration('At least one worker is needed')
+    if not settings.PORT_NUMBER_BOTTOM_BOUNDARY <= options['port'] <= 65535:
+        raise InvalidConfiguration('Port number must be between {0} and 65535'.format(
+            settings.PORT_NUMBER_BOTTOM_BOUNDARY))
+    return options
+
+
+def setup_logger(options):
+    from p2paste.logs import make_log_handler, setup_trace_logger
+
+    logging.getLogger('').setLevel(options['log_level'])
+    server_logger = logging.getLogger('server_logger')
+    server_logger.addHandler(make_log_handler(options['log_path'], 'server.log'))
+    setup_trace_logger(options['trace_payloads'])
+    return server_logger
+
+
+def serve(options, logger, stop_requested):
+    from p2paste.chatserver import ChatServer, ConnectionBroken
+    from p2paste.history import PasteHistory
+    from p2paste.network.limits import ServerLimits
+    from p2paste import settings
+
+    if options['workers'] > 1:
+        from p2paste.cluster import ChatCluster
+        make_chat_server = lambda *args: ChatCluster(options['workers'], *args)
+    else:
+        make_chat_server = ChatServer
+
+    chat_server = make_chat_server(
+        logger,
+        settings.SERVER_IDENTIFIER,
+        options['welcome_message'],
+        options['paste_time'],
+        options['timeout'],
+        options['ssl_version'],
+        options['certificate'],
+        options['key'],
+        options['outbound_buffer_size'],
+        options['compression_threshold'],
+        options['log_sample_rate'],
+        ServerLimits(options['inbound_buffer_size'], settings.FRAME_SIZE_LIMITS, options['memory_ceiling'],
+                     options['memory_policy'], settings.RATE_LIMITS, options['rate_policy'])
+    )
+    history = None
+    if options['history_path']:
+        history = PasteHistory(logger, options['history_path'], options['history_segment_size'],
+                               options['history_max_bytes'], options['history_max_age'])
+    try:
+        address = chat_server.host(options['port'], options['metrics_port'], history=history,
+                                   paste_policy=options['paste_policy'])
+    except ConnectionBroken:
+        logger.error('Hosting failed on port: {0}'.format(options['port']))
+        return 1
+
+    logger.info('Server daemon running at {0}:{1}, pid {2}'.format(address[0], address[1], os.getpid()))
+    while not stop_requested.is_set() and chat_server.running:
+        stop_requested.wait(SHUTDOWN_POLL_INTERVAL)
+
+    logger.info('Server daemon shutting down.')
+    if chat_server.running:
+        chat_server.close_server()
+    return 0
+
+
+def main(argv=None):
+    arguments = parse_arguments(sys.argv[1:] if argv is None else argv)
+
+    # The network package is imported from the p2paste directory, which start.py runs from
+    site.sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+    from p2paste import settings
+
+    try:
+        options = resolve_options(arguments, settings)
+    except InvalidConfiguration as exc:
+        sys.stderr.write('{0}\n'.format(exc))
+        return 2
+
+    logger = setup_logger(options)
+    stop_requested = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info('Received signal {0}.'.format(signum))
+        stop_requested.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    return serve(options, logger, stop_requested)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,12 @@
 Settings module contains all global constants
 '''
 
+from p2paste.packager import (PKG_IDENTIFY, PKG_MESSAGE, PKG_PASTE, PKG_PASTE_DELTA, PKG_PASTE_REQUEST,
+                              PKG_PASTE_SNAPSHOT_REQUEST, PKG_PASTE_ABORT, PKG_ADMIN_METRICS, PKG_ROOM_JOIN,
+                              PKG_ROOM_LEAVE, PKG_HISTORY, PKG_HISTORY_PASTE, PKG_PASTE_FETCH, PKG_PASTE_RELEASE,
+                              PKG_PASTE_RENEW, PKG_PASTE_CHUNK, PKG_PASTE_REF)
+from p2paste.network.limits import ALL_FRAMES
+import logging
 import os
 import ssl
 
@@ -10,17 +16,99 @@ import ssl
 PROJECT_ROOT = os.path.dirname(os.path.realpath(__file__))
 SERVER_LOG_PATH = os.path.join(os.path.dirname(PROJECT_ROOT), 'logs', 'server.log')
 CLIENT_LOG_PATH = os.path.join(os.path.dirname(PROJECT_ROOT), 'logs', 'client.log')
+TRACE_LOG_PATH = os.path.join(os.path.dirname(PROJECT_ROOT), 'logs', 'trace.log')
+# DEBUG adds a record (type, sender and size) of every package sent and received
+LOG_LEVEL = logging.INFO
+# Only every Nth package record is written
+LOG_SAMPLE_RATE = 1
+# Dumps every payload in full to the trace log, very slow with large pastes
+TRACE_PAYLOADS = False
+
 DEFAULT_PORT = 8956
 
 PORT_NUMBER_BOTTOM_BOUNDARY = 1024
 SERVER_TIMEOUT = 15
+# Processes sharing the server port (SO_REUSEPORT, Linux only), the headless server uses more than one
+SERVER_WORKERS = 1
 CLIENT_TIMEOUT = 10
 
-SSL_VERSION = ssl.PROTOCOL_TLSv1
+# Bytes buffered for a client that isn't reading, before it gets disconnected
+OUTBOUND_BUFFER_SIZE = 16 * 1024 * 1024
+# Largest frame accepted from a client, compressed or once decompressed. A frame announcing
+# more is refused before any of it is buffered, and the client disconnected.
+INBOUND_BUFFER_SIZE = 64 * 1024 * 1024
+# Lower limits for the packages that never carry a paste, in bytes once decompressed
+CONTROL_FRAME_SIZE = 64 * 1024
+FRAME_SIZE_LIMITS = dict(
+    [(PKG_MESSAGE, 1024 * 1024)] +
+    [(package_type, CONTROL_FRAME_SIZE) for package_type in (
+        PKG_IDENTIFY, PKG_PASTE_REQUEST, PKG_PASTE_SNAPSHOT_REQUEST, PKG_PASTE_ABORT, PKG_ADMIN_METRICS,
+        PKG_ROOM_JOIN, PKG_ROOM_LEAVE, PKG_HISTORY, PKG_HISTORY_PASTE, PKG_PASTE_FETCH, PKG_PASTE_RELEASE,
+        PKG_PASTE_RENEW)]
+)
+# Bytes held for all clients together, in queued frames and receive buffers, None for no ceiling
+MEMORY_CEILING = 1024 * 1024 * 1024
+# Past the ceiling: 'drop' broadcasts for the clients holding more than their share, 'disconnect' the clients
+# holding the most, or 'degrade' by reading from no client until the queues drained
+MEMORY_POLICY = 'disconnect'
+
+# Frames per second a client may send of a package type, and how many in a burst. ALL_FRAMES counts
+# every frame, before it's decoded. The paste chunks burst to a whole paste of INBOUND_BUFFER_SIZE
+# in chunks of PASTE_CHUNK_SIZE.
+RATE_LIMITS = {
+    ALL_FRAMES: (100, 1200),
+    PKG_MESSAGE: (5, 20),
+    PKG_PASTE_REQUEST: (1, 5),
+    PKG_PASTE: (1, 5),
+    PKG_PASTE_DELTA: (1, 5),
+    PKG_PASTE_REF: (1, 5),
+    PKG_PASTE_CHUNK: (64, 1024),
+    PKG_PASTE_RELEASE: (1, 5),
+    PKG_PASTE_RENEW: (1, 5),
+    PKG_PASTE_SNAPSHOT_REQUEST: (2, 10),
+    PKG_PASTE_FETCH: (2, 10),
+    PKG_ROOM_JOIN: (2, 20),
+    PKG_ROOM_LEAVE: (2, 20),
+    PKG_HISTORY: (2, 10),
+    PKG_HISTORY_PASTE: (2, 10),
+    PKG_ADMIN_METRICS: (1, 5),
+}
+# Frames over their rate: 'throttle' stops reading from the client until it may send again,
+# 'drop' throws them away
+RATE_POLICY = 'throttle'
+# Frames smaller than this are never compressed
+COMPRESSION_THRESHOLD = 1024
+
+# Negotiates the newest TLS version both ends speak, SSLv2 and SSLv3 are always refused
+SSL_VERSION = ssl.PROTOCOL_SSLv23
 CERTIFICATE_PATH = os.path.join(os.path.dirname(PROJECT_ROOT), 'certificates', 'cert.pem')
 KEY_PATH = os.path.join(os.path.dirname(PROJECT_ROOT), 'certificates', 'cert.pem')
 
+# Lines kept in the chatbox of the gui, the oldest ones go first
+CHAT_SCROLLBACK = 5000
+
+# Pastes of more characters open read-only in the gui, rendered as the view scrolls down
+LARGE_PASTE_SIZE = 4 * 1024 * 1024
+
 SERVER_IDENTIFIER = "Server"
 SERVER_WELCOME_MESSAGE = "Welcome to p2paste chat"
 
+# Seconds a paste permission lasts, or the time allowed between two chunks of a streamed paste
 ALLOWED_PASTE_TIME = 15
+# Who gets the paste permission next: 'fifo' in the order of the requests, or 'fair' for
+# whoever had it least recently, and the holder can't renew it while others wait
+PASTE_POLICY = 'fifo'
+# Pastes longer than this many characters are streamed in chunks of this size
+PASTE_CHUNK_SIZE = 64 * 1024
+
+# Localhost port serving the server metrics to a Prometheus scraper, None disables it
+METRICS_PORT = None
+
+# Directory of the server's paste history log, None keeps no history
+HISTORY_PATH = None
+# Bytes written to a history segment before the next one is started
+HISTORY_SEGMENT_SIZE = 16 * 1024 * 1024
+# The oldest segments are dropped once the history is larger than this many bytes,
+# or older than this many seconds, None keeps them
+HISTORY_MAX_BYTES = 256 * 1024 * 1024
+HISTORY_MAX_AGE = 30 * 24 * 60 * 60